@@ -10,20 +10,21 @@ from typing import List, Literal, Optional, Any
 import send2trash
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, BackgroundTasks
 from pydantic import BaseModel
 import torch
 
 from clip_finder_backend.clip_modelling import AutoloadingClipModel, ClipModel
-from clip_finder_backend.loaders import load_embedding_store
+from clip_finder_backend.loaders import load_embedding_store, load_thumbnail_provider, load_tags_wrangler
 from clip_finder_backend.progress_manager import ProgressManager
 from clip_finder_backend.embedding_store import Query, SimpleClipEmbeddingStore, ShardedEmbeddingStore, EmbeddingStore
-from clip_finder_backend.tasks import perform_search_task, perform_get_images_by_tags_task
-from clip_finder_backend.thumbnail_provider import ThumbnailProvider
+from clip_finder_backend.indexing_jobs import IndexingJobManager, IndexingJobInfo
+from clip_finder_backend.thumbnail_provider import pack_thumbnails
+from clip_finder_backend.tasks import perform_search_task, perform_get_images_by_tags_task, perform_resume_ingestion_task, \
+    perform_tag_update_task
 from clip_finder_backend.types import ZeroShotClassifyRequest, ImageResponse
 from clip_finder_backend.zero_shot import do_zero_shot_classify
-from clip_finder_backend.tags_wrangler import TagsWrangler
 
 import torch.nn.functional as F
 
@@ -39,8 +40,14 @@ embedding_store = load_embedding_store()
 print("making thumbnail provider")
 
 progress_manager = ProgressManager()
-thumbnail_provider = ThumbnailProvider()
-tags_wrangler = TagsWrangler(embedding_store.image_paths)
+thumbnail_provider = load_thumbnail_provider()
+indexing_jobs = IndexingJobManager(embedding_store, progress_manager,
+                                   max_images_per_second=float(os.environ["CLIPFINDER_INDEXING_MAX_IMAGES_PER_SECOND"])
+                                   if os.environ.get("CLIPFINDER_INDEXING_MAX_IMAGES_PER_SECOND") else None,
+                                   thumbnail_provider=thumbnail_provider
+                                   if os.environ.get("CLIPFINDER_INDEXING_WRITE_THUMBNAILS", "1") == "1" else None)
+tags_wrangler = load_tags_wrangler(embedding_store)
+embedding_store.attach_tag_index(tags_wrangler.tag_index, ensure_current=tags_wrangler.ensure_index_refreshed)
 
 print("making FastAPI")
 
@@ -83,6 +90,13 @@ async def websocket_endpoint(websocket: WebSocket):
 @app.on_event("startup")
 async def startup_event():
     """Start the progress manager when the FastAPI app starts"""
+    if embedding_store.has_pending_ingestion():
+        logger.info("Resuming an image import that was interrupted")
+        threading.Thread(target=lambda: asyncio.run(perform_resume_ingestion_task(
+            f'resume-ingestion-{uuid.uuid4()}', progress_manager=progress_manager, embedding_store=embedding_store)),
+            name='resume-ingestion', daemon=True).start()
+    # catch the tag index up with changes made while the server was down, before the first tag query needs it
+    threading.Thread(target=tags_wrangler.ensure_index_refreshed, name='tag-index-refresh', daemon=True).start()
     logger.info("Application startup complete")
 
 @app.on_event("shutdown")
@@ -98,6 +112,8 @@ class TaskResponse(BaseModel):
 class SearchRequest(BaseModel):
     task_id: str
     query: Query
+    """Set to False to get results without their tags, which saves reading the files' metadata"""
+    include_tags: bool = True
 
 @app.post("/api/search", response_model=TaskResponse)
 async def search_images(search_params: SearchRequest, background_tasks: BackgroundTasks):
@@ -110,7 +126,8 @@ async def search_images(search_params: SearchRequest, background_tasks: Backgrou
             perform_search_task(
                 task_id, query,
                 progress_manager=progress_manager,
-                embedding_store=embedding_store)
+                embedding_store=embedding_store,
+                tags_wrangler=tags_wrangler if search_params.include_tags else None)
         )
     await asyncio.to_thread(
         perform_search_task_from_thread
@@ -121,6 +138,38 @@ async def search_images(search_params: SearchRequest, background_tasks: Backgrou
         message="Search started. Use WebSocket to receive progress updates."
     )
 
+class StartIndexingRequest(BaseModel):
+    root_dir: str
+    task_id: Optional[str] = None
+    max_images_per_second: Optional[float] = None
+
+@app.post("/api/indexing/jobs", response_model=IndexingJobInfo)
+async def start_indexing_job(request: StartIndexingRequest):
+    """Index a directory in the background. Progress is sent over the WebSocket with the job id as task id."""
+    try:
+        return indexing_jobs.start_job(request.root_dir, job_id=request.task_id,
+                                       max_images_per_second=request.max_images_per_second)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/indexing/jobs", response_model=list[IndexingJobInfo])
+async def list_indexing_jobs():
+    return indexing_jobs.list_jobs()
+
+@app.get("/api/indexing/jobs/{job_id}", response_model=IndexingJobInfo)
+async def get_indexing_job(job_id: str):
+    job = indexing_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No indexing job with id {job_id}")
+    return job
+
+@app.post("/api/indexing/jobs/{job_id}/cancel", response_model=IndexingJobInfo)
+async def cancel_indexing_job(job_id: str):
+    job = indexing_jobs.cancel_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No indexing job with id {job_id}")
+    return job
+
 @app.get("/api/moveToTrash/{id}")
 async def move_image_to_trash(id: str):
     file_path = embedding_store.get_image_path_for_id(id)
@@ -177,7 +226,7 @@ async def get_images_by_tags(input: ImagesByTagsInput, background_tasks: Backgro
     task_id = input.task_id or str(f'tags-by-images-{uuid.uuid4()}')
     def perform_get_images_by_tags_task_from_thread():
         asyncio.run(
-            perform_get_images_by_tags_task(task_id=task_id, tags=input.tags,
+            perform_get_images_by_tags_task(task_id=task_id, tags=input.tags, match_all=input.match_all,
             progress_manager=progress_manager, embedding_store=embedding_store, tags_wrangler=tags_wrangler)
         )
     await asyncio.to_thread(
@@ -197,8 +246,7 @@ class GetEmbeddingsRequest(BaseModel):
 async def get_embeddings(request: GetEmbeddingsRequest):
     all_embeddings = []
     if request.texts:
-        text_embeddings = [embedding_store.get_text_embedding(t).unsqueeze(0) for t in request.texts]
-        all_embeddings.extend(text_embeddings)
+        all_embeddings.append(embedding_store.get_text_embeddings(request.texts))
     if request.image_ids:
         paths = [embedding_store.get_image_path_for_id(id) for id in request.image_ids]
         _, image_embeddings = embedding_store.get_image_embeddings(paths)
@@ -240,7 +288,7 @@ async def zero_shot_classify(request: ZeroShotClassifyRequest):
     logging.info(request)
     if request.is_empty:
         return
-    return do_zero_shot_classify(request=request, embedding_provider=embedding_store)
+    return do_zero_shot_classify(request=request, embedding_provider=embedding_store, tags_wrangler=tags_wrangler)
 
 
 class AddTagRequest(BaseModel):
@@ -250,18 +298,12 @@ class AddTagRequest(BaseModel):
 
 @app.post("/api/addTag")
 async def add_tag(request: AddTagRequest):
-    image_paths = [embedding_store.get_image_path_for_id(id) for id in request.image_ids]
-
-    errors = []
-    for image_path in image_paths:
-        try:
-            tags_wrangler.add_tag(image_path, request.tag_to_add)
-        except Exception as e:
-            errors.append(e)
+    failures = await asyncio.to_thread(_update_tags_for_ids, request.image_ids, add=[request.tag_to_add])
+    images_tags = await asyncio.to_thread(_build_images_tags, request.image_ids)
     return {
-        'images_tags': _build_images_tags(request.image_ids),
-        'errors': [str(e) for e in errors],
-        'message': f'added {request.tag_to_add}' + (f' ({len(errors)} errors)' if errors else '')}
+        'images_tags': images_tags,
+        'errors': list(failures.values()),
+        'message': f'added {request.tag_to_add}' + (f' ({len(failures)} errors)' if failures else '')}
 
 
 class DeleteTagRequest(BaseModel):
@@ -271,17 +313,92 @@ class DeleteTagRequest(BaseModel):
 
 @app.post("/api/deleteTag")
 async def delete_tag(request: DeleteTagRequest):
-    image_paths = [embedding_store.get_image_path_for_id(id) for id in request.image_ids]
-    errors = []
-    for image_path in image_paths:
-        try:
-            tags_wrangler.remove_tag(image_path, request.tag_to_delete)
-        except Exception as e:
-            errors.append(e)
+    failures = await asyncio.to_thread(_update_tags_for_ids, request.image_ids, remove=[request.tag_to_delete])
+    images_tags = await asyncio.to_thread(_build_images_tags, request.image_ids)
     return {
-        'images_tags': _build_images_tags(request.image_ids),
-        'errors': errors,
-        'message': f'deleted {request.tag_to_delete}' + (f' ({len(errors)} errors)' if errors else '')}
+        'images_tags': images_tags,
+        'errors': list(failures.values()),
+        'message': f'deleted {request.tag_to_delete}' + (f' ({len(failures)} errors)' if failures else '')}
+
+
+class BulkTagUpdateRequest(BaseModel):
+    image_ids: list[str]
+    add: list[str] = []
+    remove: list[str] = []
+    task_id: Optional[str] = None
+
+
+@app.post("/api/tags/bulk", response_model=TaskResponse)
+async def bulk_update_tags(request: BulkTagUpdateRequest):
+    """
+    Add and remove tags on many images in the background. The completion message over the WebSocket
+    carries the counts, the error for each image that failed, by id, and the new tags of every image.
+    """
+    task_id = request.task_id or f'bulk-tags-{uuid.uuid4()}'
+
+    def update(progress_callback):
+        failures = _update_tags_for_ids(request.image_ids, add=request.add, remove=request.remove,
+                                        progress_callback=progress_callback)
+        return {'failures': failures, 'images_tags': _build_images_tags(request.image_ids)}
+    _start_tag_update_task(task_id, f"Updating tags of {len(request.image_ids)} images", update)
+    return TaskResponse(task_id=task_id, message="Tag update started. Use WebSocket to receive progress updates.")
+
+
+class MergeTagsRequest(BaseModel):
+    source_tags: list[str]
+    target_tag: str
+    task_id: Optional[str] = None
+
+
+@app.post("/api/tags/merge", response_model=TaskResponse)
+async def merge_tags(request: MergeTagsRequest):
+    """Replace `source_tags` with `target_tag` on every image in the library, in the background."""
+    return _start_merge_tags(request.source_tags, request.target_tag, request.task_id)
+
+
+class RenameTagRequest(BaseModel):
+    old_tag: str
+    new_tag: str
+    task_id: Optional[str] = None
+
+
+@app.post("/api/tags/rename", response_model=TaskResponse)
+async def rename_tag(request: RenameTagRequest):
+    """Rename a tag on every image in the library, in the background."""
+    return _start_merge_tags([request.old_tag], request.new_tag, request.task_id)
+
+
+def _start_merge_tags(source_tags: list[str], target_tag: str, task_id: str | None) -> TaskResponse:
+    task_id = task_id or f'merge-tags-{uuid.uuid4()}'
+
+    def update(progress_callback):
+        result = tags_wrangler.merge_tags(source_tags, target_tag, progress_callback=progress_callback)
+        # failures are keyed by path, as the images may not all be in the store
+        return result.model_dump()
+    _start_tag_update_task(task_id, f"Merging {', '.join(source_tags)} into {target_tag}", update)
+    return TaskResponse(task_id=task_id, message="Tag merge started. Use WebSocket to receive progress updates.")
+
+
+def _start_tag_update_task(task_id: str, description: str, update):
+    threading.Thread(target=lambda: asyncio.run(perform_tag_update_task(
+        task_id, description, progress_manager=progress_manager, update=update)),
+        name='tag-update', daemon=True).start()
+
+
+def _update_tags_for_ids(image_ids: list[str], add: list[str] = (), remove: list[str] = (),
+                         progress_callback=None) -> dict[str, str]:
+    """Update the tags of the images with `image_ids` on the tag writer pool. Returns the error for each id that failed."""
+    id_for_path = {}
+    failures = {}
+    for image_id in image_ids:
+        path = embedding_store.get_image_path_for_id(image_id)
+        if path is None:
+            failures[image_id] = f"no image with id {image_id}"
+        else:
+            id_for_path[path] = image_id
+    result = tags_wrangler.update_tags(list(id_for_path), add=add, remove=remove, progress_callback=progress_callback)
+    failures.update({id_for_path[path]: error for path, error in result.failures.items()})
+    return failures
 
 
 @app.get("/api/tags/{id}")
@@ -316,10 +433,10 @@ async def handle_reveal_in_finder(id: str):
 
 
 def _build_images_tags(image_ids: list[str]) -> dict[str, list[str]]:
-    return {
-        image_id: tags_wrangler.get_tags(embedding_store.get_image_path_for_id(image_id))
-        for image_id in image_ids
-    }
+    # the tag index already has the tags just written, so this only stats the files
+    image_paths = [embedding_store.get_image_path_for_id(image_id) for image_id in image_ids]
+    tags = tags_wrangler.get_tags_for_images([p for p in image_paths if p is not None])
+    return {image_id: tags.get(path) for image_id, path in zip(image_ids, image_paths)}
 
 @app.get("api/allKnownTags")
 async def serve_all_known_tags():
@@ -327,20 +444,41 @@ async def serve_all_known_tags():
         'all_known_tags': tags_wrangler.get_all_known_tags()
     }
 
+@app.get("/api/thumbnails/stats")
+async def serve_thumbnail_stats():
+    """Thumbnail cache hits, misses, errors, evictions and size in bytes."""
+    return thumbnail_provider.get_stats()
+
+class ThumbnailsRequest(BaseModel):
+    ids: list[str]
+    size: int = 256
+
+@app.post("/api/thumbnails")
+async def serve_thumbnails(request: ThumbnailsRequest):
+    """
+    Thumbnails for a whole page of results in one response, as length-prefixed records in the order of
+    `ids` (see thumbnail_provider.pack_thumbnails). Missing thumbnails are made in parallel.
+    """
+    image_paths = [embedding_store.get_image_path_for_id(id) for id in request.ids]
+    thumbnails = await asyncio.to_thread(thumbnail_provider.get_thumbnails_bytes, image_paths, request.size)
+    return Response(content=pack_thumbnails(request.ids, thumbnails), media_type="application/octet-stream")
+
 @app.get("/api/thumbnail/{id}")
-async def serve_thumbnail(id: str):
+async def serve_thumbnail(id: str, size: int = 512):
+    """`size` is rounded up to the nearest of the provider's size tiers (128/256/512)."""
     original_path = embedding_store.get_image_path_for_id(id)
     if not os.path.isfile(original_path):
         raise HTTPException(status_code=404, detail=f"Image not found: {original_path}")
 
-    thumbnail_path = thumbnail_provider.get_or_create_thumbnail(original_path)
+    # made on the thumbnail pool, so that decoding doesn't block the event loop
+    thumbnail_path = await asyncio.wrap_future(thumbnail_provider.get_or_create_thumbnail_async(original_path, size))
     return FileResponse(thumbnail_path)
 
 @app.get("/api/cleanupMissing")
 async def cleanup_missing_images():
     try:
         embedding_store.cleanup_missing_files()
-        embedding_store.save()
+        embedding_store.schedule_compaction()
     except Exception as e:
         logging.error(f"Error during cleanup: {repr(e)}")
         raise HTTPException(status_code=500, detail=f"Cleanup failed: {str(e)}")
@@ -0,0 +1,247 @@
+"""
+IVF-PQ approximate nearest neighbour index for inner-product search over CLIP embeddings.
+
+A k-means coarse quantizer splits the corpus into `nlist` inverted lists; each vector's residual
+from its list centroid is product-quantized into `m` one-byte codes. A query scores only the
+vectors in its `nprobe` best lists, using q.x ~= q.centroid + sum_j lut[j, code_j], and the best
+candidates are then re-ranked exactly by the caller.
+
+Codes are kept in store row order, so the index follows the store's rows on append and removal;
+the inverted lists are rebuilt lazily from the list assignments when they are next needed.
+
+Build an index for an existing store with:
+    python -m clip_finder_backend.ann_index <store_file>
+This only reads the store's last snapshot and writes the index file next to it, so it can run while
+the server has the store open; the server picks the index up the next time it loads the store.
+"""
+import argparse
+import math
+import os
+import threading
+
+import numpy as np
+import torch
+
+from clip_finder_backend.store_format import is_native_store_file, read_native_store
+
+ANN_INDEX_VERSION = 1
+
+
+def get_ann_index_file(store_file: str) -> str:
+    return f'{store_file}.ivfpq'
+
+
+class IVFPQIndex:
+
+    def __init__(self, centroids: torch.Tensor, codebooks: torch.Tensor,
+                 assignments: torch.Tensor = None, codes: torch.Tensor = None):
+        self.centroids = centroids  # [nlist, d]
+        self.codebooks = codebooks  # [m, ksub, d/m]
+        m = codebooks.shape[0]
+        self.assignments = assignments if assignments is not None else torch.empty([0], dtype=torch.int32)
+        self.codes = codes if codes is not None else torch.empty([0, m], dtype=torch.uint8)
+        self._lists_lock = threading.Lock()
+        self._sorted_rows: torch.Tensor | None = None
+        self._list_offsets: torch.Tensor | None = None
+
+    @property
+    def num_rows(self) -> int:
+        return self.assignments.shape[0]
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def train(embeddings: torch.Tensor, nlist: int = None, m: int = None, iterations: int = 20,
+              max_training_rows: int = 200_000, seed: int = 0) -> 'IVFPQIndex':
+        """
+        Train the coarse quantizer and PQ codebooks on (a sample of) `embeddings`, then add all of them.
+        Defaults: nlist = 4*sqrt(n), m = d/8 (8 dimensions per one-byte code).
+        """
+        num_rows, dim = embeddings.shape
+        if num_rows == 0:
+            raise ValueError("cannot train an ANN index on an empty store")
+        nlist = nlist or max(1, min(num_rows, int(4 * math.sqrt(num_rows))))
+        m = m or max(1, dim // 8)
+        if dim % m != 0:
+            raise ValueError(f"embedding dim {dim} is not divisible by m={m}")
+
+        generator = torch.Generator().manual_seed(seed)
+        sample_rows = torch.randperm(num_rows, generator=generator)[:max_training_rows]
+        sample = embeddings[sample_rows].to('cpu', dtype=torch.float32)
+
+        print(f'training IVF coarse quantizer: {nlist} lists from {sample.shape[0]} vectors')
+        centroids = _kmeans(sample, nlist, iterations, generator)
+        residuals = sample - centroids[_nearest_centroids(sample, centroids)]
+
+        print(f'training PQ codebooks: {m} sub-quantizers')
+        ksub = min(256, sample.shape[0])
+        dsub = dim // m
+        codebooks = torch.stack([_kmeans(residuals[:, j * dsub:(j + 1) * dsub].contiguous(), ksub, iterations, generator)
+                                 for j in range(m)])
+
+        index = IVFPQIndex(centroids=centroids, codebooks=codebooks)
+        index.add(embeddings)
+        return index
+
+    def add(self, embeddings: torch.Tensor, block_size: int = 65536):
+        """Append `embeddings` as the next rows."""
+        new_assignments = []
+        new_codes = []
+        for start in range(0, embeddings.shape[0], block_size):
+            block = embeddings[start:start + block_size].to('cpu', dtype=torch.float32)
+            assignments = _nearest_centroids(block, self.centroids)
+            new_assignments.append(assignments.to(torch.int32))
+            new_codes.append(self._encode(block - self.centroids[assignments]))
+        if not new_assignments:
+            return
+        with self._lists_lock:
+            self.assignments = torch.cat([self.assignments] + new_assignments)
+            self.codes = torch.cat([self.codes] + new_codes)
+            self._sorted_rows = None
+
+    def replace_rows(self, rows: np.ndarray, embeddings: torch.Tensor):
+        """Follow an update in place in the store: `rows` now hold `embeddings`."""
+        block = embeddings.to('cpu', dtype=torch.float32)
+        assignments = _nearest_centroids(block, self.centroids)
+        codes = self._encode(block - self.centroids[assignments])
+        rows = torch.from_numpy(rows)
+        with self._lists_lock:
+            self.assignments = self.assignments.index_put((rows,), assignments.to(torch.int32))
+            self.codes = self.codes.index_put((rows,), codes)
+            self._sorted_rows = None
+
+    def keep_rows(self, keep_indices: np.ndarray):
+        """Follow a row removal in the store: keep only `keep_indices`, renumbered from 0."""
+        keep = torch.from_numpy(keep_indices)
+        with self._lists_lock:
+            self.assignments = self.assignments[keep]
+            self.codes = self.codes[keep]
+            self._sorted_rows = None
+
+    def snapshot(self) -> 'IVFPQIndex':
+        """A copy that later adds and removals don't affect, for saving in the background."""
+        with self._lists_lock:
+            return IVFPQIndex(centroids=self.centroids, codebooks=self.codebooks,
+                              assignments=self.assignments, codes=self.codes)
+
+    def search(self, query: torch.Tensor, nprobe: int, k: int,
+               row_mask: np.ndarray | None = None) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Approximate top-k rows by inner product with `query` ([d]) among the `nprobe` closest lists.
+        Rows where `row_mask` is False are skipped. Returns (rows, approximate scores), best first.
+        """
+        query = query.to('cpu', dtype=torch.float32)
+        sorted_rows, list_offsets = self._get_inverted_lists()
+
+        coarse_scores = self.centroids @ query
+        probe = torch.topk(coarse_scores, min(nprobe, self.nlist)).indices
+        list_starts = list_offsets[probe]
+        list_lengths = list_offsets[probe + 1] - list_starts
+        candidate_rows = torch.cat([sorted_rows[start:start + length]
+                                    for start, length in zip(list_starts.tolist(), list_lengths.tolist())])
+        candidate_lists = torch.repeat_interleave(probe, list_lengths)
+        if row_mask is not None:
+            passes = torch.from_numpy(row_mask)[candidate_rows]
+            candidate_rows = candidate_rows[passes]
+            candidate_lists = candidate_lists[passes]
+        if candidate_rows.shape[0] == 0:
+            return candidate_rows, torch.empty([0])
+
+        m, ksub, dsub = self.codebooks.shape
+        lookup_table = torch.einsum('md,mkd->mk', query.view(m, dsub), self.codebooks)
+        codes = self.codes[candidate_rows].long()
+        approximate_scores = coarse_scores[candidate_lists] + lookup_table[torch.arange(m), codes].sum(dim=1)
+        top = torch.topk(approximate_scores, min(k, approximate_scores.shape[0]))
+        return candidate_rows[top.indices], top.values
+
+    def _encode(self, residuals: torch.Tensor) -> torch.Tensor:
+        m, ksub, dsub = self.codebooks.shape
+        codes = torch.empty([residuals.shape[0], m], dtype=torch.uint8)
+        for j in range(m):
+            codes[:, j] = _nearest_centroids(residuals[:, j * dsub:(j + 1) * dsub], self.codebooks[j]).to(torch.uint8)
+        return codes
+
+    def _get_inverted_lists(self) -> tuple[torch.Tensor, torch.Tensor]:
+        with self._lists_lock:
+            if self._sorted_rows is None:
+                assignments = self.assignments.to(torch.int64)
+                self._sorted_rows = torch.argsort(assignments, stable=True)
+                counts = torch.bincount(assignments, minlength=self.nlist)
+                self._list_offsets = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(counts, dim=0)])
+            return self._sorted_rows, self._list_offsets
+
+    def save(self, path: str, store_generation: str | None):
+        """Write atomically. `store_generation` ties the file to the store snapshot it matches."""
+        tmp_path = f'{path}.tmp'
+        torch.save({
+            'version': ANN_INDEX_VERSION,
+            'store_generation': store_generation,
+            'centroids': self.centroids,
+            'codebooks': self.codebooks,
+            'assignments': self.assignments,
+            'codes': self.codes,
+        }, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str, store_generation: str | None, num_rows: int) -> 'IVFPQIndex | None':
+        """Load the index at `path`, or return None if it does not match the store snapshot."""
+        d = torch.load(path)
+        if d['version'] != ANN_INDEX_VERSION:
+            print(f"ignoring ANN index {path} with unrecognized version {d['version']}")
+            return None
+        if store_generation is None or d['store_generation'] != store_generation or d['assignments'].shape[0] != num_rows:
+            print(f"ignoring ANN index {path}: it doesn't match the store snapshot, please rebuild it")
+            return None
+        return IVFPQIndex(centroids=d['centroids'], codebooks=d['codebooks'],
+                          assignments=d['assignments'], codes=d['codes'])
+
+
+def _nearest_centroids(x: torch.Tensor, centroids: torch.Tensor, block_size: int = 65536) -> torch.Tensor:
+    centroid_norms = (centroids * centroids).sum(dim=1)
+    nearest = []
+    for start in range(0, x.shape[0], block_size):
+        # argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c
+        distances = centroid_norms - 2 * (x[start:start + block_size] @ centroids.T)
+        nearest.append(distances.argmin(dim=1))
+    return torch.cat(nearest) if nearest else torch.empty([0], dtype=torch.int64)
+
+
+def _kmeans(x: torch.Tensor, k: int, iterations: int, generator: torch.Generator) -> torch.Tensor:
+    num_rows = x.shape[0]
+    centroids = x[torch.randperm(num_rows, generator=generator)[:k]].clone()
+    for _ in range(iterations):
+        assignments = _nearest_centroids(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=k)
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        empty = torch.nonzero(counts == 0).squeeze(1)
+        if empty.shape[0] > 0:
+            # re-seed empty clusters from random points
+            centroids[empty] = x[torch.randint(num_rows, (empty.shape[0],), generator=generator)]
+    return centroids
+
+
+def build_ann_index_file(store_file: str, nlist: int = None, m: int = None) -> IVFPQIndex:
+    """
+    Train an index over the rows of the snapshot at `store_file` and save it next to it, tied to that
+    snapshot. Mutations logged since the snapshot are left out: the store applies them to the index
+    when it loads both, just as it does to its rows.
+    """
+    if not is_native_store_file(store_file):
+        raise ValueError(f"{store_file} is not in the native store format yet, load it with the server once to convert it")
+    snapshot = read_native_store(store_file, mmap=True)
+    index = IVFPQIndex.train(snapshot['image_embeddings'], nlist=nlist, m=m)
+    index.save(get_ann_index_file(store_file), snapshot['generation'])
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the IVF-PQ index for an embedding store")
+    parser.add_argument('store_file')
+    parser.add_argument('--nlist', type=int, default=None, help="number of inverted lists (default 4*sqrt(n))")
+    parser.add_argument('--m', type=int, default=None, help="number of PQ sub-quantizers (default embedding_dim/8)")
+    args = parser.parse_args()
+    build_ann_index_file(args.store_file, nlist=args.nlist, m=args.m)
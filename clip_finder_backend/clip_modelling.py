@@ -1,6 +1,9 @@
 
 
-from typing import List, Generator
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Generator, Iterable, Callable
 
 from PIL import Image
 import torch
@@ -15,6 +18,8 @@ from tqdm.auto import tqdm
 
 logger = logging.getLogger(__name__)
 
+_NO_MORE_IMAGES = object()
+
 class AutoloadingClipModel:
 
     def __init__(self, load_model):
@@ -41,10 +46,18 @@ class ClipModel:
                  pretrained='datacompdr',
                  device='mps',
                  weights_pt_path=None,
-                 embedding_dim=None
+                 embedding_dim=None,
+                 decode_workers: int=None,
+                 prefetch_images: int=None
                  ):
-        """Initialize the MobileCLIP model."""
+        """
+        Initialize the MobileCLIP model.
+        `decode_workers` threads (default: one per cpu core) decode and preprocess images for get_image_features_batched,
+        keeping up to `prefetch_images` (default: 4 batches) ready ahead of the model.
+        """
         self.model = None
+        self.decode_workers = decode_workers
+        self.prefetch_images = prefetch_images
         self.clip_name = clip_name
         self.clip_pretrained = pretrained
         self.clip_weights_pt_path = weights_pt_path
@@ -94,11 +107,21 @@ class ClipModel:
 
 
     def get_image_features(self, image: str|Image.Image) -> torch.Tensor:
-        i, e = next(self.get_image_features_batched([image]))
-        return e.unsqueeze(0)
+        for i, e in self.get_image_features_batched([image], show_pbar=False):
+            return e.unsqueeze(0)
+        raise RuntimeError(f"Couldn't load image from {image}")
 
 
-    def get_image_features_batched(self, images: List[str|Image.Image], batch_size: int=10, show_pbar=True) -> Generator[tuple[str|Image.Image, torch.Tensor], None, None]:
+    def get_image_features_batched(self, images: List[str|Image.Image], batch_size: int=10, show_pbar=True,
+                                   decode_workers: int=None, prefetch_images: int=None,
+                                   on_image_decoded: Callable[[str, Image.Image], None]=None
+                                   ) -> Generator[tuple[str|Image.Image, torch.Tensor], None, None]:
+        """
+        Yield (image, embedding) for every image that could be loaded; images that fail to decode are skipped.
+        Images are decoded and preprocessed on a thread pool while the previous batch is being encoded.
+        `on_image_decoded(path, image)` is called on that pool with each decoded, upright RGB image (e.g. to
+        write thumbnails without decoding the file again). It must not modify the image.
+        """
         if type(images) is not list:
             raise ValueError(f"images must be a list, got {type(images)}")
         types = set([type(i) for i in images])
@@ -106,45 +129,84 @@ class ClipModel:
             raise ValueError(f"images must be a list of str or PIL.Image, got {types}")
         if self.model is None:
             self.load_model()
-        image_chunks = [images[i:i+batch_size]
-                        for i in range(0, len(images), batch_size)]
-        with tqdm(total=len(image_chunks), disable=not show_pbar, desc="computing CLIP embeddings") as pbar:
-            for chunk_input in image_chunks:
-                chunk_preprocessed = list(self._preprocess_images(chunk_input))
-                # we may have to drop images during preprocessing - so chunk_images may be different from input
-                chunk_images = [p[0] for p in chunk_preprocessed]
-                chunk_features = torch.stack([p[1] for p in chunk_preprocessed])
-                with torch.no_grad():
-                    image_features = self.model.encode_image(chunk_features, normalize=True)
-                    image_features /= image_features.norm(dim=-1, keepdim=True)
-                    pbar.update(len(chunk_input))
-                    for i in range(image_features.shape[0]):
-                        yield chunk_images[i], image_features[i]
-
-
-    def _preprocess_images(self, images: List[str|Image.Image]) -> Generator[tuple[str|Image.Image, torch.Tensor], None, None]:
-        for path_or_img in images:
-            img = None
-            img_needs_close = False
-            try:
-                if type(path_or_img) is list:
-                    raise RuntimeError("list of lists passed to _preprocess_images")
-                if type(path_or_img) is str:
-                    img = Image.open(path_or_img)
-                    img_needs_close = True
-                else:
-                    img = path_or_img
-                if not img:
-                    raise RuntimeError(f"Couldn't load image from {path_or_img}")
-                yield path_or_img, self.preprocess(ImageOps.exif_transpose(
-                    img.convert('RGB')
-                )).to(self.device)
-            except Exception as e:
-                print("caught exception:", e, "loading image from ", path_or_img)
-                raise
-            finally:
-                if img_needs_close:
-                    img.close()
+        decode_workers = decode_workers or self.decode_workers or os.cpu_count()
+        prefetch_images = prefetch_images or self.prefetch_images or 4 * batch_size
+        with tqdm(total=len(images), disable=not show_pbar, desc="computing CLIP embeddings") as pbar:
+            batch = []
+            num_consumed = 0
+            for image, preprocessed in self._preprocess_images_ahead(images, decode_workers, prefetch_images, on_image_decoded):
+                num_consumed += 1
+                # we may have to drop images during preprocessing - so the batch may be smaller than its input
+                if preprocessed is not None:
+                    batch.append((image, preprocessed))
+                if len(batch) == batch_size:
+                    yield from self._encode_image_batch(batch)
+                    pbar.update(num_consumed)
+                    batch = []
+                    num_consumed = 0
+            if batch:
+                yield from self._encode_image_batch(batch)
+            pbar.update(num_consumed)
+
+
+    def _encode_image_batch(self, batch: list[tuple[str|Image.Image, torch.Tensor]]) -> Generator[tuple[str|Image.Image, torch.Tensor], None, None]:
+        chunk_features = torch.stack([p[1] for p in batch]).to(self.device)
+        with torch.no_grad():
+            image_features = self.model.encode_image(chunk_features, normalize=True)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+        for (image, _), features in zip(batch, image_features):
+            yield image, features
+
+
+    def _preprocess_images_ahead(self, images: Iterable[str|Image.Image], workers: int, prefetch_images: int,
+                                 on_image_decoded: Callable[[str, Image.Image], None]=None
+                                 ) -> Generator[tuple[str|Image.Image, torch.Tensor|None], None, None]:
+        """Yield (image, preprocessed tensor or None if it failed) in order, preprocessing up to `prefetch_images` ahead."""
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='clip-preprocess')
+        try:
+            remaining = iter(images)
+            pending = deque()
+            for image in remaining:
+                pending.append((image, executor.submit(self._preprocess_image, image, on_image_decoded)))
+                if len(pending) >= prefetch_images:
+                    break
+            while pending:
+                image, future = pending.popleft()
+                next_image = next(remaining, _NO_MORE_IMAGES)
+                if next_image is not _NO_MORE_IMAGES:
+                    pending.append((next_image, executor.submit(self._preprocess_image, next_image, on_image_decoded)))
+                yield image, future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def _preprocess_image(self, path_or_img: str|Image.Image,
+                          on_image_decoded: Callable[[str, Image.Image], None]=None) -> torch.Tensor|None:
+        img = None
+        img_needs_close = False
+        try:
+            if type(path_or_img) is list:
+                raise RuntimeError("list of lists passed to _preprocess_image")
+            if type(path_or_img) is str:
+                img = Image.open(path_or_img)
+                img_needs_close = True
+            else:
+                img = path_or_img
+            if not img:
+                raise RuntimeError(f"Couldn't load image from {path_or_img}")
+            decoded = ImageOps.exif_transpose(img.convert('RGB'))
+            if on_image_decoded is not None and type(path_or_img) is str:
+                try:
+                    on_image_decoded(path_or_img, decoded)
+                except Exception as e:
+                    print("caught exception:", e, "in on_image_decoded for", path_or_img)
+            return self.preprocess(decoded)
+        except Exception as e:
+            print("caught exception:", e, "loading image from ", path_or_img, "(skipping it)")
+            return None
+        finally:
+            if img_needs_close and img is not None:
+                img.close()
 
 
     def get_text_features(self, text: str|list[str]) -> torch.Tensor:
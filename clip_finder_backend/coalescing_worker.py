@@ -0,0 +1,36 @@
+import threading
+from typing import Callable
+
+
+class CoalescingWorker:
+    """
+    Runs `work` on a daemon thread whenever requested. Requests that arrive while it is running are
+    coalesced into one follow-up run.
+    """
+
+    def __init__(self, work: Callable[[], None], name: str):
+        self._work = work
+        self._name = name
+        self._requested = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def request(self):
+        self._idle.clear()
+        self._requested.set()
+
+    def wait_until_idle(self, timeout: float | None = None) -> bool:
+        return self._idle.wait(timeout)
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            try:
+                self._work()
+            except Exception as e:
+                print(f'Caught exception in {self._name} (will retry on the next request): {repr(e)}')
+            if not self._requested.is_set():
+                self._idle.set()
@@ -0,0 +1,48 @@
+"""
+Content hashes of image files, used to recognise a file that was moved, renamed or copied so that
+its embedding can be reused instead of running the model on it again.
+
+Files are read in chunks rather than all at once, and many files are hashed in parallel on a thread
+pool (hashlib and xxhash release the GIL while digesting). 'md5' digests are plain hex, like the
+hashes older versions stored. 'xxh3' is much faster but needs the optional `xxhash` package; its
+digests are prefixed with 'xxh3:' so the two kinds never compare equal.
+"""
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+
+from tqdm.auto import tqdm
+
+HashAlgorithm = Literal['md5', 'xxh3']
+
+
+def compute_content_hash(path: str, algorithm: HashAlgorithm = 'md5', chunk_size: int = 1024 * 1024) -> str:
+    """Hash the file at `path`. Returns '' if it can't be read."""
+    if algorithm == 'md5':
+        digest = hashlib.md5()
+        prefix = ''
+    elif algorithm == 'xxh3':
+        import xxhash
+        digest = xxhash.xxh3_128()
+        prefix = 'xxh3:'
+    else:
+        raise ValueError(f"unsupported hash algorithm: {algorithm}")
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+    except OSError:
+        return ''
+    return prefix + digest.hexdigest()
+
+
+def compute_content_hashes(paths: list[str], algorithm: HashAlgorithm = 'md5', workers: int = None,
+                           show_pbar: bool = False, desc: str = 'Hashing images') -> list[str]:
+    """compute_content_hash for each of `paths`, in order, using `workers` threads."""
+    if len(paths) <= 1:
+        return [compute_content_hash(p, algorithm) for p in paths]
+    workers = workers or min(16, 2 * os.cpu_count())
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher') as executor:
+        hashes = executor.map(lambda p: compute_content_hash(p, algorithm), paths)
+        return list(tqdm(hashes, total=len(paths), desc=desc, disable=not show_pbar))
@@ -1,17 +1,37 @@
 import hashlib
+import heapq
+import itertools
 import os
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Protocol, List, Literal, Callable, Optional
 
-import PIL
+import numpy as np
 import torch
-from PIL import Image
 from tqdm.auto import tqdm
 from pydantic import BaseModel, ConfigDict
 
+from clip_finder_backend.ann_index import IVFPQIndex, get_ann_index_file
 from clip_finder_backend.clip_modelling import ClipModel
+from clip_finder_backend.content_hash import HashAlgorithm, compute_content_hashes
+from clip_finder_backend.filtering import RowFilter, get_included_rows
+from clip_finder_backend.ingestion_checkpoint import IngestionCheckpoint
+from clip_finder_backend.coalescing_worker import CoalescingWorker
+from clip_finder_backend.mutation_log import MutationLog
+from clip_finder_backend.quantization import QuantizationSettings, QuantizedEmbeddings
+from clip_finder_backend.result_cache import ResultOrderCache, SearchOrdering
+from clip_finder_backend import scanner
+from clip_finder_backend.tag_index import TagIndex
+from clip_finder_backend.text_embedding_cache import TextEmbeddingCache
+from clip_finder_backend.thumbnail_provider import ThumbnailProvider
+from clip_finder_backend.types import ResultFilters
+from clip_finder_backend.store_format import is_native_store_file, read_native_store, write_native_store, \
+    remove_orphaned_sidecars, read_native_store_image_embeddings, NATIVE_STORE_VERSION
 from clip_finder_backend.util import minimum_cost_path_coverage
+from clip_finder_backend.weaviate_chunks import find_chunk_files, read_chunks, iter_shards, get_native_shard_files, \
+    convert_to_native_shards
 
 
 class Query(BaseModel):
@@ -28,14 +48,28 @@ class Query(BaseModel):
     excluded_path_contains: str = None
     required_image_ids: List[str] | None = None
     excluded_image_ids: List[str] | None = None
+    """Only images with all of these tags"""
+    required_tags_and: List[str] | None = None
+    """Only images with at least one of these tags"""
+    required_tags_or: List[str] | None = None
+    excluded_tags: List[str] | None = None
 
     # Pagination parameters
     offset: int = 0
     limit: int = 100
+    """Returned with each page of results; pass it back when fetching further pages of the same query"""
+    cursor: str | None = None
     sort_order: Literal['similarity', 'similarity_asc', 
                         'similarity_max', 'similarity_max_asc', 
                         'similarity_avg', 'similarity_avg_asc',
                         'direction', 'direction_rev', 'semantic_page'] = 'similarity'
+    """
+    Use the store's ANN index (if it has one) for the similarity, similarity_max and similarity_avg orders,
+    probing this many inverted lists. More lists give better recall but slower searches. None searches exactly.
+    """
+    ann_nprobe: int | None = None
+    """With ann_nprobe: how many approximate candidates are re-ranked exactly. This also caps the number of results."""
+    ann_candidates: int = 1000
 
     @staticmethod
     def text_query(text: str):
@@ -51,6 +85,20 @@ class Query(BaseModel):
     def vector_query(embedding: list[float]):
         return Query(texts=[], weights=[1], image_ids=[], embeddings=[embedding])
 
+    def cache_key(self) -> str:
+        """Identifies the result order of this query, independent of which page is requested."""
+        normalized = self.model_dump_json(exclude={'offset', 'limit', 'cursor'})
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def to_row_filter(self) -> RowFilter:
+        return RowFilter(path_contains_any=(self.required_path_contains,) if self.required_path_contains else (),
+                         path_contains_none=(self.excluded_path_contains,) if self.excluded_path_contains else (),
+                         required_image_ids=tuple(self.required_image_ids) if self.required_image_ids else None,
+                         excluded_image_ids=tuple(self.excluded_image_ids or ()),
+                         tags_any=tuple(self.required_tags_or or ()),
+                         tags_all=tuple(self.required_tags_and or ()),
+                         tags_none=tuple(self.excluded_tags or ()))
+
 
 @dataclass
 class QueryResult:
@@ -66,33 +114,47 @@ class EmbeddingStore(Protocol):
     def get_image_embedding(self, path: str) -> torch.Tensor:
         ...
 
+    def get_filtered_images(self, filters: ResultFilters) -> tuple[list[str], list[str], torch.Tensor]:
+        """The ids, paths and embeddings of the images that pass `filters`."""
+        ...
+
     def get_text_embedding(self, text: str) -> torch.Tensor:
         ...
 
+    def get_text_embeddings(self, texts: list[str]) -> torch.Tensor:
+        ...
+
     def search_images(self, query: Query, progress_callback: Optional[Callable[[float, str], None]]=None,
                       return_total_available: bool=False) -> tuple[list[QueryResult], int]|list[QueryResult]:
         ...
 
+    def get_search_cursor(self, query: Query) -> str:
+        ...
+
     def has_image(self, path: str) -> bool:
         ...
 
     def add_images(self, paths: list[str]) -> torch.Tensor:
         ...
 
-    def add_images_recursively(self, root_dir: str) -> int:
-        images_to_add = []
-        for directory, _, files in os.walk(root_dir):
-            for f in files:
-                path = os.path.join(directory, f)
-                if self.has_image(path):
-                    continue
-                try:
-                    _ = Image.open(path)
-                    images_to_add.append(os.path.abspath(path))
-                except PIL.UnidentifiedImageError:
-                    continue
-        self.add_images(images_to_add)
-        return len(images_to_add)
+    def update_images(self, paths: list[str], **kwargs) -> list[str]:
+        ...
+
+    def attach_tag_index(self, tag_index: TagIndex, ensure_current: Callable[[], None] = None):
+        ...
+
+    def add_rows_listener(self, listener: Callable[[list[str], list[str]], None]):
+        ...
+
+    def add_images_recursively(self, root_dir: str, **kwargs) -> int:
+        """See scanner.add_images_recursively for the keyword arguments."""
+        return scanner.add_images_recursively(self, root_dir, **kwargs)
+
+    def has_pending_ingestion(self) -> bool:
+        return False
+
+    def resume_ingestion(self, progress_callback: Optional[Callable[[float, str], None]] = None) -> int:
+        return 0
 
     def get_image_path_for_id(self, id: str) -> str:
         ...
@@ -105,31 +167,102 @@ class ReadOnlyException(Exception):
     pass
 
 class SimpleClipEmbeddingStore(EmbeddingStore):
-    def __init__(self, clip_model: ClipModel, store_file: str = None, store_file_identifier = None, store_device='cpu', ignore_identifier_mismatch=False, bare_mode=False, readonly=False):
+    def __init__(self, clip_model: ClipModel, store_file: str = None, store_file_identifier = None, store_device='cpu', ignore_identifier_mismatch=False, bare_mode=False, readonly=False,
+                 compact_after_log_bytes: int = 64 * 1024 * 1024, result_cache_bytes: int = 256 * 1024 * 1024,
+                 text_embedding_cache: TextEmbeddingCache = None, quantization: QuantizationSettings = None,
+                 hash_algorithm: HashAlgorithm = 'md5'):
+        """
+        Mutations are appended to a log next to `store_file` (see mutation_log.py) and folded into a new
+        snapshot by a background thread once the log grows beyond `compact_after_log_bytes`.
+        Text embeddings come from `text_embedding_cache`; if none is given, the store keeps its own next
+        to `store_file`.
+        With `quantization`, searches scan a float16 or int8 copy of the image embeddings on `store_device`
+        (see quantization.py) and the full precision embeddings stay memory-mapped on the cpu.
+        New images are hashed with `hash_algorithm` (see content_hash.py), and an image whose content is
+        already in the store reuses that embedding instead of running the model.
+        """
         self.store_file = store_file
         self.clip_model = clip_model
         self.store_device = store_device
         self.readonly = readonly
+        self.hash_algorithm = hash_algorithm
+        self.compact_after_log_bytes = compact_after_log_bytes
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._log: MutationLog|None = None
+        self._compactor: CoalescingWorker|None = None
+        self._needs_compaction = False
+        # set when loading gave the images new ids, which must be logged before any mutation refers to them
+        self._image_ids_regenerated = False
+        # whether the snapshot on disk has every mutation applied so far, so the ANN index can be saved alone
+        self._snapshot_is_current = False
+        # counts removals and in-place replacements of rows, which move or change existing embeddings
+        self._rows_changed_generation = 0
+        # counts recorded mutations, so that compaction can tell whether any arrived while it was writing
+        self._num_recorded_mutations = 0
+        self._path_to_row: dict[str, int] = {}
+        self._id_to_row: dict[str, int] = {}
+        self._hash_to_row: dict[str, int] = {}
+        self._path_contains_masks: dict[str, np.ndarray] = {}
+        self.tag_index: TagIndex|None = None
+        self._ensure_tag_index_current: Callable[[], None]|None = None
+        self._tag_masks: dict[str, np.ndarray] = {}
+        self._tag_masks_generation = -1
+        self._tag_index_rows: tuple[np.ndarray, int]|None = None
+        self._result_cache = ResultOrderCache(max_bytes=result_cache_bytes)
+        self._snapshot_generation: str|None = None
+        self.ann_index: IVFPQIndex|None = None
+        self.quantization = quantization
+        self._quantized: QuantizedEmbeddings|None = None
+        self._rows_listeners: list[Callable[[list[str], list[str]], None]] = []
         if store_file_identifier is not None:
             self.store_file_identifier = store_file_identifier
         else:
             self.store_file_identifier = clip_model.distinct_identifier
+        self.text_embedding_cache = text_embedding_cache
         if bare_mode:
             assert clip_model is None
             assert store_file is None
             self.bare_mode = True
         else:
             self.bare_mode = False
+            if self.text_embedding_cache is None:
+                self.text_embedding_cache = TextEmbeddingCache(
+                    clip_model,
+                    cache_file=None if store_file is None else f'{store_file}.text_embeddings',
+                    identifier=self.store_file_identifier)
+            first_log_segment = 0
             if store_file is not None and os.path.exists(store_file):
-                self._load_from_store(ignore_identifier_mismatch=ignore_identifier_mismatch)
-                print('loaded', len(self.image_paths), 'image embeddings from', store_file)
+                first_log_segment = self._load_from_store(ignore_identifier_mismatch=ignore_identifier_mismatch)
+                self._snapshot_is_current = True
             else:
-                self.text_embeddings = torch.empty([0, clip_model.embedding_dim]).to(self.store_device)
-                self.texts: List[str] = []
-                self.image_embeddings = torch.empty([0, clip_model.embedding_dim]).to(self.store_device)
+                self.image_embeddings = torch.empty([0, clip_model.embedding_dim]).to(self._full_precision_device)
                 self.image_paths: List[str] = []
                 self.image_ids: List[str] = []
                 self.image_hashes: List[str] = []
+            self._rebuild_row_indexes()
+            if quantization is not None:
+                self._quantized = QuantizedEmbeddings.from_embeddings(self.image_embeddings, quantization, device=store_device)
+            if store_file is not None:
+                if os.path.exists(self.ann_index_file):
+                    self.ann_index = IVFPQIndex.load(self.ann_index_file, self._snapshot_generation, len(self.image_paths))
+                self._log = MutationLog(store_file)
+                self._replay_mutation_log(first_log_segment)
+                print('loaded', len(self.image_paths), 'image embeddings from', store_file)
+                self._start_persistence()
+
+    @property
+    def _full_precision_device(self):
+        return 'cpu' if self.quantization is not None else self.store_device
+
+    def set_embedding_quantization(self, quantization: QuantizationSettings | None):
+        """Switch to (or, with None, away from) searching a quantized copy of the image embeddings."""
+        with self._lock:
+            self.quantization = quantization
+            self.image_embeddings = self.image_embeddings.to(self._full_precision_device)
+            self._quantized = None if quantization is None else \
+                QuantizedEmbeddings.from_embeddings(self.image_embeddings, quantization, device=self.store_device)
+            self._invalidate_derived_state()
 
     @property
     def is_readonly(self) -> bool:
@@ -141,17 +274,314 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
         if readonly is True, the store will not compute hashes for images, and will not be able to add new images.
         """
         assert self.bare_mode
-        self.text_embeddings = torch.empty([0, clip_model.embedding_dim]).to(self.store_device)
-        self.texts = []
-        self.image_ids = str(uuid.uuid4() for _ in range(len(self.image_paths)))
+        self.clip_model = clip_model
+        if store_file_identifier is not None:
+            self.store_file_identifier = store_file_identifier
+        if self.text_embedding_cache is None:
+            self.text_embedding_cache = TextEmbeddingCache(clip_model, cache_file=f'{store_file}.text_embeddings',
+                                                           identifier=self.store_file_identifier)
+        self.image_ids = [str(uuid.uuid4()) for _ in range(len(self.image_paths))]
         if readonly:
             self.image_hashes = []
         else:
-            self.image_hashes = [_compute_md5_hash(p) if os.path.exists(p) else 0
-                                 for p in tqdm(self.image_paths, desc='Computing md5 hashes for images')
-                                 ]
+            self.image_hashes = compute_content_hashes(self.image_paths, self.hash_algorithm, show_pbar=True,
+                                                       desc='Computing hashes for images')
+        self._rebuild_row_indexes()
         self.store_file = store_file
         self.bare_mode = False
+        self._log = MutationLog(store_file)
+        self._start_persistence()
+        if self._compactor is not None:
+            # there is no snapshot yet that logged mutations could be replayed onto, so write one before accepting any
+            self._compact()
+
+    def _start_persistence(self):
+        if self.store_file is None or self.is_readonly:
+            return
+        remove_orphaned_sidecars(self.store_file)
+        self._log.start_new_segment()
+        self._compactor = CoalescingWorker(self._compact, name=f'compactor {os.path.basename(self.store_file)}')
+        if self._image_ids_regenerated:
+            # otherwise a restart before the next snapshot would generate other ids, and the logged
+            # mutations that refer to these would no longer match any image
+            self._record_mutation('set_image_ids', ids=list(self.image_ids))
+            self._image_ids_regenerated = False
+        if self._needs_compaction:
+            self._compactor.request()
+
+    def _replay_mutation_log(self, first_segment: int):
+        num_replayed = 0
+        for kind, payload in self._log.replay(first_segment):
+            self._apply_mutation(kind, payload)
+            num_replayed += 1
+        if num_replayed > 0:
+            print(f'replayed {num_replayed} logged mutations for {self.store_file}')
+            self._needs_compaction = True
+            self._snapshot_is_current = False
+
+    def _record_mutation(self, kind: str, **payload):
+        """Apply a mutation and, if this store is persisted, append it to the mutation log."""
+        with self._lock:
+            self._apply_mutation(kind, payload)
+            self._snapshot_is_current = False
+            self._num_recorded_mutations += 1
+            if self._compactor is not None:
+                self._log.append(kind, payload)
+                if self._log.bytes_written > self.compact_after_log_bytes:
+                    self._compactor.request()
+
+    def _apply_mutation(self, kind: str, payload: dict):
+        if kind == 'add_texts':
+            # written by older versions, before text embeddings moved to TextEmbeddingCache
+            self.text_embedding_cache.add(payload['texts'], torch.from_numpy(payload['embeddings']))
+            self._needs_compaction = True
+        elif kind == 'add_images':
+            embeddings = torch.from_numpy(payload['embeddings']).to(self.image_embeddings.device, dtype=self.image_embeddings.dtype)
+            first_row = len(self.image_paths)
+            self.image_embeddings = torch.cat([self.image_embeddings, embeddings])
+            if self.ann_index is not None:
+                self.ann_index.add(embeddings)
+            if self._quantized is not None:
+                self._quantized.add(embeddings)
+            self.image_paths.extend(payload['paths'])
+            self.image_ids.extend(payload['ids'])
+            self.image_hashes.extend(payload['hashes'])
+            self._path_to_row.update(zip(payload['paths'], range(first_row, len(self.image_paths))))
+            self._id_to_row.update(zip(payload['ids'], range(first_row, len(self.image_ids))))
+            self._add_hash_rows(first_row)
+            assert len(self.image_paths) == len(self.image_hashes)
+            assert len(self.image_ids) == len(self.image_hashes)
+            assert self.image_embeddings.shape[0] == len(self.image_paths)
+            for listener in self._rows_listeners:
+                listener(payload['paths'], payload['ids'])
+        elif kind == 'remove_images':
+            rows_to_remove = self.get_rows_for_ids(payload['ids'])
+            keep = np.ones(len(self.image_paths), dtype=bool)
+            keep[rows_to_remove[rows_to_remove >= 0]] = False
+            self._keep_rows(np.flatnonzero(keep))
+        elif kind == 'move_images':
+            # the files' content is unchanged, so they keep their rows, ids and embeddings
+            for image_id, path in zip(payload['ids'], payload['paths']):
+                row = self._id_to_row[image_id]
+                del self._path_to_row[self.image_paths[row]]
+                self.image_paths[row] = path
+                self._path_to_row[path] = row
+            for listener in self._rows_listeners:
+                listener(payload['paths'], payload['ids'])
+        elif kind == 'replace_embeddings':
+            # the files' content changed: they keep their rows, ids and paths
+            rows = self.get_rows_for_ids(payload['ids'])
+            found = rows >= 0
+            rows = rows[found]
+            embeddings = torch.from_numpy(payload['embeddings'][found]).to(self.image_embeddings.device, dtype=self.image_embeddings.dtype)
+            self.image_embeddings = self.image_embeddings.index_put((torch.from_numpy(rows).to(self.image_embeddings.device),), embeddings)
+            if self.ann_index is not None:
+                self.ann_index.replace_rows(rows, embeddings)
+            if self._quantized is not None:
+                self._quantized.replace_rows(rows, embeddings)
+            for row, image_hash in zip(rows.tolist(), itertools.compress(payload['hashes'], found)):
+                self.image_hashes[row] = image_hash
+            self._rows_changed_generation += 1
+            # a replaced row may have been the first with its old hash
+            self._hash_to_row = {}
+            self._add_hash_rows(0)
+        elif kind == 'set_image_ids':
+            if len(payload['ids']) != len(self.image_paths):
+                raise RuntimeError(f"set_image_ids: got {len(payload['ids'])} ids for {len(self.image_paths)} images")
+            self.image_ids = list(payload['ids'])
+            self._rebuild_row_indexes()
+            for listener in self._rows_listeners:
+                listener(self.image_paths, self.image_ids)
+        else:
+            raise RuntimeError(f"unrecognized mutation kind: {kind}")
+        if kind != 'add_texts':
+            self._invalidate_derived_state()
+
+    def add_rows_listener(self, listener: Callable[[list[str], list[str]], None]):
+        """`listener(paths, ids)` is called whenever rows are added, moved or get new ids. Removals are not reported."""
+        self._rows_listeners.append(listener)
+
+    def _invalidate_derived_state(self):
+        """Drop everything computed from the current rows. Called after every mutation."""
+        self._path_contains_masks = {}
+        self._tag_masks = {}
+        self._tag_index_rows = None
+        self._result_cache.invalidate()
+
+    def _keep_rows(self, keep_indices: np.ndarray):
+        if len(keep_indices) == len(self.image_paths):
+            return
+        self._rows_changed_generation += 1
+        # rows before the first removed one don't move, so only the tail of the indexes needs updating
+        moved_rows = np.flatnonzero(keep_indices != np.arange(len(keep_indices)))
+        first_changed_row = int(moved_rows[0]) if len(moved_rows) else len(keep_indices)
+        for path in self.image_paths[first_changed_row:]:
+            self._path_to_row.pop(path, None)
+        for image_id in self.image_ids[first_changed_row:]:
+            self._id_to_row.pop(image_id, None)
+        for image_hash in self.image_hashes[first_changed_row:]:
+            if self._hash_to_row.get(image_hash, -1) >= first_changed_row:
+                del self._hash_to_row[image_hash]
+
+        self.image_paths = [self.image_paths[i] for i in keep_indices]
+        self.image_embeddings = self.image_embeddings[torch.from_numpy(keep_indices).to(self.image_embeddings.device)]
+        if self.ann_index is not None:
+            self.ann_index.keep_rows(keep_indices)
+        if self._quantized is not None:
+            self._quantized.keep_rows(keep_indices)
+        if self.image_hashes:
+            self.image_hashes = [self.image_hashes[i] for i in keep_indices]
+        if self.image_ids:
+            self.image_ids = [self.image_ids[i] for i in keep_indices]
+
+        self._path_to_row.update(zip(self.image_paths[first_changed_row:], range(first_changed_row, len(self.image_paths))))
+        self._id_to_row.update(zip(self.image_ids[first_changed_row:], range(first_changed_row, len(self.image_ids))))
+        self._add_hash_rows(first_changed_row)
+        if len(self._path_to_row) != len(self.image_paths) or len(self._id_to_row) != len(self.image_ids):
+            # a path or id that is in several rows may also be before first_changed_row, where it wasn't re-added
+            self._rebuild_row_indexes()
+
+    def _rebuild_row_indexes(self):
+        """Rebuild the path->row, id->row and hash->row lookups. Needed whenever the columns are replaced wholesale."""
+        self._path_to_row = dict(zip(self.image_paths, range(len(self.image_paths))))
+        self._id_to_row = dict(zip(self.image_ids, range(len(self.image_ids))))
+        self._hash_to_row = {}
+        self._add_hash_rows(0)
+        self._invalidate_derived_state()
+
+    def _add_hash_rows(self, first_row: int):
+        """Index the hashes of the rows from `first_row` on. A hash shared by several rows maps to the first of them."""
+        for row in range(first_row, len(self.image_hashes)):
+            image_hash = self.image_hashes[row]
+            if image_hash:
+                self._hash_to_row.setdefault(image_hash, row)
+
+    def get_rows_for_ids(self, image_ids: list[str]) -> np.ndarray:
+        """Row index for each id, or -1 if the id is unknown."""
+        return np.fromiter((self._id_to_row.get(i, -1) for i in image_ids), dtype=np.int64, count=len(image_ids))
+
+    def get_path_contains_mask(self, fragment: str, max_cached_masks: int = 32) -> np.ndarray:
+        """Boolean mask of the rows whose path contains `fragment`, cached until the next mutation."""
+        masks = self._path_contains_masks
+        mask = masks.get(fragment)
+        if mask is None:
+            mask = np.fromiter((fragment in p for p in self.image_paths), dtype=bool, count=len(self.image_paths))
+            if len(masks) >= max_cached_masks:
+                masks.pop(next(iter(masks)))
+            masks[fragment] = mask
+        return mask
+
+    def attach_tag_index(self, tag_index: TagIndex, ensure_current: Callable[[], None] = None):
+        """
+        Answer the tag predicates of queries and filters from `tag_index`. `ensure_current`, if given, is
+        called before tag predicates are evaluated and returns once the index is up to date, e.g.
+        TagsWrangler.ensure_index_refreshed, which waits for the startup refresh.
+        """
+        self.tag_index = tag_index
+        self._ensure_tag_index_current = ensure_current
+        self._invalidate_derived_state()
+
+    def get_tag_mask(self, tag: str) -> np.ndarray:
+        """
+        Boolean mask of the rows whose image has `tag`, cached until the next mutation of the store or
+        change of the tag index.
+        """
+        if self.tag_index is None:
+            raise RuntimeError("this store has no tag index to evaluate tag predicates with, see attach_tag_index")
+        if self._ensure_tag_index_current is not None:
+            self._ensure_tag_index_current()
+        generation = self.tag_index.generation
+        if generation != self._tag_masks_generation:
+            self._tag_masks = {}
+            self._tag_masks_generation = generation
+        mask = self._tag_masks.get(tag)
+        while mask is None:
+            if self._tag_index_rows is None:
+                self._tag_index_rows = self.tag_index.get_rows_for_paths(self.image_paths)
+            mask = self.tag_index.get_tag_mask(tag, *self._tag_index_rows)
+            if mask is None:
+                # the index moved its rows around since they were looked up
+                self._tag_index_rows = None
+        self._tag_masks[tag] = mask
+        return mask
+
+    def get_rows_for_paths(self, paths: list[str]) -> np.ndarray:
+        """Row index for each path, or -1 if the path is not in the store."""
+        return np.fromiter((self._path_to_row.get(p, -1) for p in paths), dtype=np.int64, count=len(paths))
+
+    def schedule_compaction(self):
+        """Fold the mutation log into a new snapshot on the background thread."""
+        if self._compactor is not None:
+            self._compactor.request()
+
+    def _compact(self):
+        with self._compaction_lock:
+            with self._lock:
+                # tensors are always replaced rather than modified in place, so holding references is enough
+                columns = self._get_columns_for_saving()
+                ann_index = None if self.ann_index is None else self.ann_index.snapshot()
+                first_log_segment = self._log.start_new_segment()
+                num_recorded_mutations = self._num_recorded_mutations
+            self._snapshot_generation = write_native_store(self.store_file, **columns, log_segment=first_log_segment)
+            if ann_index is not None:
+                ann_index.save(self.ann_index_file, self._snapshot_generation)
+            self._log.remove_segments_before(first_log_segment)
+            with self._lock:
+                # only now is the snapshot on disk, and only if nothing was recorded meanwhile is it complete
+                self._snapshot_is_current = self._num_recorded_mutations == num_recorded_mutations
+            if self.image_embeddings.device.type == 'cpu':
+                # map the new snapshot, so that rows added since loading don't stay in anonymous memory
+                mapped_embeddings = read_native_store_image_embeddings(self.store_file)
+                with self._lock:
+                    if self.image_embeddings is columns['image_embeddings']:
+                        self.image_embeddings = mapped_embeddings
+
+    @property
+    def ann_index_file(self) -> str | None:
+        return None if self.store_file is None else get_ann_index_file(self.store_file)
+
+    def build_ann_index(self, nlist: int = None, m: int = None):
+        """
+        Train an IVF-PQ index over the current images (see ann_index.py). It is kept up to date as images are
+        added and removed, and saved next to the store file with the next snapshot.
+        """
+        with self._lock:
+            # tensors are always replaced rather than modified in place, so training can go on without the lock
+            embeddings = self.image_embeddings
+            rows_changed_generation = self._rows_changed_generation
+        ann_index = IVFPQIndex.train(embeddings, nlist=nlist, m=m)
+        with self._lock:
+            if self._rows_changed_generation != rows_changed_generation:
+                # rows were removed or replaced during training: the quantizers still apply, but the codes don't
+                ann_index = IVFPQIndex(centroids=ann_index.centroids, codebooks=ann_index.codebooks)
+            # the rows added during training, or all of them
+            ann_index.add(self.image_embeddings[ann_index.num_rows:])
+            self.ann_index = ann_index
+            self._invalidate_derived_state()
+
+    def save_ann_index(self):
+        """
+        Write the ANN index next to the store file, without rewriting the snapshot if it is current. If there
+        are logged mutations that the snapshot doesn't have yet, compacts instead, which writes both.
+        """
+        if self.ann_index is None:
+            raise RuntimeError("there is no ANN index to save, see build_ann_index")
+        with self._compaction_lock:
+            with self._lock:
+                ann_index = self.ann_index.snapshot() if self._snapshot_is_current else None
+            if ann_index is not None and self._snapshot_generation is not None:
+                ann_index.save(self.ann_index_file, self._snapshot_generation)
+                return
+        self.save()
+
+    def _get_columns_for_saving(self) -> dict:
+        return dict(identifier=self.store_file_identifier,
+                    image_embeddings=self.image_embeddings,
+                    image_ids=list(self.image_ids),
+                    image_paths=list(self.image_paths),
+                    image_hashes=list(self.image_hashes),
+                    text_embeddings=torch.empty([0, self.image_embeddings.shape[1]]),
+                    texts=[])
 
     def cleanup_missing_files(self, force=False):
         have_indices = [i for i, p in enumerate(tqdm(self.image_paths)) if os.path.exists(p)]
@@ -160,38 +590,43 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
                   "images, but this is more than 25% of the dataset. Refusing to proceed with force=True")
         if len(have_indices) < len(self.image_paths):
             print(f'removing {len(self.image_paths) - len(have_indices)} embeddings from store because files are missing')
-            self.image_paths = [self.image_paths[i] for i in have_indices]
-            self.image_embeddings = self.image_embeddings[have_indices]
-            if self.image_hashes:
-                self.image_hashes = [self.image_hashes[i] for i in have_indices]
-            if self.image_ids:
-                self.image_ids = [self.image_ids[i] for i in have_indices]
+            have_indices = set(have_indices)
+            missing_ids = [image_id for i, image_id in enumerate(self.image_ids) if i not in have_indices]
+            self._record_mutation('remove_images', ids=missing_ids)
 
 
     def get_image_path_for_id(self, image_id: str) -> str | None:
-        try:
-            index = self.image_ids.index(image_id)
-            return self.image_paths[index]
-        except ValueError:
-            return None
+        row = self._id_to_row.get(image_id)
+        return None if row is None else self.image_paths[row]
+
+    def get_image_paths_for_ids(self, image_ids: list[str]) -> list[str | None]:
+        return [None if row < 0 else self.image_paths[row] for row in self.get_rows_for_ids(image_ids)]
 
 
     def get_image_embedding(self, path: str) -> torch.Tensor | None:
-        try:
-            index = self.image_paths.index(os.path.abspath(path))
-            return self.image_embeddings[index]
-        except ValueError:
+        row = self._path_to_row.get(os.path.abspath(path))
+        if row is not None:
+            return self.image_embeddings[row]
+        else:
             if self.is_readonly:
                 return self.clip_model.get_image_features(path)
             else:
                 image_embedding = self.add_image(path)
                 return image_embedding
 
+    def get_filtered_images(self, filters: ResultFilters) -> tuple[list[str], list[str], torch.Tensor]:
+        if RowFilter.from_result_filters(filters).has_tag_predicates and self._ensure_tag_index_current is not None:
+            self._ensure_tag_index_current()
+        with self._lock:
+            rows = get_included_rows(filters=filters, store=self)
+            return ([self.image_ids[i] for i in rows], [self.image_paths[i] for i in rows],
+                    self.image_embeddings[torch.from_numpy(rows).to(self.image_embeddings.device)])
+
     def get_image_embeddings(self, paths: list[str], show_pbar=True) -> tuple[list[str], torch.Tensor]:
         if any([type(p) is list for p in paths]):
             raise ValueError(f"paths must be a list of strings, got {type(paths)}")
         paths = [os.path.abspath(path) for path in paths]
-        missing = [p for p in paths if p not in self.image_paths]
+        missing = [p for p in paths if p not in self._path_to_row]
         if any([type(p) is list for p in missing]):
             raise ValueError(f"(b) paths must be a list of strings, got {type(missing)}")
         if missing:
@@ -203,24 +638,20 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
                     have_paths, have_embeds = self.get_image_embeddings(paths, show_pbar=False)
                     return have_paths + to_add_paths, torch.cat([have_embeds, to_add_embeds], dim=0)
                 if to_add_paths:
-                    to_add_embeds = torch.stack(to_add_embeds).to(self.store_device)
-                    self.image_paths.extend(to_add_paths)
-                    self.image_embeddings = torch.cat([self.image_embeddings, to_add_embeds], dim=0)
+                    self.add_images_precomputed(list(to_add_paths), torch.stack(to_add_embeds))
             except Exception as e:
                 print(f'Caught exception adding {len(missing)} images to clip embeddings (just returning what we have): {repr(e)}')
                 raise
-        image_paths_reverse_lookup = {p: i for i, p in enumerate(self.image_paths)}
-        have_indices = [image_paths_reverse_lookup[p] for p in paths if p in image_paths_reverse_lookup]
-        have_paths = [p for p in paths if p in image_paths_reverse_lookup]
-        return have_paths, self.image_embeddings[have_indices]
+        rows = self.get_rows_for_paths(paths)
+        have = np.flatnonzero(rows >= 0)
+        have_paths = [paths[i] for i in have]
+        return have_paths, self.image_embeddings[torch.from_numpy(rows[have]).to(self.image_embeddings.device)]
 
     def get_text_embedding(self, text: str) -> torch.Tensor:
-        try:
-            index = self.texts.index(text)
-            return self.text_embeddings[index]
-        except ValueError:
-            text_embedding = self.add_text(text)
-            return text_embedding
+        return self.get_text_embeddings([text])[0]
+
+    def get_text_embeddings(self, texts: list[str]) -> torch.Tensor:
+        return self.text_embedding_cache.get_text_embeddings(texts).to(self.store_device)
 
     def search_images(
             self,
@@ -228,6 +659,72 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
             progress_callback: Optional[Callable[[float, str], None]] = None,
             return_total_available: bool = False
     ) -> tuple[list[QueryResult], int] | list[QueryResult]:
+        ordering = self.get_search_ordering(query, progress_callback=progress_callback)
+        if ordering is None:
+            return []
+
+        # Apply pagination
+        paginated_indices = ordering.rows[query.offset:query.offset + query.limit].to(torch.int64)
+        paginated_similarities = ordering.similarities[query.offset:query.offset + query.limit]
+
+        if query.sort_order == 'semantic_page':
+            # Use minimum cost path coverage instead of TSP for better performance
+            page_embeddings = self.image_embeddings[paginated_indices.to(self.image_embeddings.device)]
+            distance_matrix = 1 - torch.matmul(page_embeddings, page_embeddings.T)
+            path_order = minimum_cost_path_coverage(distance_matrix)
+            paginated_indices = paginated_indices[path_order]
+            paginated_similarities = paginated_similarities[path_order]
+
+        if progress_callback is not None:
+            progress_callback(1, "Finished")
+
+        query_results = [QueryResult(similarity=similarity,
+                            path=self.image_paths[row],
+                            id=self.image_ids[row])
+                for row, similarity in zip(paginated_indices.tolist(), paginated_similarities.tolist())]
+        if return_total_available:
+            return query_results, ordering.total_available
+        else:
+            return query_results
+
+    def get_search_ordering(self, query: Query,
+                            progress_callback: Optional[Callable[[float, str], None]] = None) -> SearchOrdering | None:
+        """
+        The complete result order for `query`, ignoring offset/limit. Cached until the store's images
+        change, so paging through results only costs the page slice.
+        """
+        key = self.get_search_cursor(query)
+        return self._result_cache.get_or_compute(key, lambda: self._compute_search_ordering(query, progress_callback))
+
+    def get_search_cursor(self, query: Query) -> str:
+        """
+        The key the result order of `query` is cached under, which clients pass back as `query.cursor`
+        when fetching further pages. A cursor that is still cached and current skips normalizing the query.
+        """
+        if query.cursor is not None and self.get_cached_search_ordering(query.cursor) is not None:
+            return query.cursor
+        key = query.cache_key()
+        if self.tag_index is not None and query.to_row_filter().has_tag_predicates:
+            if self._ensure_tag_index_current is not None:
+                self._ensure_tag_index_current()
+            # results cached before the last tag edit no longer apply
+            key = f'{key}:tags{self.tag_index.generation}'
+        return key
+
+    def get_cached_search_ordering(self, cursor: str) -> SearchOrdering | None:
+        """The cached result order `cursor` refers to, or None if it isn't cached or tags were edited since."""
+        _, _, tags_generation = cursor.partition(':tags')
+        if tags_generation:
+            if self.tag_index is None:
+                return None
+            if self._ensure_tag_index_current is not None:
+                self._ensure_tag_index_current()
+            if tags_generation != str(self.tag_index.generation):
+                return None
+        return self._result_cache.get(cursor)
+
+    def _compute_search_ordering(self, query: Query,
+                                 progress_callback: Optional[Callable[[float, str], None]] = None) -> SearchOrdering | None:
         weights = list(query.weights)
         inputs_counts = [len(query.embeddings) if query.embeddings else 0,
                                 len(query.texts) if query.texts else 0,
@@ -238,84 +735,107 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
             progress_callback(0, "Computing embeddings")
         all_query_embeddings = []
         if query.texts:
-            all_query_embeddings.extend([
-                self.get_text_embedding(t).unsqueeze(0)
-                for t in query.texts
-            ])
+            all_query_embeddings.append(self.get_text_embeddings(query.texts))
         if query.image_ids:
-            image_paths = [self.get_image_path_for_id(i) for i in query.image_ids]
+            image_paths = self.get_image_paths_for_ids(query.image_ids)
+            actual_paths, image_embeddings = self.get_image_embeddings([p for p in image_paths if p is not None])
             missing_image_indices = [i for i, path in enumerate(image_paths)
-                                     if path is None]
-            actual_paths, image_embeddings = self.get_image_embeddings(image_paths)
-            missing_image_indices += [i for i, path in enumerate(image_paths)
-                                   if path not in actual_paths]
-            weight_index_offset = len(all_query_embeddings)
+                                     if path not in actual_paths]
+            weight_index_offset = len(query.texts) if query.texts else 0
             for index in sorted(missing_image_indices, reverse=True):
                 del weights[weight_index_offset + index]
             all_query_embeddings.append(image_embeddings)
 
         if query.embeddings:
-            if any(len(t.shape) != 1 for t in all_query_embeddings) or any(
-                    t.shape[0] != self.clip_model.embedding_dim for t in all_query_embeddings):
+            if any(len(e) != self.image_embeddings.shape[1] for e in query.embeddings):
                 raise ValueError("all query embeddings must be of shape [embedding_dim]")
             all_query_embeddings.extend([torch.tensor([e]) for e in query.embeddings])
 
-        if any(len(t.shape) != 2 for t in all_query_embeddings) or any(t.shape[1] != self.clip_model.embedding_dim for t in all_query_embeddings):
+        if any(len(t.shape) != 2 for t in all_query_embeddings) or any(t.shape[1] != self.image_embeddings.shape[1] for t in all_query_embeddings):
             raise RuntimeError("something went wrong: all finalized embeddings must be of shape [1, embedding_dim]")
         if len(all_query_embeddings) == 0:
             print("Empty query, returning no results")
-            return []
+            return None
         all_query_embeddings = torch.cat(all_query_embeddings, dim=0).to(self.image_embeddings.device, dtype=self.image_embeddings.dtype)
         if all_query_embeddings.shape[0] != len(weights):
             raise RuntimeError(f"Bad weight editing (have {all_query_embeddings.shape[0]} embeddings and {len(weights)} weights)")
         all_query_embeddings /= all_query_embeddings.norm(dim=-1, keepdim=True)
         weights = torch.tensor(weights).to(all_query_embeddings.device, dtype=all_query_embeddings.dtype)
 
-        filtered_corpus_paths: set[str]|None = None
-        def intersect_corpus_paths(paths: list[str]):
-            nonlocal filtered_corpus_paths
-            if filtered_corpus_paths is None:
-                filtered_corpus_paths = set(self.image_paths)
-            filtered_corpus_paths.intersection_update(set(paths))
-
-        def subtract_corpus_paths(paths: list[str]):
-            nonlocal filtered_corpus_paths
-            if filtered_corpus_paths is None:
-                filtered_corpus_paths = set(self.image_paths)
-            filtered_corpus_paths.difference_update(set(paths))
-
-        if query.required_path_contains:
-            matching_corpus_paths = [p for p in self.image_paths if query.required_path_contains in p]
-            intersect_corpus_paths(matching_corpus_paths)
-        if query.excluded_path_contains:
-            matching_corpus_paths = [p for p in self.image_paths if query.excluded_path_contains not in p]
-            intersect_corpus_paths(matching_corpus_paths)
-
-        if query.required_image_ids:
-            matching_corpus_indices = [self.image_ids.index(image_id)
-                                       for image_id in query.required_image_ids]
-            matching_corpus_paths = [self.image_paths[i] for i in matching_corpus_indices]
-            intersect_corpus_paths(matching_corpus_paths)
-
-        if query.excluded_image_ids:
-            matching_corpus_indices = [self.image_ids.index(image_id)
-                                       for image_id in query.excluded_image_ids]
-            matching_corpus_paths = [self.image_paths[i] for i in matching_corpus_indices]
-            subtract_corpus_paths(matching_corpus_paths)
-
-        if filtered_corpus_paths is not None:
-            corpus_indices = [self.image_paths.index(p) for p in sorted(filtered_corpus_paths)]
-            corpus_paths = [self.image_paths[i] for i in corpus_indices]
-            corpus_embeddings = self.image_embeddings[corpus_indices]
-            corpus_image_ids = [self.image_ids[i] for i in corpus_indices]
-        else:
-            corpus_paths = self.image_paths
-            corpus_embeddings = self.image_embeddings
-            corpus_image_ids = self.image_ids
+        row_filter = query.to_row_filter()
+        if row_filter.has_tag_predicates and self._ensure_tag_index_current is not None:
+            # may wait for a tag index refresh, which must not hold up mutations
+            self._ensure_tag_index_current()
+        with self._lock:
+            # the mask, the ANN candidates and the embeddings must all describe the same rows. Mutations replace
+            # the tensors rather than modify them in place, so scoring can go on without the lock
+            row_mask = row_filter.compile_mask(self)
+            image_embeddings = self.image_embeddings
+            quantized = None if self._quantized is None else self._quantized.snapshot()
+            # rows to score (None for all of them), and whether to score them against the full precision embeddings
+            candidate_rows = None
+            exact = quantized is None
+            use_ann_index = self._should_use_ann_index(query, row_mask)
+            if use_ann_index:
+                if progress_callback is not None:
+                    progress_callback(0.1, "Finding approximate candidates")
+                candidate_rows = self._get_ann_candidates(query, all_query_embeddings, weights, row_mask)
+                exact = True
+        if not use_ann_index and quantized is not None and query.sort_order in ('similarity', 'similarity_max', 'similarity_avg'):
+            candidate_rows = quantized.prefilter(self._get_probe_vectors(query, all_query_embeddings, weights), row_mask)
+        if candidate_rows is not None:
+            # candidates have already been filtered
+            row_mask = None
 
         if progress_callback is not None:
             progress_callback(0.25, "Computing similarities")
 
+        final_similarities = self._compute_similarities(query, all_query_embeddings, weights, candidate_rows, exact,
+                                                        image_embeddings, quantized)
+
+        ascending_order = query.sort_order == 'similarity_asc' or query.sort_order == 'similarity_max_asc' or query.sort_order == 'similarity_avg_asc'
+        if row_mask is None:
+            total_available = final_similarities.shape[0]
+        else:
+            # filtered-out rows sort to the end, past total_available
+            total_available = int(row_mask.sum())
+            excluded = torch.from_numpy(~row_mask).to(final_similarities.device)
+            final_similarities.masked_fill_(excluded, float('inf') if ascending_order else float('-inf'))
+        if progress_callback is not None:
+            progress_callback(0.9, "Sorting")
+
+        ordered_indices = torch.argsort(final_similarities, dim=0, descending=not ascending_order)[:total_available]
+        ordered_similarities = final_similarities[ordered_indices].to('cpu', dtype=torch.float32)
+        ordered_indices = ordered_indices.cpu()
+        if candidate_rows is not None:
+            ordered_indices = candidate_rows[ordered_indices]
+
+        rescore_top_k = 0 if exact else min(quantized.settings.rescore_top_k, total_available)
+        if rescore_top_k > 0:
+            top_rows = ordered_indices[:rescore_top_k]
+            rescored = self._compute_similarities(query, all_query_embeddings, weights, top_rows, True,
+                                                  image_embeddings, quantized)
+            rescored_order = torch.argsort(rescored, dim=0, descending=not ascending_order).cpu()
+            ordered_indices[:rescore_top_k] = top_rows[rescored_order]
+            ordered_similarities[:rescore_top_k] = rescored[rescored_order].to('cpu', dtype=torch.float32)
+
+        return SearchOrdering(rows=ordered_indices.to(torch.int32),
+                              similarities=ordered_similarities,
+                              total_available=total_available)
+
+    def _compute_similarities(self, query: Query, all_query_embeddings: torch.Tensor, weights: torch.Tensor,
+                              rows: torch.Tensor | None, exact: bool, image_embeddings: torch.Tensor,
+                              quantized: QuantizedEmbeddings | None) -> torch.Tensor:
+        """
+        Similarity of each of `rows` (or every row) to the query, according to its sort order, scored against
+        `image_embeddings` or, if not `exact`, `quantized`.
+        """
+        def score(vectors: torch.Tensor) -> torch.Tensor:
+            if not exact:
+                return quantized.scores(vectors, rows)
+            corpus_embeddings = image_embeddings if rows is None else image_embeddings[rows.to(image_embeddings.device)]
+            return torch.matmul(vectors, corpus_embeddings.T)
+
         if query.sort_order == 'direction' or query.sort_order == 'direction_rev':
             if all_query_embeddings.shape[0] != 2:
                 raise ValueError("direction sort order requires exactly 2 query embeddings (got " + str(all_query_embeddings.shape[0]) + ")")
@@ -323,97 +843,252 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
             direction /= direction.norm()
             if query.sort_order == 'direction_rev':
                 direction = -direction
-            final_similarities = torch.matmul(corpus_embeddings, direction.unsqueeze(-1)).squeeze(-1)
+            return score(direction.unsqueeze(0)).squeeze(0)
         elif query.sort_order == 'similarity_avg' or query.sort_order == 'similarity_avg_asc':
             # Take weighted mean of embeddings before computing similarities
             weighted_embeddings = all_query_embeddings * weights.unsqueeze(-1)
             mean_embedding = weighted_embeddings.sum(dim=0) / weights.sum()
             mean_embedding /= mean_embedding.norm()
-            final_similarities = torch.matmul(corpus_embeddings, mean_embedding.unsqueeze(-1)).squeeze(-1)
+            return score(mean_embedding.unsqueeze(0)).squeeze(0)
         else:
-            similarities = torch.matmul(all_query_embeddings, corpus_embeddings.T)
-            weighted_similarities = (similarities.T * weights).T
+            similarities = score(all_query_embeddings)
+            weighted_similarities = (similarities.T * weights.to(similarities.device, dtype=similarities.dtype)).T
             if query.sort_order == 'similarity_max' or query.sort_order == 'similarity_max_asc':
-                final_similarities = weighted_similarities.max(dim=0).values
+                return weighted_similarities.max(dim=0).values
             else:
-                final_similarities = weighted_similarities.sum(dim=0)
+                return weighted_similarities.sum(dim=0)
 
-        ascending_order = query.sort_order == 'similarity_asc' or query.sort_order == 'similarity_max_asc' or query.sort_order == 'similarity_avg_asc'
-        ordered_indices = torch.argsort(final_similarities, dim=0, descending=not ascending_order)
-
-        if progress_callback is not None:
-            progress_callback(0.9, "Sorting")
-
-        # Apply pagination
-        start_idx = query.offset
-        end_idx = start_idx + query.limit
-        paginated_indices = ordered_indices[start_idx:end_idx]
+    def _should_use_ann_index(self, query: Query, row_mask: np.ndarray | None) -> bool:
+        if query.ann_nprobe is None or self.ann_index is None:
+            return False
+        if query.sort_order not in ('similarity', 'similarity_max', 'similarity_avg'):
+            return False
+        # a selective filter leaves few enough rows to score exactly, and the probed lists might miss them all
+        return row_mask is None or int(row_mask.sum()) > query.ann_candidates
 
-        if query.sort_order == 'semantic_page':
-            # Use minimum cost path coverage instead of TSP for better performance
-            page_embeddings = corpus_embeddings[paginated_indices]
-            distance_matrix = 1 - torch.matmul(page_embeddings, page_embeddings.T)
-            path_order = minimum_cost_path_coverage(distance_matrix)
-            paginated_indices = [paginated_indices[i] for i in path_order]
-
-        if progress_callback is not None:
-            progress_callback(1, "Finished")
-
-        query_results = [QueryResult(similarity=final_similarities[i].item(),
-                            path=corpus_paths[i],
-                            id=corpus_image_ids[i])
-                for i in paginated_indices]
-        if return_total_available:
-            return query_results, final_similarities.shape[0]
+    def _get_probe_vectors(self, query: Query, all_query_embeddings: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+        """
+        Vectors whose highest-scoring rows include the best results of a similarity, similarity_max or
+        similarity_avg query, for finding candidates in an index.
+        """
+        weighted_embeddings = all_query_embeddings * weights.unsqueeze(-1)
+        if query.sort_order == 'similarity_max':
+            # the max is high wherever any single weighted query embedding scores high
+            return weighted_embeddings
+        elif query.sort_order == 'similarity_avg':
+            return (weighted_embeddings.sum(dim=0) / weights.sum()).unsqueeze(0)
         else:
-            return query_results
+            # a weighted sum of similarities is the similarity to the weighted sum of embeddings
+            return weighted_embeddings.sum(dim=0, keepdim=True)
+
+    def _get_ann_candidates(self, query: Query, all_query_embeddings: torch.Tensor, weights: torch.Tensor,
+                            row_mask: np.ndarray | None) -> torch.Tensor:
+        """Rows (cpu int64) that the ANN index proposes for `query`, to be re-ranked exactly."""
+        probe_vectors = self._get_probe_vectors(query, all_query_embeddings, weights)
+        candidates = [self.ann_index.search(v, nprobe=query.ann_nprobe, k=query.ann_candidates, row_mask=row_mask)[0]
+                      for v in probe_vectors]
+        return torch.unique(torch.cat(candidates))
 
 
-    def add_images_precomputed(self, paths: list[str], embeddings: torch.Tensor, save=False):
-        new_indices = [i for i, p in enumerate(paths) if not self.has_image(p)]
-        paths_to_add = [paths[i] for i in new_indices]
-        embeddings_to_add = embeddings[new_indices].to(self.store_device)
-        hashes_to_add = [_compute_md5_hash(p) for p in paths_to_add]
-        self.image_embeddings = torch.cat([self.image_embeddings, embeddings_to_add])
-        self.image_ids = self.image_ids + [str(uuid.uuid4()) for _ in range(len(paths_to_add))]
-        self.image_paths.extend(paths_to_add)
-        self.image_hashes = self.image_hashes + [_compute_md5_hash(p) for p in paths_to_add]
-        assert len(self.image_paths) == len(self.image_hashes)
-        assert len(self.image_ids) == len(self.image_hashes)
-        assert self.image_embeddings.shape[0] == len(self.image_paths)
+    def add_images_precomputed(self, paths: list[str], embeddings: torch.Tensor, save=False, hashes: list[str] = None):
+        """
+        Add images with already-computed embeddings. The addition is logged immediately;
+        save=True additionally schedules a background snapshot.
+        `hashes` are the images' content hashes, if the caller has computed them already.
+        """
+        new_indices = []
+        seen_paths = set()
+        for i, path in enumerate(paths):
+            # a path given more than once is added once
+            if path not in seen_paths and not self.has_image(path):
+                new_indices.append(i)
+            seen_paths.add(path)
+        if new_indices:
+            paths_to_add = [paths[i] for i in new_indices]
+            if hashes is None:
+                hashes_to_add = compute_content_hashes(paths_to_add, self.hash_algorithm)
+            else:
+                hashes_to_add = [hashes[i] for i in new_indices]
+            self._record_mutation('add_images',
+                                  paths=paths_to_add,
+                                  ids=[str(uuid.uuid4()) for _ in range(len(paths_to_add))],
+                                  hashes=hashes_to_add,
+                                  embeddings=embeddings[new_indices].detach().cpu().numpy())
         if save:
-            self._save_to_store()
+            self.schedule_compaction()
 
-    def add_images(self, paths_in: list[str], batch_size=10, save=False, show_pbar=True) -> tuple[list[str], torch.Tensor]:
+    def _reuse_embeddings_by_hash(self, paths: list[str], hashes: list[str]) -> list[int]:
+        """
+        Handle the `paths` whose content is already in the store without running the model: a row whose file is
+        gone is moved to the new path (keeping its id), otherwise the new path is added with a copy of the
+        embedding. Returns the indices of the paths that still need embedding.
+        """
+        moved_ids, moved_paths = [], []
+        moved_rows = set()
+        copied_indices, copied_rows = [], []
+        remaining_indices = []
+        with self._lock:
+            for i, (path, image_hash) in enumerate(zip(paths, hashes)):
+                row = self._hash_to_row.get(image_hash, -1) if image_hash else -1
+                if row < 0:
+                    remaining_indices.append(i)
+                elif row not in moved_rows and not os.path.exists(self.image_paths[row]):
+                    moved_rows.add(row)
+                    moved_ids.append(self.image_ids[row])
+                    moved_paths.append(path)
+                else:
+                    copied_indices.append(i)
+                    copied_rows.append(row)
+            if moved_ids:
+                self._record_mutation('move_images', ids=moved_ids, paths=moved_paths)
+            if copied_indices:
+                self.add_images_precomputed([paths[i] for i in copied_indices],
+                                            self.image_embeddings[torch.tensor(copied_rows, device=self.image_embeddings.device)],
+                                            hashes=[hashes[i] for i in copied_indices])
+        if moved_ids or copied_indices:
+            print(f'reused the embeddings of {len(moved_ids)} moved and {len(copied_indices)} copied images')
+        return remaining_indices
+
+    def add_images(self, paths_in: list[str], batch_size=10, save=False, show_pbar=True, commit_every: int = 1000,
+                   checkpoint_every: int = 10_000, progress_callback: Optional[Callable[[float, str], None]] = None,
+                   return_embeddings=True, thumbnail_provider: ThumbnailProvider = None) -> tuple[list[str], torch.Tensor | None]:
+        """
+        Embed and add the images in `paths_in` that are not in the store yet. Returns the paths that were added
+        and, unless return_embeddings=False, their embeddings.
+        Embeddings are committed every `commit_every` images, so they are logged as they are computed rather
+        than all at the end. If there are more than that, the remaining paths are also checkpointed every
+        `checkpoint_every` images (see ingestion_checkpoint.py), together with a background snapshot, and
+        resume_ingestion() continues from the last checkpoint after a crash or restart.
+        With a `thumbnail_provider`, thumbnails are written from the images decoded for the model.
+        """
         if self.is_readonly:
             raise ReadOnlyException("this store is read-only because it has no hashes")
         paths_in = [os.path.abspath(path) for path in paths_in]
         paths_missing = [p for p in paths_in if not self.has_image(p)]
         if len(paths_missing) == 0:
-            empty = torch.empty((0, self.clip_model.embedding_dim)).to(self.store_device)
-            return [],empty
+            return [], torch.empty((0, self.image_embeddings.shape[1])) if return_embeddings else None
         if self.clip_model is None:
             raise ReadOnlyException("this store is read-only because no clip_model was")
-        paths_to_add, embeddings_to_add = zip(
-            *self.clip_model.get_image_features_batched(paths_missing, batch_size=batch_size, show_pbar=show_pbar)
-        )
-        assert len(embeddings_to_add) == len(paths_to_add)
-        self.add_images_precomputed(paths_to_add, torch.stack(embeddings_to_add))
-        return paths_to_add, embeddings_to_add
+        checkpoint = None
+        if self.store_file is not None and len(paths_missing) > commit_every:
+            checkpoint = IngestionCheckpoint.create(self.store_file, paths_missing)
+        added_paths = self._ingest(paths_missing, checkpoint, batch_size=batch_size, show_pbar=show_pbar,
+                                   commit_every=commit_every, checkpoint_every=checkpoint_every,
+                                   progress_callback=progress_callback, thumbnail_provider=thumbnail_provider)
+        if save:
+            self.schedule_compaction()
+        if not return_embeddings:
+            return added_paths, None
+        rows = self.get_rows_for_paths(added_paths)
+        return added_paths, self.image_embeddings[torch.from_numpy(rows).to(self.image_embeddings.device)]
+
+    def _ingest(self, paths: list[str], checkpoint: IngestionCheckpoint | None, batch_size: int, show_pbar: bool,
+                commit_every: int, checkpoint_every: int,
+                progress_callback: Optional[Callable[[float, str], None]],
+                thumbnail_provider: ThumbnailProvider = None) -> list[str]:
+        """Add `paths` in increments of `commit_every`. Returns the paths that were added."""
+        added_paths = []
+        num_done = 0
+        with tqdm(total=len(paths), disable=not show_pbar, desc="adding images") as pbar:
+            for start in range(0, len(paths), commit_every):
+                increment = [p for p in paths[start:start + commit_every] if not self.has_image(p)]
+                hashes = compute_content_hashes(increment, self.hash_algorithm)
+                remaining_indices = self._reuse_embeddings_by_hash(increment, hashes)
+                hash_for_path = {increment[i]: hashes[i] for i in remaining_indices}
+                extra_args = {} if thumbnail_provider is None else \
+                    {'on_image_decoded': thumbnail_provider.write_thumbnails_from_image}
+                embedded = list(self.clip_model.get_image_features_batched([increment[i] for i in remaining_indices],
+                                                                           batch_size=batch_size, show_pbar=False,
+                                                                           **extra_args))
+                if embedded:
+                    embedded_paths = [p for p, _ in embedded]
+                    self.add_images_precomputed(embedded_paths, torch.stack([e for _, e in embedded]),
+                                                hashes=[hash_for_path[p] for p in embedded_paths])
+                added_paths.extend(p for p in increment if self.has_image(p))
+
+                previous_num_done = num_done
+                num_done = min(start + commit_every, len(paths))
+                pbar.update(num_done - previous_num_done)
+                if checkpoint is not None and num_done < len(paths) and \
+                        num_done // checkpoint_every > previous_num_done // checkpoint_every:
+                    checkpoint.save(paths[num_done:])
+                    self.schedule_compaction()
+                if progress_callback is not None:
+                    progress_callback(num_done / len(paths), f'added {len(added_paths)} of {len(paths)} images')
+        if checkpoint is not None:
+            checkpoint.remove()
+            self.schedule_compaction()
+        return added_paths
+
+    def update_images(self, paths: list[str], batch_size=10, show_pbar=True,
+                      thumbnail_provider: ThumbnailProvider = None) -> list[str]:
+        """
+        Bring the images in `paths`, whose files changed since they were added, up to date. Images keep their
+        ids; those whose content hash changed get a new embedding, which is reused from another image with
+        the same content if there is one. An image that can't be read or decoded any more keeps its old
+        embedding. Returns the paths that are up to date now.
+        """
+        if self.is_readonly:
+            raise ReadOnlyException("this store is read-only because it has no hashes")
+        paths = list(dict.fromkeys(p for p in (os.path.abspath(p) for p in paths) if self.has_image(p)))
+        hashes = compute_content_hashes(paths, self.hash_algorithm)
+        with self._lock:
+            rows = self.get_rows_for_paths(paths)
+            changed_indices = [i for i, row in enumerate(rows.tolist())
+                               if row >= 0 and hashes[i] and hashes[i] != self.image_hashes[row]]
+            reused_indices = [i for i in changed_indices if hashes[i] in self._hash_to_row]
+            if reused_indices:
+                self._record_mutation('replace_embeddings',
+                                      ids=[self.image_ids[rows[i]] for i in reused_indices],
+                                      hashes=[hashes[i] for i in reused_indices],
+                                      embeddings=self.image_embeddings[torch.tensor(
+                                          [self._hash_to_row[hashes[i]] for i in reused_indices],
+                                          device=self.image_embeddings.device)].detach().cpu().numpy())
+        to_embed = sorted(set(changed_indices) - set(reused_indices))
+        if to_embed and self.clip_model is None:
+            raise ReadOnlyException("this store is read-only because no clip_model was")
+        extra_args = {} if thumbnail_provider is None else \
+            {'on_image_decoded': thumbnail_provider.write_thumbnails_from_image}
+        embedded = dict(self.clip_model.get_image_features_batched([paths[i] for i in to_embed], batch_size=batch_size,
+                                                                   show_pbar=show_pbar, **extra_args)) if to_embed else {}
+        if embedded:
+            hash_for_path = {paths[i]: hashes[i] for i in to_embed}
+            self._record_mutation('replace_embeddings', ids=self.get_image_ids_for_paths(list(embedded)),
+                                  hashes=[hash_for_path[p] for p in embedded],
+                                  embeddings=torch.stack(list(embedded.values())).detach().cpu().numpy())
+        failed = {paths[i] for i in to_embed} - embedded.keys()
+        return [p for i, p in enumerate(paths) if hashes[i] and p not in failed]
+
+    def has_pending_ingestion(self) -> bool:
+        return self.store_file is not None and len(IngestionCheckpoint.find(self.store_file)) > 0
+
+    def resume_ingestion(self, batch_size=10, show_pbar=True, commit_every: int = 1000, checkpoint_every: int = 10_000,
+                         progress_callback: Optional[Callable[[float, str], None]] = None) -> int:
+        """Finish the add_images calls that were interrupted, from their last checkpoints. Returns the number of images added."""
+        if self.store_file is None:
+            return 0
+        num_added = 0
+        for checkpoint in IngestionCheckpoint.find(self.store_file):
+            paths = [p for p in checkpoint.load() if not self.has_image(p)]
+            print(f'resuming ingestion of {len(paths)} images from {checkpoint.path}')
+            num_added += len(self._ingest(paths, checkpoint, batch_size=batch_size, show_pbar=show_pbar,
+                                          commit_every=commit_every, checkpoint_every=checkpoint_every,
+                                          progress_callback=progress_callback))
+        return num_added
 
     def add_image(self, path) -> torch.Tensor:
         _, e = self.add_images([path])
         return e[0]
 
-    def add_text(self, text: str) -> torch.Tensor:
-        embedding_to_add = self.clip_model.get_text_features(text)
-        self.text_embeddings = torch.cat([self.text_embeddings, embedding_to_add])
-        self.texts.append(text)
-        self._save_to_store()
-        return embedding_to_add[0]
-
     def has_image(self, path: str) -> bool:
-        return path in self.image_paths
+        return path in self._path_to_row
+
+    def add_images_recursively(self, root_dir: str, **kwargs) -> int:
+        """Add new and changed images under `root_dir`. Scan manifests are kept next to the store file, see scanner.py."""
+        return scanner.add_images_recursively(self, root_dir, manifest_file=self.get_scan_manifest_file(root_dir), **kwargs)
+
+    def get_scan_manifest_file(self, root_dir: str) -> str | None:
+        return None if self.store_file is None else scanner.get_manifest_file(f'{self.store_file}.scan_manifests', root_dir)
 
     def save(self, store_file_path=None):
         if store_file_path is None:
@@ -423,37 +1098,51 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
         else:
             self._save_to_store(store_file_path)
 
-    def _load_from_store(self, ignore_identifier_mismatch=False):
-        d = torch.load(self.store_file)
+    def _load_from_store(self, ignore_identifier_mismatch=False) -> int:
+        """Load the last snapshot. Returns the first mutation log segment to replay on top of it."""
+        if is_native_store_file(self.store_file):
+            d = read_native_store(self.store_file, mmap=True)
+            self._snapshot_generation = d['generation']
+        else:
+            d = torch.load(self.store_file)
         version = d['version']
         if version >= 3:
             if not ignore_identifier_mismatch and d['identifier'] != self.store_file_identifier:
                 raise ValueError(f'Store_file_identifier mismatch. expected: {self.store_file_identifier}, loaded: ' + d['identifier'])
+            # keep the file's identifier, so that saving doesn't relabel the embeddings as another model's
+            self.store_file_identifier = d['identifier']
         if version == 1:
-            self.image_embeddings = d['embeddings'].to(self.store_device)
+            self.image_embeddings = d['embeddings'].to(self._full_precision_device)
             self.image_paths = _recover_natural_case_from_lowercase_paths(d['paths'])
             self.image_ids = d['ids']
-            self.text_embeddings = torch.empty([0, self.clip_model.embedding_dim]).to(self.store_device)
-            self.texts = []
         elif version >= 2:
-            self.image_embeddings = d['image_embeddings'].to(self.store_device)
+            self.image_embeddings = d['image_embeddings'].to(self._full_precision_device)
             if version >= 5:
                 self.image_paths = d['image_paths']
             else:
                 self.image_paths = _recover_natural_case_from_lowercase_paths(d['image_paths'])
             self.image_ids = d['image_ids']
-            self.text_embeddings = d['text_embeddings'].to(self.store_device)
-            self.texts = d['texts']
+            if d['texts']:
+                # older versions kept every query string in the store file
+                print(f"moving {len(d['texts'])} text embeddings from {self.store_file} to the text embedding cache")
+                self.text_embedding_cache.add(d['texts'], d['text_embeddings'])
+                self._needs_compaction = True
         else:
             raise RuntimeError(f"unrecognized store version in {self.store_file}: {version}")
         if version >= 4:
             self.image_hashes = d['image_hashes']
         else:
             print(f'computing missing hashes for {len(self.image_paths)} images')
-            self.image_hashes = [_compute_md5_hash(p) for p in tqdm(self.image_paths)]
+            self.image_hashes = compute_content_hashes(self.image_paths, self.hash_algorithm, show_pbar=True)
         if self.image_ids is None or len(self.image_ids) != len(self.image_paths):
             print('generating new image ids for', len(self.image_paths), 'images')
             self.image_ids = [str(uuid.uuid4()) for _ in range(len(self.image_paths))]
+            self._image_ids_regenerated = True
+            self._needs_compaction = True
+        if version < NATIVE_STORE_VERSION:
+            # convert to the memory-mapped format in the background
+            self._needs_compaction = True
+        return d.get('log_segment', 0)
 
     def _save_to_store(self, store_file_path=None):
         if self.is_readonly:
@@ -462,138 +1151,224 @@ class SimpleClipEmbeddingStore(EmbeddingStore):
         path = self.store_file if store_file_path is None else store_file_path
         if path is None:
             return
-        torch.save({
-            'version': 5,
-            'identifier': self.store_file_identifier,
-            'image_embeddings': self.image_embeddings,
-            'image_ids': self.image_ids,
-            'image_paths': self.image_paths,
-            'image_hashes': self.image_hashes,
-            'text_embeddings': self.text_embeddings,
-            'texts': self.texts,
-        }, path)
+        if path == self.store_file and self._log is not None:
+            self._compact()
+        else:
+            with self._lock:
+                columns = self._get_columns_for_saving()
+            write_native_store(path, **columns)
 
 
     def get_image_ids_for_paths(self, image_paths: list[str]) -> list[str]:
-        indices = [self.image_paths.index(p) for p in image_paths if p in self.image_paths]
-        return [self.image_ids[i] for i in indices]
+        rows = self.get_rows_for_paths(image_paths)
+        return [self.image_ids[row] for row in rows if row >= 0]
 
 
     def remove_image(self, id: str):
         if self.is_readonly:
             raise ReadOnlyException("Readonly store is read-only")
-        index = self.image_ids.index(id)
-        del self.image_ids[index]
-        del self.image_paths[index]
-        del self.image_hashes[index]
-        self.image_embeddings = self.image_embeddings[torch.arange(self.image_embeddings.shape[0]) != index]
-
-
-def _compute_md5_hash(path):
-    with open(path, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
-
-
-
-def load_chunk_paths(store_folder: str) -> List[str]:
-    def make_chunk_path(index):
-        return os.path.join(store_folder, f'part_{index:04d}.pt')
-
-    num_chunks = 0
-    print('finding chunks...')
-    while os.path.exists(make_chunk_path(num_chunks)):
-        num_chunks += 1
-
-    all_paths = []
-    for chunk_index in tqdm(range(num_chunks), desc='Loading chunks'):
-        chunk = torch.load(make_chunk_path(chunk_index), weights_only=False)
-        chunk_paths = [p['path'] for p in chunk['objects']]
-        all_paths.extend(chunk_paths)
-        chunk_index += 1
-    return all_paths
-
-
-def _load_chunked_store(store_folder: str, store_device='cpu', shard_size: int = 1e6) -> List[SimpleClipEmbeddingStore]:
-    shards = []
-    # eg part_0000.pt
-    def make_chunk_path(index):
-        return os.path.join(store_folder, f'part_{index:04d}.pt')
-
-    def add_shard(paths, embeddings):
-        shard = SimpleClipEmbeddingStore(clip_model=None, store_file=None, store_device=store_device, store_file_identifier='shard__', bare_mode=True)
-        shard.image_embeddings = embeddings
-        shard.image_paths = paths
-        shard.image_ids = [str(uuid.uuid4()) for _ in range(len(shard_paths))]
-        shard.image_hashes = []
-        shards.append(shard)
-
-    shard_embeddings = None
-    shard_paths = []
-
-    num_chunks = 0
-    print('finding chunks...')
-    while os.path.exists(make_chunk_path(num_chunks)):
-        num_chunks += 1
-
-    for chunk_index in tqdm(range(num_chunks), desc='Loading chunks'):
-        chunk = torch.load(make_chunk_path(chunk_index), weights_only=False)
-        chunk_paths = [p['path'] for p in chunk['objects']]
-        chunk_embeddings = chunk['vectors'].to(store_device)
-        shard_paths.extend(chunk_paths)
-        shard_embeddings = chunk_embeddings if shard_embeddings is None else torch.cat([shard_embeddings, chunk_embeddings])
-        if len(shard_paths) >= shard_size:
-            add_shard(shard_paths[:shard_size], shard_embeddings[:shard_size])
-            shard_embeddings = shard_embeddings[shard_size:]
-            shard_paths = shard_paths[shard_size:]
-        chunk_index += 1
-    if len(shard_paths) >= 0:
-        add_shard(shard_paths, shard_embeddings)
-    return shards
+        if id not in self._id_to_row:
+            raise ValueError(f"no image with id {id}")
+        self._record_mutation('remove_images', ids=[id])
+
+
+
+def load_chunk_paths(store_folder: str, native_folder: str = None) -> List[str]:
+    native_folder = native_folder or os.path.join(store_folder, 'native_shards')
+    shard_files = get_native_shard_files(store_folder, native_folder, shard_size=None)
+    if shard_files is not None:
+        return [path for shard_file in shard_files for path in read_native_store(shard_file)['image_paths']]
+    return [path for chunk_paths, _ in read_chunks(find_chunk_files(store_folder)) for path in chunk_paths]
+
+
+def _make_bare_shard(paths: list[str], ids: list[str], embeddings: torch.Tensor, store_device='cpu',
+                     quantization: QuantizationSettings = None) -> SimpleClipEmbeddingStore:
+    shard = SimpleClipEmbeddingStore(clip_model=None, store_file=None, store_device=store_device, store_file_identifier='shard__', bare_mode=True)
+    shard.image_embeddings = embeddings if quantization is not None else embeddings.to(store_device)
+    shard.image_paths = paths
+    shard.image_ids = ids
+    shard.image_hashes = []
+    shard._rebuild_row_indexes()
+    if quantization is not None:
+        shard.set_embedding_quantization(quantization)
+    return shard
+
+
+def _load_chunked_store(store_folder: str, store_device='cpu', shard_size: int = 1_000_000,
+                        quantization: QuantizationSettings = None, native_folder: str = None,
+                        convert_to_native: bool = True, workers: int = None) -> List[SimpleClipEmbeddingStore]:
+    """
+    Load a Weaviate dump (see weaviate_chunks.py) as shards of `shard_size` rows. With `convert_to_native`,
+    the first load writes the shards to `native_folder` (default: `<store_folder>/native_shards`) and later
+    loads memory-map them from there.
+    """
+    shard_size = int(shard_size)
+    native_folder = native_folder or os.path.join(store_folder, 'native_shards')
+    shard_files = get_native_shard_files(store_folder, native_folder, shard_size)
+    if shard_files is None and convert_to_native:
+        try:
+            shard_files = convert_to_native_shards(store_folder, native_folder, shard_size, workers=workers)
+        except OSError as e:
+            print(f'Caught exception converting {store_folder} to native shards (loading the chunks directly): {repr(e)}')
+
+    if shard_files is None:
+        return [_make_bare_shard(paths, [str(uuid.uuid4()) for _ in range(len(paths))], embeddings,
+                                 store_device=store_device, quantization=quantization)
+                for paths, embeddings in iter_shards(find_chunk_files(store_folder), shard_size, workers=workers)]
+
+    def load_shard(shard_file: str) -> SimpleClipEmbeddingStore:
+        d = read_native_store(shard_file, mmap=True)
+        return _make_bare_shard(d['image_paths'], d['image_ids'], d['image_embeddings'],
+                                store_device=store_device, quantization=quantization)
+
+    print(f'loading {len(shard_files)} native shards from {native_folder}')
+    with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count()), thread_name_prefix='shard-loader') as executor:
+        return list(executor.map(load_shard, shard_files))
 
 
 class ShardedEmbeddingStore(EmbeddingStore):
 
     @property
     def image_paths(self) -> List[str]:
-        return self.editable_shard.image_paths
+        return [path for shard in self.shards for path in shard.image_paths]
 
     @staticmethod
     def from_weaviate_dump_chunks(chunks_folder: str,
                                   clip_model: ClipModel=None,
                                   store_device='cpu',
-                                  shard_size: int=1e6):
-        shards = _load_chunked_store(chunks_folder, store_device=store_device, shard_size=shard_size)
-        return ShardedEmbeddingStore(clip_model=clip_model, shards=shards)
-
-    def __init__(self, clip_model: ClipModel, shards: list[SimpleClipEmbeddingStore]):
+                                  shard_size: int=1e6,
+                                  text_embedding_cache: TextEmbeddingCache=None,
+                                  quantization: QuantizationSettings=None,
+                                  native_folder: str=None,
+                                  convert_to_native: bool=True):
+        shards = _load_chunked_store(chunks_folder, store_device=store_device, shard_size=shard_size,
+                                     quantization=quantization, native_folder=native_folder,
+                                     convert_to_native=convert_to_native)
+        return ShardedEmbeddingStore(clip_model=clip_model, shards=shards, text_embedding_cache=text_embedding_cache)
+
+    def __init__(self, clip_model: ClipModel, shards: list[SimpleClipEmbeddingStore], text_embedding_cache: TextEmbeddingCache = None,
+                 search_workers: int = None):
+        """`search_workers` threads search the shards in parallel (default: one per cpu core)."""
         self.clip_model = clip_model
         self.shards = shards
+        self._search_executor = ThreadPoolExecutor(max_workers=search_workers or os.cpu_count(),
+                                                   thread_name_prefix='shard-search')
+        self.text_embedding_cache = text_embedding_cache or TextEmbeddingCache(clip_model)
         self.editable_shard: SimpleClipEmbeddingStore|None = None
+        # global routing: which shard holds each id and path. Rows within a shard come from the shard's own indexes.
+        # Entries for removed images are dropped when they are next looked up.
+        self._id_to_shard: dict[str, SimpleClipEmbeddingStore] = {}
+        self._path_to_shard: dict[str, SimpleClipEmbeddingStore] = {}
+        self.tag_index: TagIndex|None = None
+        self._ensure_tag_index_current: Callable[[], None]|None = None
+        self._rows_listeners: list[Callable[[list[str], list[str]], None]] = []
+        for shard in shards:
+            self._add_routes(shard)
 
     def add_shard(self, shard: SimpleClipEmbeddingStore, editable=False):
         self.shards.append(shard)
+        self._add_routes(shard)
+        if self.tag_index is not None:
+            shard.attach_tag_index(self.tag_index, ensure_current=self._ensure_tag_index_current)
+        for listener in self._rows_listeners:
+            shard.add_rows_listener(listener)
         if editable:
             self.editable_shard = shard
 
-    def get_image_embeddings(self, paths: list[str]) -> tuple[list[str], torch.Tensor]:
-        result_paths = []
-        result_embeddings = []
+    def attach_tag_index(self, tag_index: TagIndex, ensure_current: Callable[[], None] = None):
+        self.tag_index = tag_index
+        self._ensure_tag_index_current = ensure_current
         for shard in self.shards:
-            paths, embeddings = shard.get_image_embeddings(paths)
-            result_paths.extend(paths)
-            result_embeddings.append(embeddings)
+            shard.attach_tag_index(tag_index, ensure_current=ensure_current)
 
-        return result_paths, torch.cat(result_embeddings, dim=0)
+    def add_rows_listener(self, listener: Callable[[list[str], list[str]], None]):
+        """See SimpleClipEmbeddingStore.add_rows_listener; listens to every shard, including ones added later."""
+        self._rows_listeners.append(listener)
+        for shard in self.shards:
+            shard.add_rows_listener(listener)
+
+    def _add_routes(self, shard: SimpleClipEmbeddingStore):
+        # when an image is in several shards, the first one wins, as it did with linear probing
+        for path in shard.image_paths:
+            self._path_to_shard.setdefault(path, shard)
+        for image_id in shard.image_ids:
+            self._id_to_shard.setdefault(image_id, shard)
+
+        def on_rows_added(paths: list[str], ids: list[str]):
+            self._path_to_shard.update(zip(paths, itertools.repeat(shard)))
+            self._id_to_shard.update(zip(ids, itertools.repeat(shard)))
+        shard.add_rows_listener(on_rows_added)
+
+    def _get_shard_for_id(self, image_id: str) -> SimpleClipEmbeddingStore | None:
+        shard = self._id_to_shard.get(image_id)
+        if shard is not None and shard.get_rows_for_ids([image_id])[0] < 0:
+            self._id_to_shard.pop(image_id, None)
+            return None
+        return shard
+
+    def _get_shard_for_path(self, path: str) -> SimpleClipEmbeddingStore | None:
+        shard = self._path_to_shard.get(path)
+        if shard is not None and not shard.has_image(path):
+            self._path_to_shard.pop(path, None)
+            return None
+        return shard
+
+    def get_image_path_for_id(self, image_id: str) -> str | None:
+        shard = self._get_shard_for_id(image_id)
+        return None if shard is None else shard.get_image_path_for_id(image_id)
+
+    def get_image_ids_for_paths(self, image_paths: list[str]) -> list[str]:
+        result = []
+        for path in image_paths:
+            shard = self._get_shard_for_path(path)
+            if shard is not None:
+                result.extend(shard.get_image_ids_for_paths([path]))
+        return result
+
+    def get_image_embeddings(self, paths: list[str]) -> tuple[list[str], torch.Tensor]:
+        """Embeddings in the order of `paths`. Paths that no shard has are added to the editable shard, if there is one."""
+        paths = [os.path.abspath(path) for path in paths]
+        paths_by_shard: dict[SimpleClipEmbeddingStore, list[str]] = {}
+        for path in paths:
+            shard = self._get_shard_for_path(path) or self.editable_shard
+            if shard is not None:
+                paths_by_shard.setdefault(shard, []).append(path)
+
+        embeddings_by_path = {}
+        for shard, shard_paths in paths_by_shard.items():
+            found_paths, found_embeddings = shard.get_image_embeddings(shard_paths)
+            embeddings_by_path.update(zip(found_paths, found_embeddings))
+
+        result_paths = [path for path in paths if path in embeddings_by_path]
+        if not result_paths:
+            return [], torch.empty([0, self.shards[0].image_embeddings.shape[1] if self.shards else 0])
+        device = embeddings_by_path[result_paths[0]].device
+        return result_paths, torch.stack([embeddings_by_path[path].to(device) for path in result_paths])
 
     def get_image_embedding(self, path: str) -> torch.Tensor:
+        shard = self._get_shard_for_path(os.path.abspath(path)) or self.editable_shard
+        if shard is None:
+            raise ValueError("no such path")
+        return shard.get_image_embedding(path)
+
+    def get_filtered_images(self, filters: ResultFilters) -> tuple[list[str], list[str], torch.Tensor]:
+        """See SimpleClipEmbeddingStore.get_filtered_images. Shards may differ in dtype, so the embeddings are float32."""
+        image_ids, image_paths, image_embeddings = [], [], []
         for shard in self.shards:
-            embedding = shard.get_image_embedding(path)
-            if embedding is not None:
-                return embedding
-        raise ValueError("no such path")
+            shard_ids, shard_paths, shard_embeddings = shard.get_filtered_images(filters)
+            image_ids.extend(shard_ids)
+            image_paths.extend(shard_paths)
+            image_embeddings.append(shard_embeddings.float())
+        if not image_embeddings:
+            return [], [], torch.empty([0, 0])
+        device = image_embeddings[0].device
+        return image_ids, image_paths, torch.cat([e.to(device) for e in image_embeddings], dim=0)
 
     def get_text_embedding(self, text: str) -> torch.Tensor:
-        return self.clip_model.get_text_features(text)
+        return self.get_text_embeddings([text])[0]
+
+    def get_text_embeddings(self, texts: list[str]) -> torch.Tensor:
+        return self.text_embedding_cache.get_text_embeddings(texts)
 
     def search_images(
             self,
@@ -601,56 +1376,150 @@ class ShardedEmbeddingStore(EmbeddingStore):
             progress_callback: Optional[Callable[[float, str], None]] = None,
             return_total_available: bool = False
     ) -> tuple[list[QueryResult], int] | list[QueryResult]:
-        results = []
-        total_available = 0
         if query.sort_order == 'semantic_page':
             raise ValueError("semantic_page sort order is not supported in sharded stores")
 
-        # Temporarily modify query to get all results from each shard
-        original_offset = query.offset
-        original_limit = query.limit
-        query.offset = 0
-        query.limit = original_offset + original_limit
-
-        progress_per_shard = 1.0 / len(self.shards) if self.shards else 1.0
-        for shard_index, shard in enumerate(tqdm(self.shards, leave=False)):
-            def progress_callback_internal(progress, message):
-                if progress_callback:
-                    progress_callback(progress_per_shard * (shard_index + progress),
-                                  f"shard {shard_index}: {message}")
-
-            shard_results, shard_total = shard.search_images(query, progress_callback_internal, return_total_available=True)
-            total_available += shard_total
-            results.extend(shard_results)
-
-        # Restore original query parameters
-        query.offset = original_offset
-        query.limit = original_limit
-
-        # Sort all results by similarity (descending by default)
+        if progress_callback is not None:
+            progress_callback(0, "Computing embeddings")
+        orderings = self._get_cached_search_orderings(query.cursor)
+        if orderings is None:
+            shard_query = self._resolve_query(query)
+            shard_progress = [0.0] * len(self.shards)
+            progress_lock = threading.Lock()
+
+            def search_shard(shard_index: int) -> SearchOrdering | None:
+                def progress_callback_internal(progress, message):
+                    if progress_callback:
+                        with progress_lock:
+                            shard_progress[shard_index] = progress
+                            overall_progress = sum(shard_progress) / len(shard_progress)
+                        progress_callback(overall_progress, f"shard {shard_index}: {message}")
+                return self.shards[shard_index].get_search_ordering(shard_query, progress_callback_internal)
+
+            # shards are searched concurrently; torch releases the GIL while scoring
+            orderings = list(self._search_executor.map(search_shard, range(len(self.shards))))
+
+        # each shard's ordering is sorted already, so a k-way merge of their first offset+limit entries is enough
         ascending_order = query.sort_order == 'similarity_asc' or query.sort_order == 'similarity_max_asc' or query.sort_order == 'similarity_avg_asc'
-        results = sorted(results, key=lambda r: r.similarity, reverse=not ascending_order)
-
-        # Apply pagination to the combined results
-        paginated_results = results[original_offset:original_offset + original_limit]
+        end = query.offset + query.limit
+        shard_entries = [zip(ordering.similarities[:end].tolist(), itertools.repeat(shard_index), ordering.rows[:end].tolist())
+                         for shard_index, ordering in enumerate(orderings) if ordering is not None]
+        merged = heapq.merge(*shard_entries, key=lambda entry: entry[0], reverse=not ascending_order)
+        paginated_results = [QueryResult(similarity=similarity,
+                                         path=self.shards[shard_index].image_paths[row],
+                                         id=self.shards[shard_index].image_ids[row])
+                             for similarity, shard_index, row in itertools.islice(merged, query.offset, end)]
+        total_available = sum(ordering.total_available for ordering in orderings if ordering is not None)
 
+        if progress_callback is not None:
+            progress_callback(1, "Finished")
         if return_total_available:
             return paginated_results, total_available
         else:
             return paginated_results
 
+    def get_search_cursor(self, query: Query) -> str:
+        """
+        See SimpleClipEmbeddingStore.get_search_cursor. Shards cache the result orders of the resolved
+        query, so that is what the cursor identifies.
+        """
+        if self._get_cached_search_orderings(query.cursor) is not None:
+            return query.cursor
+        shard_query = self._resolve_query(query)
+        return self.shards[0].get_search_cursor(shard_query) if self.shards else shard_query.cache_key()
+
+    def _get_cached_search_orderings(self, cursor: str | None) -> list[SearchOrdering] | None:
+        """Every shard's cached result order for `cursor`, or None unless all of them are cached and current."""
+        if cursor is None or not self.shards:
+            return None
+        orderings = [shard.get_cached_search_ordering(cursor) for shard in self.shards]
+        return None if any(ordering is None for ordering in orderings) else orderings
+
+    def _resolve_query(self, query: Query) -> Query:
+        """
+        A copy of `query` with its texts and images replaced by their embeddings, so that shards neither
+        need a clip model nor have to find images that live in other shards.
+        """
+        texts = query.texts or []
+        image_ids = query.image_ids or []
+        vectors = query.embeddings or []
+        if len(query.weights) != len(texts) + len(image_ids) + len(vectors):
+            raise ValueError(f"there must be 1 weight for every embedding, text, or image in the query (got {len(texts) + len(image_ids) + len(vectors)} inputs and {len(query.weights)} weights)")
+        text_weights = query.weights[:len(texts)]
+        image_weights = query.weights[len(texts):len(texts) + len(image_ids)]
+        vector_weights = query.weights[len(texts) + len(image_ids):]
+
+        embeddings = self.get_text_embeddings(texts).tolist() if texts else []
+        weights = list(text_weights)
+        for image_id, weight in zip(image_ids, image_weights):
+            embedding = self._get_image_embedding_for_id(image_id)
+            if embedding is not None:
+                embeddings.append(embedding.tolist())
+                weights.append(weight)
+        embeddings.extend(vectors)
+        weights.extend(vector_weights)
+        return query.model_copy(update=dict(texts=[], image_ids=[], embeddings=embeddings, weights=weights, cursor=None))
+
+    def _get_image_embedding_for_id(self, image_id: str) -> torch.Tensor | None:
+        shard = self._get_shard_for_id(image_id)
+        if shard is None:
+            return None
+        return shard.image_embeddings[int(shard.get_rows_for_ids([image_id])[0])].float()
+
     def has_image(self, path: str) -> bool:
-        for shard in self.shards:
-            if shard.has_image(path):
-                return True
-        return False
+        return self._get_shard_for_path(path) is not None
 
-    def add_images(self, paths: list[str]) -> torch.Tensor:
+    def add_images(self, paths: list[str], **kwargs) -> tuple[list[str], torch.Tensor | None]:
         if self.editable_shard:
-            return self.editable_shard.add_images(paths)
+            return self.editable_shard.add_images(paths, **kwargs)
         else:
             raise RuntimeError("cannot add images, no editable shard set")
 
+    def add_images_recursively(self, root_dir: str, **kwargs) -> int:
+        """See SimpleClipEmbeddingStore.add_images_recursively. The scan manifests are kept next to the editable shard."""
+        if self.editable_shard is None:
+            raise RuntimeError("cannot add images, no editable shard set")
+        return scanner.add_images_recursively(self, root_dir, manifest_file=self.editable_shard.get_scan_manifest_file(root_dir),
+                                              **kwargs)
+
+    def update_images(self, paths: list[str], **kwargs) -> list[str]:
+        """See SimpleClipEmbeddingStore.update_images. Images in read-only shards keep their embeddings."""
+        paths_for_shard: dict[SimpleClipEmbeddingStore, list[str]] = {}
+        for path in paths:
+            shard = self._get_shard_for_path(path)
+            if shard is not None and not shard.is_readonly:
+                paths_for_shard.setdefault(shard, []).append(path)
+        return [path for shard, shard_paths in paths_for_shard.items() for path in shard.update_images(shard_paths, **kwargs)]
+
+    def has_pending_ingestion(self) -> bool:
+        return self.editable_shard is not None and self.editable_shard.has_pending_ingestion()
+
+    def resume_ingestion(self, **kwargs) -> int:
+        return 0 if self.editable_shard is None else self.editable_shard.resume_ingestion(**kwargs)
+
+    def remove_image(self, id: str):
+        shard = self._get_shard_for_id(id)
+        if shard is None:
+            raise ValueError(f"no image with id {id}")
+        path = shard.get_image_path_for_id(id)
+        shard.remove_image(id)
+        self._id_to_shard.pop(id, None)
+        self._path_to_shard.pop(path, None)
+
+    def cleanup_missing_files(self, force=False):
+        for shard in self.shards:
+            if not shard.is_readonly:
+                shard.cleanup_missing_files(force=force)
+
+    def schedule_compaction(self):
+        for shard in self.shards:
+            shard.schedule_compaction()
+
+    def save(self):
+        for shard in self.shards:
+            if shard.store_file is not None:
+                shard.save()
+
 
 def ___recover_natural_case_from_lowercase_paths(paths: list[str]) -> list[str]:
 
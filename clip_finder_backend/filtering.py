@@ -1,21 +1,98 @@
+from dataclasses import dataclass, field
+from typing import Protocol
+
+import numpy as np
+
 from clip_finder_backend.types import ResultFilters
 
 
-def get_included_path_indices(filters: ResultFilters, image_paths: list[str]) -> list[int]:
-    def passes_path_contains_filter(path):
-        if not filters.path_contains:
-            return True
-        return any(fragment in path
-                   for fragment in filters.path_contains)
+class RowFilterable(Protocol):
+    """What a store must provide for a RowFilter to be compiled against it."""
+    image_paths: list[str]
+
+    def get_rows_for_ids(self, image_ids: list[str]) -> np.ndarray:
+        ...
+
+    def get_path_contains_mask(self, fragment: str) -> np.ndarray:
+        ...
+
+    def get_tag_mask(self, tag: str) -> np.ndarray:
+        ...
+
+
+@dataclass(frozen=True)
+class RowFilter:
+    """
+    Row constraints shared by Query and ResultFilters, compiled into one boolean mask over store rows.
+    A row passes if its path contains at least one of `path_contains_any` (when given), none of
+    `path_contains_none`, and it is in `required_image_ids` (when given) but not in `excluded_image_ids`.
+    Its image must also have at least one of `tags_any` (when given), all of `tags_all` and none of `tags_none`.
+    """
+    path_contains_any: tuple[str, ...] = field(default_factory=tuple)
+    path_contains_none: tuple[str, ...] = field(default_factory=tuple)
+    required_image_ids: tuple[str, ...] | None = None
+    excluded_image_ids: tuple[str, ...] = field(default_factory=tuple)
+    tags_any: tuple[str, ...] = field(default_factory=tuple)
+    tags_all: tuple[str, ...] = field(default_factory=tuple)
+    tags_none: tuple[str, ...] = field(default_factory=tuple)
+
+    @staticmethod
+    def from_result_filters(filters: ResultFilters) -> 'RowFilter':
+        return RowFilter(path_contains_any=tuple(f for f in filters.path_contains if f),
+                         path_contains_none=tuple(f for f in filters.path_not_contains if f),
+                         tags_any=tuple(t for t in filters.required_tags_or if t),
+                         tags_all=tuple(t for t in filters.required_tags_and if t),
+                         tags_none=tuple(t for t in filters.excluded_tags if t))
+
+    @property
+    def is_empty(self) -> bool:
+        return (not self.path_contains_any and not self.path_contains_none
+                and self.required_image_ids is None and not self.excluded_image_ids
+                and not self.has_tag_predicates)
+
+    @property
+    def has_tag_predicates(self) -> bool:
+        return bool(self.tags_any or self.tags_all or self.tags_none)
+
+    def compile_mask(self, store: RowFilterable) -> np.ndarray | None:
+        """Boolean mask with one entry per store row, or None if nothing is filtered out."""
+        if self.is_empty:
+            return None
+        num_rows = len(store.image_paths)
+        mask = np.ones(num_rows, dtype=bool)
+
+        if self.path_contains_any:
+            any_mask = np.zeros(num_rows, dtype=bool)
+            for fragment in self.path_contains_any:
+                any_mask |= store.get_path_contains_mask(fragment)
+            mask &= any_mask
+        for fragment in self.path_contains_none:
+            mask &= ~store.get_path_contains_mask(fragment)
+
+        if self.required_image_ids is not None:
+            required_rows = store.get_rows_for_ids(list(self.required_image_ids))
+            required_mask = np.zeros(num_rows, dtype=bool)
+            required_mask[required_rows[required_rows >= 0]] = True
+            mask &= required_mask
+        if self.excluded_image_ids:
+            excluded_rows = store.get_rows_for_ids(list(self.excluded_image_ids))
+            mask[excluded_rows[excluded_rows >= 0]] = False
+
+        if self.tags_any:
+            any_mask = np.zeros(num_rows, dtype=bool)
+            for tag in self.tags_any:
+                any_mask |= store.get_tag_mask(tag)
+            mask &= any_mask
+        for tag in self.tags_all:
+            mask &= store.get_tag_mask(tag)
+        for tag in self.tags_none:
+            mask &= ~store.get_tag_mask(tag)
 
-    def passes_path_not_contains_filter(path):
-        if not filters.path_not_contains:
-            return True
-        return not any(fragment in path
-                        for fragment in filters.path_not_contains)
+        return mask
 
-    def passes_filter(path):
-        return passes_path_contains_filter(path) and passes_path_not_contains_filter(path)
 
-    return [i for i, p in enumerate(image_paths)
-            if passes_filter(p)]
+def get_included_rows(filters: ResultFilters, store: RowFilterable) -> np.ndarray:
+    mask = RowFilter.from_result_filters(filters).compile_mask(store)
+    if mask is None:
+        return np.arange(len(store.image_paths))
+    return np.flatnonzero(mask)
@@ -0,0 +1,175 @@
+"""
+Background indexing of directories while the server keeps answering searches.
+
+Jobs are queued and run one at a time on a dedicated worker thread, through the store's
+add_images_recursively. Each job reports its throughput (images/s) and, once the scan has found
+everything there is to add, an ETA over the progress WebSocket, using the job id as the task id.
+A job can be throttled to `max_images_per_second`, and cancelling one stops it after its current
+batch: whatever was added until then stays in the store.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from typing import Literal
+
+from pydantic import BaseModel
+
+from clip_finder_backend.embedding_store import EmbeddingStore
+from clip_finder_backend.progress_manager import ProgressManager, ProgressStatus
+from clip_finder_backend.thumbnail_provider import ThumbnailProvider
+
+logger = logging.getLogger(__name__)
+
+
+class IndexingJobInfo(BaseModel):
+    job_id: str
+    root_dir: str
+    status: Literal['queued', 'running', 'completed', 'cancelled', 'error']
+    num_processed: int = 0
+    """Images found so far that are new or changed. Final once scan_complete is set."""
+    num_found: int = 0
+    scan_complete: bool = False
+    num_added: int = 0
+    images_per_second: float | None = None
+    eta_seconds: float | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+
+
+class IndexingJob:
+
+    def __init__(self, root_dir: str, job_id: str = None, max_images_per_second: float = None):
+        self.info = IndexingJobInfo(job_id=job_id or f'indexing-{uuid.uuid4()}', root_dir=os.path.abspath(root_dir),
+                                    status='queued')
+        self.max_images_per_second = max_images_per_second
+        self.cancel_event = threading.Event()
+
+    @property
+    def job_id(self) -> str:
+        return self.info.job_id
+
+
+class IndexingJobManager:
+
+    def __init__(self, embedding_store: EmbeddingStore, progress_manager: ProgressManager, batch_size: int = 100,
+                 max_images_per_second: float = None, max_finished_jobs: int = 100,
+                 thumbnail_provider: ThumbnailProvider = None):
+        """
+        `batch_size` is how many images are embedded between progress updates and cancellation checks.
+        `max_images_per_second` is the default throttle for new jobs (None: as fast as possible).
+        With a `thumbnail_provider`, thumbnails of the new images are written while they are indexed.
+        """
+        self.embedding_store = embedding_store
+        self.progress_manager = progress_manager
+        self.thumbnail_provider = thumbnail_provider
+        self.batch_size = batch_size
+        self.max_images_per_second = max_images_per_second
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs: dict[str, IndexingJob] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[IndexingJob] = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='indexing-worker', daemon=True)
+        self._worker.start()
+
+    def start_job(self, root_dir: str, job_id: str = None, max_images_per_second: float = None) -> IndexingJobInfo:
+        if not os.path.isdir(root_dir):
+            raise ValueError(f"not a directory: {root_dir}")
+        job = IndexingJob(root_dir, job_id=job_id, max_images_per_second=max_images_per_second or self.max_images_per_second)
+        with self._lock:
+            if job.job_id in self._jobs:
+                raise ValueError(f"there is already a job with id {job.job_id}")
+            self._jobs[job.job_id] = job
+            self._forget_old_jobs()
+        self.progress_manager.start_task(job.job_id, f"Queued indexing of {job.info.root_dir}")
+        self._queue.put(job)
+        return job.info.model_copy()
+
+    def get_job(self, job_id: str) -> IndexingJobInfo | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job.info.model_copy()
+
+    def list_jobs(self) -> list[IndexingJobInfo]:
+        with self._lock:
+            return [job.info.model_copy() for job in self._jobs.values()]
+
+    def cancel_job(self, job_id: str) -> IndexingJobInfo | None:
+        """Ask a job to stop. A queued job never starts; a running one stops after its current batch."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_event.set()
+            if job.info.status == 'queued':
+                self._finish(job, 'cancelled')
+            return job.info.model_copy()
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.info.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _finish(self, job: IndexingJob, status: str, error: str = None):
+        job.info.status = status
+        job.info.error = error
+        job.info.finished_at = time.time()
+        job.info.eta_seconds = None
+        message = f"Indexed {job.info.root_dir}: added {job.info.num_added} images"
+        if status == 'cancelled':
+            self.progress_manager.complete_task(job.job_id, message + " before being cancelled",
+                                                data=job.info.model_dump(), status=ProgressStatus.CANCELLED)
+        elif status == 'error':
+            self.progress_manager.fail_task(job.job_id, f"Indexing {job.info.root_dir} failed", error_details=error)
+        else:
+            self.progress_manager.complete_task(job.job_id, message, data=job.info.model_dump())
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.cancel_event.is_set():
+                    continue
+                job.info.status = 'running'
+                job.info.started_at = time.time()
+            try:
+                num_added = self.embedding_store.add_images_recursively(
+                    job.info.root_dir, batch_size=self.batch_size, cancel_event=job.cancel_event,
+                    thumbnail_provider=self.thumbnail_provider,
+                    progress_callback=lambda num_processed, num_found, scan_complete:
+                        self._on_progress(job, num_processed, num_found, scan_complete))
+                with self._lock:
+                    job.info.num_added = num_added
+                    self._finish(job, 'cancelled' if job.cancel_event.is_set() else 'completed')
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(f"error indexing {job.info.root_dir}: {repr(e)}")
+                with self._lock:
+                    self._finish(job, 'error', error=repr(e))
+
+    def _on_progress(self, job: IndexingJob, num_processed: int, num_found: int, scan_complete: bool):
+        elapsed = time.time() - job.info.started_at
+        if job.max_images_per_second and num_processed > 0:
+            # wait until the average rate is back at the limit, so searches get the cpu/gpu in between
+            if job.cancel_event.wait(max(0.0, num_processed / job.max_images_per_second - elapsed)):
+                # cancelled while waiting: the scan stops after this batch
+                return
+            elapsed = time.time() - job.info.started_at
+        with self._lock:
+            info = job.info
+            info.num_processed = num_processed
+            info.num_found = num_found
+            info.scan_complete = scan_complete
+            info.images_per_second = num_processed / elapsed if elapsed > 0 else None
+            info.eta_seconds = (num_found - num_processed) / info.images_per_second \
+                if scan_complete and info.images_per_second else None
+        eta = f", about {info.eta_seconds:.0f}s left" if info.eta_seconds is not None else ""
+        self.progress_manager.update_task_progress(
+            job.job_id, 100 * num_processed / max(1, num_found),
+            message=f"Indexing {info.root_dir}: {num_processed} of {num_found}{'' if scan_complete else '+'} images, "
+                    f"{info.images_per_second or 0:.1f} images/s{eta}",
+            data=info.model_dump())
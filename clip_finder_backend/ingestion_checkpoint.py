@@ -0,0 +1,52 @@
+"""
+Checkpoints for large add_images calls on a SimpleClipEmbeddingStore.
+
+Embeddings are committed to the store (and so to its mutation log) in small increments while an
+ingestion runs. The checkpoint only needs to remember which paths were still to be processed, so
+that after a crash or restart the ingestion can be resumed without its caller. Each ingestion
+writes `<store_file>.ingest.<job id>`, rewrites it every `checkpoint_every` images and deletes it
+once done.
+"""
+import glob
+import json
+import os
+import uuid
+
+INGESTION_CHECKPOINT_VERSION = 1
+
+
+class IngestionCheckpoint:
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def create(store_file: str, paths: list[str]) -> 'IngestionCheckpoint':
+        checkpoint = IngestionCheckpoint(f'{store_file}.ingest.{uuid.uuid4().hex[:12]}')
+        checkpoint.save(paths)
+        return checkpoint
+
+    @staticmethod
+    def find(store_file: str) -> list['IngestionCheckpoint']:
+        """The checkpoints of ingestions that did not finish, oldest first."""
+        paths = [p for p in glob.glob(glob.escape(store_file) + '.ingest.*') if not p.endswith('.tmp')]
+        return [IngestionCheckpoint(p) for p in sorted(paths, key=os.path.getmtime)]
+
+    def save(self, remaining_paths: list[str]):
+        """Write atomically."""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': INGESTION_CHECKPOINT_VERSION, 'remaining_paths': remaining_paths}, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> list[str]:
+        """The paths that were still to be processed at the last checkpoint."""
+        with open(self.path) as f:
+            d = json.load(f)
+        if d['version'] != INGESTION_CHECKPOINT_VERSION:
+            raise RuntimeError(f"unrecognized ingestion checkpoint version in {self.path}: {d['version']}")
+        return d['remaining_paths']
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
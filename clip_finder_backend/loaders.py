@@ -1,45 +1,115 @@
 import os
+from pathlib import Path
 from typing import Any
 
+import platformdirs
+
 from clip_finder_backend.clip_modelling import ClipModel, AutoloadingClipModel
 from clip_finder_backend.embedding_store import EmbeddingStore, SimpleClipEmbeddingStore, ShardedEmbeddingStore
+from clip_finder_backend.metadata_backends import make_metadata_backend
+from clip_finder_backend.quantization import QuantizationSettings
+from clip_finder_backend.tags_wrangler import TagsWrangler
+from clip_finder_backend.text_embedding_cache import TextEmbeddingCache
+from clip_finder_backend.thumbnail_provider import ThumbnailProvider
+
+
+def _use_mock_model() -> bool:
+    return os.environ.get("CLIPFINDER_USE_MOCK_CLIP_MODEL", "0") == "1"
+
+
+def _make_model() -> ClipModel:
+    """The configured model, with weights not loaded yet."""
+    model_type = os.environ.get("CLIPFINDER_CLIP_MODEL_TYPE", "MobileCLIP-S1")
+    pretrained = os.environ.get("CLIPFINDER_CLIP_MODEL_PRETRAINED", "datacompdr")
+    weights_pt_path = os.environ.get("CLIPFINDER_CLIP_MODEL_WEIGHTS_PT_PATH", None)
+    decode_workers = os.environ.get("CLIPFINDER_DECODE_WORKERS", None)
+    prefetch_images = os.environ.get("CLIPFINDER_DECODE_PREFETCH_IMAGES", None)
+    return ClipModel(clip_name=model_type, pretrained=pretrained, weights_pt_path=weights_pt_path,
+                     decode_workers=int(decode_workers) if decode_workers else None,
+                     prefetch_images=int(prefetch_images) if prefetch_images else None)
 
 
 def load_model():
-    if os.environ.get("CLIPFINDER_USE_MOCK_CLIP_MODEL", "0") == "1":
+    if _use_mock_model():
         print("using mock clip model because CLIPFINDER_USE_MOCK_CLIP_MODEL=1")
         from clip_finder_backend.mock_clip_model import MockClipModel
         return MockClipModel()
 
-    model_type = os.environ.get("CLIPFINDER_CLIP_MODEL_TYPE", "MobileCLIP-S1")
-    pretrained = os.environ.get("CLIPFINDER_CLIP_MODEL_PRETRAINED", "datacompdr")
-    weights_pt_path = os.environ.get("CLIPFINDER_CLIP_MODEL_WEIGHTS_PT_PATH", None)
-    print("loading model:", model_type, "pretrained:", pretrained, "custom weights:", weights_pt_path)
+    model = _make_model()
+    print("loading model:", model.clip_name, "pretrained:", model.clip_pretrained, "custom weights:", model.clip_weights_pt_path)
     print("Set env vars CLIPFINDER_CLIP_MODEL_TYPE, CLIPFINDER_CLIP_MODEL_PRETRAINED, CLIPFINDER_CLIP_MODEL_WEIGHTS_PT_PATH to change")
-    from clip_finder_backend.clip_modelling import ClipModel
-    return ClipModel(clip_name=model_type, pretrained=pretrained, weights_pt_path=weights_pt_path).load_model()
+    return model.load_model()
+
+
+def load_text_embedding_cache(clip_model: ClipModel) -> TextEmbeddingCache:
+    cache_file = os.environ.get("CLIPFINDER_TEXT_EMBEDDING_CACHE_FILE", None)
+    if cache_file is None:
+        cache_dir = Path(platformdirs.user_cache_dir("clipfinder3"))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = str(cache_dir / "text_embeddings.pt")
+    identifier = 'mock' if _use_mock_model() else _make_model().distinct_identifier
+    print(f"loading text embedding cache from {cache_file}")
+    return TextEmbeddingCache(clip_model, cache_file=cache_file, identifier=identifier)
+
+
+def load_quantization_settings() -> QuantizationSettings | None:
+    kind = os.environ.get("CLIPFINDER_EMBEDDING_QUANTIZATION", None)
+    if kind is None:
+        return None
+    settings = QuantizationSettings(kind=kind, sign_prefilter=os.environ.get("CLIPFINDER_SIGN_PREFILTER", "0") == "1")
+    print(f"searching {kind} embeddings because CLIPFINDER_EMBEDDING_QUANTIZATION={kind}"
+          f"{' with a sign prefilter' if settings.sign_prefilter else ''}")
+    return settings
 
 
-def load_simple_embedding_store(clip_model: ClipModel) -> EmbeddingStore:
+def load_simple_embedding_store(clip_model: ClipModel, text_embedding_cache: TextEmbeddingCache = None) -> EmbeddingStore:
     base_store_file = os.environ.get("CLIPFINDER_EMBEDDING_STORE_FILE", None)
     if base_store_file is None:
         raise RuntimeError("env var CLIPFINDER_EMBEDDING_STORE_FILE must point to a path to load the base embedding store")
     print(f"loading embedding store from {base_store_file}")
-    return SimpleClipEmbeddingStore(clip_model=clip_model, store_file=base_store_file, store_device='mps')
+    return SimpleClipEmbeddingStore(clip_model=clip_model, store_file=base_store_file, store_device='mps',
+                                    text_embedding_cache=text_embedding_cache, quantization=load_quantization_settings(),
+                                    hash_algorithm=os.environ.get("CLIPFINDER_CONTENT_HASH", "md5"))
 
 def load_embedding_store():
     clip_model: Any = AutoloadingClipModel(load_model=load_model)
+    text_embedding_cache = load_text_embedding_cache(clip_model)
     if os.environ.get("CLIPFINDER_USE_SHARDS", "0") == "1":
         print("using sharded embedding store because CLIPFINDER_USE_SHARDS=1")
         root = os.environ.get("CLIPFINDER_SHARDS_ROOT", None)
         if root is None:
             raise ValueError("env var CLIPFINDER_SHARDS_ROOT must be set to use sharded embedding store")
         print("loading sharded embedding store from", root)
-        sharded_embedding_store = ShardedEmbeddingStore.from_weaviate_dump_chunks(clip_model=None, chunks_folder=root,
-                                                    shard_size=5 * 100_000, store_device='mps')
+        sharded_embedding_store = ShardedEmbeddingStore.from_weaviate_dump_chunks(clip_model=clip_model, chunks_folder=root,
+                                                    shard_size=5 * 100_000, store_device='mps',
+                                                    text_embedding_cache=text_embedding_cache,
+                                                    quantization=load_quantization_settings(),
+                                                    native_folder=os.environ.get("CLIPFINDER_SHARDS_NATIVE_FOLDER", None))
         if os.environ.get("CLIPFINDER_SHARDS_ADD_BASE", "0") == "1":
-            base_shard = load_simple_embedding_store(clip_model=clip_model)
+            base_shard = load_simple_embedding_store(clip_model=clip_model, text_embedding_cache=text_embedding_cache)
             sharded_embedding_store.add_shard(base_shard, editable=True)
         return sharded_embedding_store
     else:
-        return load_simple_embedding_store(clip_model=clip_model)
+        return load_simple_embedding_store(clip_model=clip_model, text_embedding_cache=text_embedding_cache)
+
+
+def load_thumbnail_provider() -> ThumbnailProvider:
+    max_cache_bytes = os.environ.get("CLIPFINDER_THUMBNAIL_CACHE_BYTES", None)
+    if max_cache_bytes is None:
+        return ThumbnailProvider()
+    print(f"limiting the thumbnail cache to {int(max_cache_bytes)} bytes because CLIPFINDER_THUMBNAIL_CACHE_BYTES is set")
+    return ThumbnailProvider(max_cache_bytes=int(max_cache_bytes))
+
+
+def load_tags_wrangler(embedding_store: EmbeddingStore) -> TagsWrangler:
+    backend = make_metadata_backend(os.environ.get("CLIPFINDER_TAGS_BACKEND", None))
+    index_file = os.environ.get("CLIPFINDER_TAG_INDEX_FILE", None)
+    if index_file is None:
+        cache_dir = Path(platformdirs.user_cache_dir("clipfinder3"))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        index_file = str(cache_dir / f"tag_index.{backend.name}.pkl")
+    print(f"reading tags through the {backend.name} metadata backend (set CLIPFINDER_TAGS_BACKEND to change), "
+          f"indexed in {index_file}")
+    tags_wrangler = TagsWrangler(lambda: embedding_store.image_paths, backend=backend, index_file=index_file)
+    embedding_store.add_rows_listener(tags_wrangler.on_rows_added)
+    return tags_wrangler
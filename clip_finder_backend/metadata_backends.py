@@ -0,0 +1,140 @@
+"""
+Where image tags are read from and written to.
+
+- 'osx': Finder tags, through osxmetadata (macOS only).
+- 'xattr': the `user.xdg.tags` extended attribute, a comma separated list as used by KDE/Baloo
+  (Linux, on filesystems with user xattrs).
+- 'sidecar': a `<image>.tags.json` file next to each image holding a JSON list. Works anywhere.
+
+Backends also report a change marker per file, so that the tag index only re-reads the tags of
+files whose metadata may have changed. Tag writes through xattrs change a file's ctime but not
+its mtime, so the marker includes both.
+"""
+import errno
+import json
+import os
+import sys
+from typing import Protocol
+
+
+class MetadataBackend(Protocol):
+    name: str
+
+    def get_tags(self, path: str) -> list[str] | None:
+        """The tags of the image at `path`, or None if it doesn't exist."""
+        ...
+
+    def set_tags(self, path: str, tags: list[str]):
+        ...
+
+    def get_change_marker(self, path: str) -> tuple[int, int] | None:
+        """Changes whenever the tags of `path` may have changed. None if it doesn't exist."""
+        ...
+
+
+def _stat_marker(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_ctime_ns
+
+
+class OSXMetadataBackend:
+    name = 'osx'
+
+    def __init__(self):
+        # only importable on macOS
+        import osxmetadata
+        self._osxmetadata = osxmetadata
+
+    def get_tags(self, path: str) -> list[str] | None:
+        try:
+            md = self._osxmetadata.OSXMetaData(path)
+            return [t.name for t in md.tags]
+        except FileNotFoundError:
+            return None
+
+    def set_tags(self, path: str, tags: list[str]):
+        md = self._osxmetadata.OSXMetaData(path)
+        existing = {t.name: t for t in md.tags}
+        # keep the colors of tags that are already set
+        md.tags = [existing.get(name) or self._osxmetadata.Tag(name=name, color=self._osxmetadata.FINDER_COLOR_NONE)
+                   for name in tags]
+
+    def get_change_marker(self, path: str) -> tuple[int, int] | None:
+        return _stat_marker(path)
+
+
+# what getxattr fails with when a file has no such attribute (ENOATTR is the BSD/macOS name)
+_NO_ATTRIBUTE_ERRNOS = {getattr(errno, name) for name in ('ENODATA', 'ENOATTR') if hasattr(errno, name)}
+
+
+class XattrMetadataBackend:
+    name = 'xattr'
+    attribute = 'user.xdg.tags'
+
+    def get_tags(self, path: str) -> list[str] | None:
+        try:
+            value = os.getxattr(path, self.attribute)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            if e.errno not in _NO_ATTRIBUTE_ERRNOS:
+                # e.g. ENOTSUP or EACCES: the tags can't be read, which is not the same as having none
+                raise
+            return []
+        return [t for t in value.decode('utf-8').split(',') if t]
+
+    def set_tags(self, path: str, tags: list[str]):
+        if tags:
+            os.setxattr(path, self.attribute, ','.join(tags).encode('utf-8'))
+        elif self.get_tags(path):
+            os.removexattr(path, self.attribute)
+
+    def get_change_marker(self, path: str) -> tuple[int, int] | None:
+        return _stat_marker(path)
+
+
+class SidecarMetadataBackend:
+    name = 'sidecar'
+
+    @staticmethod
+    def sidecar_path(path: str) -> str:
+        return f'{path}.tags.json'
+
+    def get_tags(self, path: str) -> list[str] | None:
+        try:
+            with open(self.sidecar_path(path)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return [] if os.path.exists(path) else None
+
+    def set_tags(self, path: str, tags: list[str]):
+        sidecar_path = self.sidecar_path(path)
+        if not tags:
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+            return
+        tmp_path = f'{sidecar_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(tags, f)
+        os.replace(tmp_path, sidecar_path)
+
+    def get_change_marker(self, path: str) -> tuple[int, int] | None:
+        if not os.path.exists(path):
+            return None
+        # the image itself doesn't change when its tags do
+        return _stat_marker(self.sidecar_path(path)) or (0, 0)
+
+
+def make_metadata_backend(name: str = None) -> MetadataBackend:
+    """The backend called `name`; by default Finder tags on macOS and xattrs elsewhere."""
+    name = name or ('osx' if sys.platform == 'darwin' else 'xattr')
+    if name == 'osx':
+        return OSXMetadataBackend()
+    elif name == 'xattr':
+        return XattrMetadataBackend()
+    elif name == 'sidecar':
+        return SidecarMetadataBackend()
+    raise ValueError(f"unknown metadata backend: {name}")
@@ -0,0 +1,100 @@
+"""
+Append-only mutation log for SimpleClipEmbeddingStore.
+
+Mutations (added texts, added images, removals, id changes) are appended to numbered log
+segments next to the store file (`<store_file>.log.000000`, ...) instead of rewriting the whole
+store. On load the segments are replayed on top of the last snapshot; a background compaction
+later folds them into a new snapshot and deletes them.
+
+Each record is framed as <length, crc32, pickled (kind, payload)>, so a record torn by a crash
+is detected and dropped at replay time instead of corrupting the store.
+"""
+import glob
+import os
+import pickle
+import re
+import struct
+import threading
+import zlib
+from typing import Any, Generator
+
+_FRAME_HEADER = struct.Struct('<II')
+
+
+class MutationLog:
+
+    def __init__(self, store_file: str, fsync: bool = True):
+        self.store_file = store_file
+        self.fsync = fsync
+        self._file = None
+        self._segment: int | None = None
+        self._lock = threading.Lock()
+        self.bytes_written = 0
+
+    def segment_path(self, segment: int) -> str:
+        return f'{self.store_file}.log.{segment:06d}'
+
+    def existing_segments(self) -> list[int]:
+        pattern = re.compile(re.escape(self.store_file) + r'\.log\.(\d{6})$')
+        matches = [pattern.match(p) for p in glob.glob(glob.escape(self.store_file) + '.log.*')]
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    @property
+    def current_segment(self) -> int | None:
+        return self._segment
+
+    def replay(self, first_segment: int) -> Generator[tuple[str, dict[str, Any]], None, None]:
+        """Yield (kind, payload) for every intact record in segments >= first_segment, in order."""
+        for segment in self.existing_segments():
+            if segment < first_segment:
+                continue
+            path = self.segment_path(segment)
+            with open(path, 'rb') as f:
+                while True:
+                    frame_header = f.read(_FRAME_HEADER.size)
+                    if len(frame_header) == 0:
+                        break
+                    if len(frame_header) < _FRAME_HEADER.size:
+                        print(f'ignoring torn record at the end of {path}')
+                        break
+                    length, crc = _FRAME_HEADER.unpack(frame_header)
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) != crc:
+                        print(f'ignoring torn record at the end of {path}')
+                        break
+                    yield pickle.loads(data)
+
+    def start_new_segment(self) -> int:
+        """Close the current segment and direct further appends to a fresh one. Returns its number."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            existing = self.existing_segments()
+            last = max(existing + ([self._segment] if self._segment is not None else []), default=-1)
+            self._segment = last + 1
+            self._file = open(self.segment_path(self._segment), 'ab')
+            self.bytes_written = 0
+            return self._segment
+
+    def append(self, kind: str, payload: dict[str, Any]):
+        data = pickle.dumps((kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("MutationLog.start_new_segment() must be called before append()")
+            self._file.write(_FRAME_HEADER.pack(len(data), zlib.crc32(data)))
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.bytes_written += _FRAME_HEADER.size + len(data)
+
+    def remove_segments_before(self, segment: int):
+        for existing in self.existing_segments():
+            if existing < segment:
+                os.remove(self.segment_path(existing))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -3,12 +3,16 @@ Progress Manager for WebSocket-based status and progress reporting.
 Runs in a separate thread to deliver real-time updates to connected clients.
 """
 import asyncio
+import heapq
+import itertools
 import json
+import math
 import threading
 import time
 import traceback
 from asyncio import AbstractEventLoop
-from typing import Dict, List, Optional, Any
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Any
 from dataclasses import dataclass, asdict
 from enum import Enum
 from fastapi import WebSocket
@@ -25,6 +29,9 @@ class ProgressStatus(Enum):
     CANCELLED = "cancelled"
 
 
+FINAL_STATUSES = (ProgressStatus.COMPLETED, ProgressStatus.ERROR, ProgressStatus.CANCELLED)
+
+
 @dataclass
 class ProgressMessage:
     """Represents a progress update message"""
@@ -43,75 +50,192 @@ class ProgressMessage:
             self.timestamp = time.time()
 
 
+class _TimerQueue:
+    """Runs callbacks after a delay, all on one thread, instead of a sleeping thread per callback."""
+
+    def __init__(self, name: str):
+        self._heap: list[tuple[float, int, Callable[[], None]]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def schedule(self, delay: float, callback: Callable[[], None]):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), callback))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(timeout=self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            try:
+                callback()
+            except Exception:
+                logger.exception("error in progress manager timer")
+
+
+class _Connection:
+    """
+    A WebSocket and the messages waiting to be sent to it. Only the latest progress update of each task
+    waits; a newer one replaces it, so a slow client gets fewer updates rather than a growing backlog.
+    Each message is sent with a timeout, and a client that falls behind is disconnected.
+    """
+
+    def __init__(self, websocket: WebSocket, loop: AbstractEventLoop, send_timeout: float, max_waiting: int,
+                 on_error: Callable[['_Connection'], None]):
+        self.websocket = websocket
+        self.loop = loop
+        self.send_timeout = send_timeout
+        self.max_waiting = max_waiting
+        self._on_error = on_error
+        self._waiting: OrderedDict[tuple[str, ProgressStatus], str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._sending = False
+
+    def post(self, message: ProgressMessage, text: str):
+        """Queue `text`, the serialized `message`, without waiting for it to be sent."""
+        with self._lock:
+            if message.status in FINAL_STATUSES:
+                # an update that hasn't gone out yet must not arrive after the final state
+                self._waiting.pop((message.task_id, ProgressStatus.IN_PROGRESS), None)
+            self._waiting[(message.task_id, message.status)] = text
+            if len(self._waiting) > self.max_waiting:
+                logger.warning(f"WebSocket has {len(self._waiting)} messages waiting, disconnecting it")
+                self._waiting.clear()
+                overflowed = True
+            else:
+                overflowed = False
+                start_sending = not self._sending
+                self._sending = True
+        if overflowed:
+            self._on_error(self)
+        elif start_sending:
+            try:
+                asyncio.run_coroutine_threadsafe(self._send_waiting(), self.loop)
+            except RuntimeError as e:
+                # the connection's event loop is closed
+                logger.error(f"Error sending message to WebSocket: {e}")
+                self._on_error(self)
+
+    async def _send_waiting(self):
+        while True:
+            with self._lock:
+                if not self._waiting:
+                    self._sending = False
+                    return
+                _, text = self._waiting.popitem(last=False)
+            try:
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=self.send_timeout)
+            except Exception as e:
+                logger.error(f"Error sending message to WebSocket: {repr(e)}")
+                with self._lock:
+                    self._waiting.clear()
+                    self._sending = False
+                self._on_error(self)
+                return
+
+
 class ProgressManager:
     """
     Manages WebSocket connections and broadcasts progress messages.
+
+    Progress updates of a task are sent at most every `min_update_interval` seconds: updates in between
+    are coalesced, and the latest one is sent when the interval is up. Start and final states are always
+    sent right away. Each message is serialized once for all connections. Finished tasks are forgotten
+    `keep_finished_seconds` after they finish.
     """
 
-    def __init__(self):
-        self.connections: List[WebSocket, AbstractEventLoop] = []  # List of WebSocket connections
+    def __init__(self, min_update_interval: float = 0.1, keep_finished_seconds: float = 2,
+                 send_timeout: float = 10, max_waiting_messages: int = 1000):
+        self.connections: List[_Connection] = []
         self.active_tasks: Dict[str, ProgressMessage] = {}
-        self._lock = threading.Lock()
+        self.min_update_interval = min_update_interval
+        self.keep_finished_seconds = keep_finished_seconds
+        self.send_timeout = send_timeout
+        self.max_waiting_messages = max_waiting_messages
+        # reentrant, because a connection that fails while a message is being broadcast removes itself
+        self._lock = threading.RLock()
+        self._last_broadcast: Dict[str, float] = {}
+        self._coalesced: Dict[str, ProgressMessage] = {}
+        self._timers = _TimerQueue(name='progress-timers')
 
     def add_connection(self, websocket, loop: asyncio.AbstractEventLoop):
         """Add a new WebSocket connection"""
+        connection = _Connection(websocket, loop, send_timeout=self.send_timeout,
+                                 max_waiting=self.max_waiting_messages, on_error=self._remove_connection)
         with self._lock:
-            self.connections.append((websocket, loop))
+            self.connections.append(connection)
             logger.info(f"Added WebSocket connection. Total connections: {len(self.connections)}")
 
-        # Send current active tasks to the new connection
-        for task_id, progress_msg in self.active_tasks.items():
-            print("new connection: sending existing task", task_id, progress_msg)
-            self._send_to_connection(websocket, progress_msg, loop)
-
+            # Send current active tasks to the new connection
+            for task_id, progress_msg in self.active_tasks.items():
+                connection.post(progress_msg, self._serialize(progress_msg))
 
     def remove_connection(self, websocket):
         """Remove a WebSocket connection"""
         with self._lock:
-            index = next((i for i, (ws, _) in enumerate(self.connections) if ws == websocket), None)
-            if index:
-                del self.connections[index]
+            connection = next((c for c in self.connections if c.websocket == websocket), None)
+            if connection is not None:
+                self._remove_connection(connection)
+
+    def _remove_connection(self, connection: _Connection):
+        with self._lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
                 logger.info(f"Removed WebSocket connection. Total connections: {len(self.connections)}")
 
-    def _send_to_connection(self, websocket: WebSocket, message: ProgressMessage, loop: AbstractEventLoop):
-        """Send a message to a specific WebSocket connection"""
-        try:
-            message_dict = asdict(message)
-            message_dict['status'] = message.status.value
-            asyncio.run_coroutine_threadsafe(
-                websocket.send_text(json.dumps(message_dict)),
-                loop
-            )
-            #print("ProgressManager _send_to_connection sent", message)
-        except Exception as e:
-            logger.error(f"Error sending message to WebSocket: {e}")
-            # Remove the connection if it's broken
-            self.remove_connection(websocket),
+    @staticmethod
+    def _serialize(message: ProgressMessage) -> str:
+        message_dict = asdict(message)
+        message_dict['status'] = message.status.value
+        return json.dumps(message_dict)
 
     def _broadcast_message(self, message: ProgressMessage):
-        """Broadcast a message to all connected WebSocket clients"""
-        #rint(f"ProgressManager about to broadcast. num_connections: {self.connections}", message)
+        """Serialize a message once and queue it for all connected WebSocket clients"""
         if not self.connections:
             return
-
+        text = self._serialize(message)
         # Create a copy of connections to avoid modification during iteration
-        connections_copy = list(self.connections)
-
-        for websocket, loop in connections_copy:
-            self._send_to_connection(websocket, message, loop)
-        #print("ProgressManager broadcast done", message)
+        for connection in list(self.connections):
+            connection.post(message, text)
 
     def send_progress_update(self, message: ProgressMessage):
         """
         Send a progress update from any thread.
         This method is thread-safe and can be called from the main application thread.
         """
-        # Store the task state
+        task_id = message.task_id
         with self._lock:
-            self.active_tasks[message.task_id] = message
+            # Store the task state
+            self.active_tasks[task_id] = message
+            if message.status == ProgressStatus.IN_PROGRESS:
+                delay = self._last_broadcast.get(task_id, -math.inf) + self.min_update_interval - time.monotonic()
+                if delay > 0:
+                    if task_id not in self._coalesced:
+                        self._timers.schedule(delay, lambda: self._send_coalesced(task_id))
+                    self._coalesced[task_id] = message
+                    return
+            else:
+                self._coalesced.pop(task_id, None)
+            self._last_broadcast[task_id] = time.monotonic()
+            # under the lock, so that a coalesced update can't be queued after the task's final state
+            self._broadcast_message(message)
 
-        # Schedule the broadcast in the event loop
-        self._broadcast_message(message)
+    def _send_coalesced(self, task_id: str):
+        with self._lock:
+            message = self._coalesced.pop(task_id, None)
+            if message is not None:
+                self._last_broadcast[task_id] = time.monotonic()
+                self._broadcast_message(message)
+
+    def _forget_task(self, task_id: str, message: ProgressMessage):
+        with self._lock:
+            # unless the task id was reused in the meantime
+            if self.active_tasks.get(task_id) is message:
+                del self.active_tasks[task_id]
+                self._last_broadcast.pop(task_id, None)
 
     def start_task(self, task_id: str, message: str = "", total_steps: Optional[int] = None):
         """Convenience method to start tracking a task"""
@@ -154,18 +278,13 @@ class ProgressManager:
         )
         self.send_progress_update(progress_msg)
 
-        # Remove from active tasks after a delay
-        def cleanup():
-            time.sleep(2)  # Keep completed status visible for 2 seconds
-            with self._lock:
-                self.active_tasks.pop(task_id, None)
-
-        threading.Thread(target=cleanup, daemon=True).start()
+        # Keep completed status visible for a little while
+        self._timers.schedule(self.keep_finished_seconds, lambda: self._forget_task(task_id, progress_msg))
 
     def fail_task(self, task_id: str, message: str = "", error_details: Optional[str] = None):
         """Convenience method to mark a task as errored"""
         self.complete_task(
             task_id,
             status=ProgressStatus.ERROR,
-            message=f'{message}\nError details: {error_details or ''}')
+            message=f'{message}\nError details: {error_details or ""}')
 
@@ -0,0 +1,195 @@
+"""
+Compact copies of a store's image embeddings for scanning: float16, or int8 with one scale per
+vector, plus an optional 1-bit sign code per dimension used as a prefilter.
+
+The store keeps its full precision embeddings as well, memory-mapped from the snapshot so that
+only the rows that are actually touched get paged in. Searches scan the compact copy in blocks
+with fp32 accumulation, and then optionally re-score the best rows against the full precision
+embeddings.
+
+Measure the recall cost on an existing store with:
+    python -m clip_finder_backend.quantization <store_file>
+"""
+import argparse
+import copy
+from dataclasses import dataclass
+from typing import Literal
+
+import numpy as np
+import torch
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+@dataclass(frozen=True)
+class QuantizationSettings:
+    kind: Literal['float16', 'int8'] = 'int8'
+    """Keep 1 sign bit per dimension and only score the `prefilter_candidates` rows closest in Hamming distance"""
+    sign_prefilter: bool = False
+    prefilter_candidates: int = 50_000
+    """Re-score this many of the best rows against the full precision embeddings (0 to disable)"""
+    rescore_top_k: int = 1000
+
+
+class QuantizedEmbeddings:
+
+    def __init__(self, settings: QuantizationSettings, embedding_dim: int, device='cpu', block_size: int = 65536):
+        if settings.kind not in ('float16', 'int8'):
+            raise ValueError(f"unsupported quantization kind: {settings.kind}")
+        self.settings = settings
+        self.device = device
+        self.block_size = block_size
+        value_dtype = torch.float16 if settings.kind == 'float16' else torch.int8
+        self.values = torch.empty([0, embedding_dim], dtype=value_dtype, device=device)
+        self.scales = torch.empty([0], dtype=torch.float32, device=device)
+        self.sign_bits = np.empty([0, (embedding_dim + 7) // 8], dtype=np.uint8)
+
+    @staticmethod
+    def from_embeddings(embeddings: torch.Tensor, settings: QuantizationSettings, device='cpu') -> 'QuantizedEmbeddings':
+        quantized = QuantizedEmbeddings(settings, embedding_dim=embeddings.shape[1], device=device)
+        quantized.add(embeddings)
+        return quantized
+
+    @property
+    def num_rows(self) -> int:
+        return self.values.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return (self.values.numel() * self.values.element_size() + self.scales.numel() * self.scales.element_size()
+                + self.sign_bits.nbytes)
+
+    def snapshot(self) -> 'QuantizedEmbeddings':
+        """A copy that later adds, replacements and removals don't affect, for searching without the store's lock."""
+        return copy.copy(self)
+
+    def add(self, embeddings: torch.Tensor):
+        """Append `embeddings` as the next rows."""
+        values, scales, sign_bits = [self.values], [self.scales], [self.sign_bits]
+        for start in range(0, embeddings.shape[0], self.block_size):
+            block = embeddings[start:start + self.block_size].to('cpu', dtype=torch.float32)
+            if self.settings.kind == 'int8':
+                scale = block.abs().amax(dim=1).clamp(min=1e-12) / 127
+                values.append(torch.round(block / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8).to(self.device))
+                scales.append(scale.to(self.device))
+            else:
+                values.append(block.to(self.device, dtype=torch.float16))
+            if self.settings.sign_prefilter:
+                sign_bits.append(np.packbits(block.numpy() > 0, axis=1))
+        self.values = torch.cat(values)
+        if self.settings.kind == 'int8':
+            self.scales = torch.cat(scales)
+        if self.settings.sign_prefilter:
+            self.sign_bits = np.concatenate(sign_bits)
+
+    def replace_rows(self, rows: np.ndarray, embeddings: torch.Tensor):
+        """Follow an update in place in the store: `rows` now hold `embeddings`."""
+        replacement = QuantizedEmbeddings.from_embeddings(embeddings, self.settings, device=self.device)
+        rows_tensor = torch.from_numpy(rows).to(self.device)
+        self.values = self.values.index_put((rows_tensor,), replacement.values)
+        if self.settings.kind == 'int8':
+            self.scales = self.scales.index_put((rows_tensor,), replacement.scales)
+        if self.settings.sign_prefilter:
+            sign_bits = self.sign_bits.copy()
+            sign_bits[rows] = replacement.sign_bits
+            self.sign_bits = sign_bits
+
+    def keep_rows(self, keep_indices: np.ndarray):
+        """Follow a row removal in the store: keep only `keep_indices`, renumbered from 0."""
+        keep = torch.from_numpy(keep_indices).to(self.device)
+        self.values = self.values[keep]
+        if self.settings.kind == 'int8':
+            self.scales = self.scales[keep]
+        if self.settings.sign_prefilter:
+            self.sign_bits = self.sign_bits[keep_indices]
+
+    def scores(self, vectors: torch.Tensor, rows: torch.Tensor | None = None) -> torch.Tensor:
+        """Approximate `vectors @ embeddings.T` ([k, d] -> [k, num_rows]) over all rows or only `rows`."""
+        vectors = vectors.to(self.device, dtype=torch.float32)
+        num_rows = self.num_rows if rows is None else rows.shape[0]
+        result = torch.empty([vectors.shape[0], num_rows], dtype=torch.float32, device=self.device)
+        for start in range(0, num_rows, self.block_size):
+            block_rows = slice(start, start + self.block_size) if rows is None else rows[start:start + self.block_size].to(self.device)
+            # only one block is ever widened to fp32 at a time
+            block_scores = torch.matmul(vectors, self.values[block_rows].to(torch.float32).T)
+            if self.settings.kind == 'int8':
+                block_scores *= self.scales[block_rows]
+            result[:, start:start + self.block_size] = block_scores
+        return result
+
+    def prefilter(self, vectors: torch.Tensor, row_mask: np.ndarray | None = None) -> torch.Tensor | None:
+        """
+        Rows (cpu int64, ascending) whose sign codes are closest to any of `vectors`, or None if the
+        prefilter is disabled or would not rule anything out.
+        """
+        num_candidates = self.settings.prefilter_candidates
+        if not self.settings.sign_prefilter or self.num_rows <= num_candidates:
+            return None
+        query_bits = np.packbits(vectors.to('cpu', dtype=torch.float32).numpy() > 0, axis=1)
+        distances = np.full(self.num_rows, np.iinfo(np.uint16).max, dtype=np.uint16)
+        for start in range(0, self.num_rows, self.block_size):
+            block = self.sign_bits[start:start + self.block_size]
+            for bits in query_bits:
+                block_distances = _POPCOUNT[np.bitwise_xor(block, bits)].sum(axis=1, dtype=np.uint16)
+                np.minimum(distances[start:start + self.block_size], block_distances,
+                           out=distances[start:start + self.block_size])
+        if row_mask is not None:
+            distances[~row_mask] = np.iinfo(np.uint16).max
+            num_candidates = min(num_candidates, int(row_mask.sum()))
+            if num_candidates == 0:
+                return torch.empty([0], dtype=torch.int64)
+        candidates = np.argpartition(distances, num_candidates - 1)[:num_candidates]
+        return torch.from_numpy(np.sort(candidates))
+
+
+def measure_recall(embeddings: torch.Tensor, settings: QuantizationSettings, num_queries: int = 100, k: int = 100,
+                   seed: int = 0) -> dict[str, float]:
+    """
+    Recall@k of quantized search against exact search, using randomly chosen corpus rows as queries.
+    Returns the recall with and without exact re-scoring, and the memory used per vector.
+    """
+    embeddings = embeddings.to(torch.float32)
+    quantized = QuantizedEmbeddings.from_embeddings(embeddings, settings)
+    generator = torch.Generator().manual_seed(seed)
+    queries = embeddings[torch.randint(embeddings.shape[0], (num_queries,), generator=generator)]
+    k = min(k, embeddings.shape[0])
+
+    recall = 0.0
+    rescored_recall = 0.0
+    for query in queries:
+        exact = set(torch.topk(embeddings @ query, k).indices.tolist())
+        candidate_rows = quantized.prefilter(query.unsqueeze(0))
+        approximate_scores = quantized.scores(query.unsqueeze(0), candidate_rows)[0]
+        top = torch.topk(approximate_scores, min(max(k, settings.rescore_top_k), approximate_scores.shape[0])).indices
+        top_rows = top if candidate_rows is None else candidate_rows[top]
+        recall += len(exact & set(top_rows[:k].tolist())) / k
+        rescored = top_rows[torch.topk(embeddings[top_rows] @ query, k).indices]
+        rescored_recall += len(exact & set(rescored.tolist())) / k
+    return {
+        'recall': recall / num_queries,
+        'rescored_recall': rescored_recall / num_queries,
+        'bytes_per_vector': quantized.nbytes / quantized.num_rows,
+    }
+
+
+if __name__ == '__main__':
+    from clip_finder_backend.store_format import is_native_store_file, read_native_store
+
+    parser = argparse.ArgumentParser(description="Measure the recall of quantized search on an embedding store")
+    parser.add_argument('store_file')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=100)
+    args = parser.parse_args()
+
+    if is_native_store_file(args.store_file):
+        store_embeddings = read_native_store(args.store_file)['image_embeddings']
+    else:
+        store_embeddings = torch.load(args.store_file)['image_embeddings']
+    print(f'full precision: {store_embeddings.shape[1] * store_embeddings.element_size()} bytes per vector')
+    for settings in [QuantizationSettings(kind='float16'),
+                     QuantizationSettings(kind='int8'),
+                     QuantizationSettings(kind='int8', sign_prefilter=True,
+                                          prefilter_candidates=max(args.k, store_embeddings.shape[0] // 10))]:
+        result = measure_recall(store_embeddings, settings, num_queries=args.queries, k=args.k)
+        print(f"{settings}: recall@{args.k} {result['recall']:.4f}, with re-scoring {result['rescored_recall']:.4f}, "
+              f"{result['bytes_per_vector']:.1f} bytes per vector")
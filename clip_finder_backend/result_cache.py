@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+import torch
+
+from clip_finder_backend.single_flight import SingleFlight
+
+
+@dataclass
+class SearchOrdering:
+    """The full result order for one query: store rows best-first, with their similarities."""
+    rows: torch.Tensor
+    similarities: torch.Tensor
+    total_available: int
+
+    @property
+    def nbytes(self) -> int:
+        return (self.rows.element_size() * self.rows.nelement()
+                + self.similarities.element_size() * self.similarities.nelement())
+
+
+class ResultOrderCache:
+    """
+    LRU cache of SearchOrderings keyed on the normalized query (without offset/limit), bounded by
+    memory. Identical searches that arrive while one is being computed share that computation.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, SearchOrdering] = OrderedDict()
+        self._total_bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str) -> SearchOrdering | None:
+        with self._lock:
+            ordering = self._entries.get(key)
+            if ordering is not None:
+                self._entries.move_to_end(key)
+            return ordering
+
+    def get_or_compute(self, key: str, compute: Callable[[], SearchOrdering | None]) -> SearchOrdering | None:
+        ordering = self.get(key)
+        if ordering is not None:
+            return ordering
+
+        def compute_and_put():
+            with self._lock:
+                generation = self._generation
+            computed = compute()
+            if computed is not None:
+                self._put(key, computed, generation)
+            return computed
+
+        return self._single_flight.do((key, self._generation), compute_and_put)
+
+    def invalidate(self):
+        """Drop all entries. Computations already running will not be cached."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _put(self, key: str, ordering: SearchOrdering, generation: int):
+        if ordering.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation:
+                # the store changed while this was being computed
+                return
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = ordering
+            self._total_bytes += ordering.nbytes
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.nbytes
@@ -0,0 +1,238 @@
+"""
+Incremental directory scanning for add_images_recursively.
+
+A ScanManifest remembers the (size, mtime_ns, inode) of every file seen under a root, and whether it
+looked like an image. Directories are listed with os.scandir on a thread pool, and only files that
+are new or whose stat changed are opened at all. Image-ness is checked by file signature instead of
+decoding. New and changed images are yielded as they are found, so embedding can start before the
+scan finishes.
+"""
+import hashlib
+import os
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Generator, NamedTuple, Optional
+
+MANIFEST_VERSION = 1
+_SCAN_COMPLETE = object()
+
+
+class FileState(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+    is_image: bool
+
+
+def looks_like_image(path: str) -> bool:
+    """Check the file signature for the image formats we can decode."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(16)
+    except OSError:
+        return False
+    return (header.startswith(b'\xff\xd8\xff')                                  # jpeg
+            or header.startswith(b'\x89PNG\r\n\x1a\n')                          # png
+            or header[:6] in (b'GIF87a', b'GIF89a')                             # gif
+            or header[:4] in (b'II*\x00', b'MM\x00*')                           # tiff
+            or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')              # webp
+            or (header[4:8] == b'ftyp' and header[8:12] in (b'heic', b'heix', b'mif1', b'msf1', b'avif'))  # heif/avif
+            or header.startswith(b'BM'))                                        # bmp
+
+
+def get_manifest_file(manifest_folder: str, root_dir: str) -> str:
+    """One manifest per indexed root."""
+    root_hash = hashlib.sha1(os.path.abspath(root_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(manifest_folder, f'{root_hash}.manifest')
+
+
+class ScanManifest:
+
+    def __init__(self, root_dir: str, manifest_file: str | None = None):
+        """Without a `manifest_file`, the manifest only lasts as long as this object."""
+        self.root_dir = os.path.abspath(root_dir)
+        self.manifest_file = manifest_file
+        self.files: dict[str, FileState] = {}
+        if manifest_file is not None and os.path.exists(manifest_file):
+            with open(manifest_file, 'rb') as f:
+                d = pickle.load(f)
+            if d['version'] != MANIFEST_VERSION or d['root_dir'] != self.root_dir:
+                print(f'ignoring scan manifest {manifest_file}: it was written for {d["root_dir"]}, version {d["version"]}')
+            else:
+                self.files = {path: FileState(*state) for path, state in d['files'].items()}
+
+    def save(self):
+        if self.manifest_file is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_file)), exist_ok=True)
+        tmp_path = f'{self.manifest_file}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': MANIFEST_VERSION,
+                         'root_dir': self.root_dir,
+                         'files': {path: tuple(state) for path, state in self.files.items()}},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.manifest_file)
+
+
+class DirectoryScanner:
+
+    def __init__(self, root_dir: str, manifest_file: str | None = None, workers: int = None):
+        self.manifest = ScanManifest(root_dir, manifest_file)
+        self.workers = workers or min(32, 4 * os.cpu_count())
+        self.num_scanned = 0
+        # the scan may run on another thread than the one recording and saving
+        self._lock = threading.Lock()
+
+    def scan(self, stop: threading.Event = None) -> Generator[tuple[str, FileState, FileState | None], None, None]:
+        """
+        Yield (path, state, previous state or None) for every image under the root that is new or changed since
+        the last scan. Call record() once a yielded image has been indexed, otherwise it is yielded again next
+        time. Everything else is recorded in the manifest as it is seen, and files that have disappeared are
+        dropped from it when the scan completes. Setting `stop` ends the scan early.
+        """
+        previous = self.manifest.files
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scanner')
+        try:
+            pending = {executor.submit(_scan_directory, self.manifest.root_dir, previous)}
+            while pending:
+                if stop is not None and stop.is_set():
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subdirectories, files = future.result()
+                    pending |= {executor.submit(_scan_directory, d, previous) for d in subdirectories}
+                    for path, state, changed in files:
+                        self.num_scanned += 1
+                        seen.add(path)
+                        if changed and state.is_image:
+                            yield path, state, previous.get(path)
+                        elif changed:
+                            with self._lock:
+                                previous[path] = state
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            for path in [p for p in previous if p not in seen]:
+                del previous[path]
+
+    def record(self, path: str, state: FileState):
+        with self._lock:
+            self.manifest.files[path] = state
+
+    def save(self):
+        with self._lock:
+            self.manifest.save()
+
+
+def _scan_directory(directory: str, previous: dict[str, FileState]) -> tuple[list[str], list[tuple[str, FileState, bool]]]:
+    """List one directory: its subdirectories, and (path, state, changed) for each file."""
+    subdirectories = []
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        previous_state = previous.get(entry.path)
+                        if (previous_state is not None and previous_state.size == stat.st_size
+                                and previous_state.mtime_ns == stat.st_mtime_ns and previous_state.inode == stat.st_ino):
+                            files.append((entry.path, previous_state, False))
+                        else:
+                            files.append((entry.path, FileState(stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                                                                looks_like_image(entry.path)), True))
+                except OSError as e:
+                    print(f'skipping {entry.path}: {repr(e)}')
+    except OSError as e:
+        print(f'skipping directory {directory}: {repr(e)}')
+    return subdirectories, files
+
+
+def add_images_recursively(store, root_dir: str, manifest_file: str | None = None, batch_size: int = 1000,
+                           workers: int = None, checkpoint_every: int = 10_000, cancel_event: threading.Event = None,
+                           progress_callback: Optional[Callable[[int, int, bool], None]] = None,
+                           thumbnail_provider=None) -> int:
+    """
+    Add the new and changed images under `root_dir` to `store`, in batches of `batch_size`. The scan runs ahead
+    on its own thread. Changed images keep their ids and are re-embedded if their content changed (see
+    store.update_images). Images that can't be decoded are skipped until their file changes. The manifest is
+    saved every `checkpoint_every` images, so
+    an interrupted scan doesn't look at the images it already added again.
+    Setting `cancel_event` stops after the current batch. `progress_callback(num_processed, num_found, scan_complete)`
+    is called after every batch. `thumbnail_provider` is passed on to store.add_images. Returns the number of
+    images added.
+    """
+    scanner = DirectoryScanner(root_dir, manifest_file, workers=workers)
+    found = queue.Queue()
+    stop_scanning = threading.Event()
+    scan_complete = False
+    num_found = 0
+    num_processed = 0
+    num_added = 0
+    num_updated = 0
+    num_unreadable = 0
+
+    def scan():
+        nonlocal num_found
+        try:
+            for scanned in scanner.scan(stop_scanning):
+                num_found += 1
+                found.put(scanned)
+            found.put(_SCAN_COMPLETE)
+        except BaseException as e:
+            found.put(e)
+
+    def add_batch(batch):
+        nonlocal num_added, num_updated, num_unreadable
+        changed_paths = [path for path, _, previous_state in batch if previous_state is not None and store.has_image(path)]
+        if changed_paths:
+            updated_paths = store.update_images(changed_paths, show_pbar=False, thumbnail_provider=thumbnail_provider)
+            num_updated += len(updated_paths)
+            num_unreadable += len(changed_paths) - len(updated_paths)
+        paths_to_add = [path for path, _, _ in batch if not store.has_image(path)]
+        previous_num_added = num_added
+        if paths_to_add:
+            store.add_images(paths_to_add, return_embeddings=False, show_pbar=False, thumbnail_provider=thumbnail_provider)
+            num_batch_added = sum(1 for path in paths_to_add if store.has_image(path))
+            num_added += num_batch_added
+            num_unreadable += len(paths_to_add) - num_batch_added
+        # images that couldn't be decoded are recorded too, so they are only opened again once their file changes
+        for path, state, _ in batch:
+            scanner.record(path, state)
+        if num_added // checkpoint_every > previous_num_added // checkpoint_every:
+            scanner.save()
+
+    scan_thread = threading.Thread(target=scan, name='scanner', daemon=True)
+    scan_thread.start()
+    try:
+        while not scan_complete and not (cancel_event is not None and cancel_event.is_set()):
+            # wait for at least one more image, then take whatever else the scan has found, up to a batch
+            batch = []
+            while len(batch) < batch_size:
+                try:
+                    item = found.get(block=not batch)
+                except queue.Empty:
+                    break
+                if item is _SCAN_COMPLETE:
+                    scan_complete = True
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                batch.append(item)
+            if batch:
+                add_batch(batch)
+                num_processed += len(batch)
+            if progress_callback is not None:
+                progress_callback(num_processed, num_found, scan_complete)
+    finally:
+        stop_scanning.set()
+    scan_thread.join()
+    scanner.save()
+    print(f'scanned {scanner.num_scanned} files under {root_dir}, added {num_added} images and checked {num_updated} changed ones'
+          f'{f", {num_unreadable} could not be read" if num_unreadable else ""}{"" if scan_complete else " before being cancelled"}')
+    return num_added
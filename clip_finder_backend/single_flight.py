@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import Future, Executor
+from typing import Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: while a call for `key` is in flight, further calls for the
+    same key wait for its result instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """Run fn() on the calling thread, or wait for the call already in flight for `key`."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+        if not is_leader:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    def submit(self, key: Hashable, fn: Callable[[], T], executor: Executor) -> Future:
+        """Like do(), but runs fn on `executor` and returns a Future shared by every caller for `key`."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = executor.submit(fn)
+            self._in_flight[key] = future
+
+        def forget(_):
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+        future.add_done_callback(forget)
+        return future
@@ -0,0 +1,220 @@
+"""
+On-disk format for SimpleClipEmbeddingStore (version 6 onwards).
+
+The store file itself is a small JSON header. The embedding matrices are written as flat
+row-major binary files next to it, so they can be memory-mapped instead of unpickled, and the
+string columns (paths, ids, hashes, texts) are written as NUL-separated UTF-8 blobs.
+
+Sidecar file names carry a per-save generation tag, so a save never overwrites a file that a
+running process may still have mapped; the header is replaced last, atomically. The header also
+records which mutation log segment (see mutation_log.py) to start replaying from.
+"""
+import json
+import os
+import re
+import uuid
+from typing import Any
+
+import numpy as np
+import torch
+
+STORE_MAGIC = b'CLIPFINDER-STORE\n'
+NATIVE_STORE_VERSION = 6
+
+_SIDECAR_KINDS = ['image_embeddings', 'image_paths', 'image_ids', 'image_hashes', 'text_embeddings', 'texts']
+
+_SUPPORTED_DTYPES = {
+    'float32': (torch.float32, np.float32),
+    'float16': (torch.float16, np.float16),
+}
+
+
+def is_native_store_file(path: str) -> bool:
+    """True if `path` is a version 6+ header, False for legacy torch.save() stores."""
+    with open(path, 'rb') as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+
+def read_native_store(path: str, mmap: bool = True) -> dict[str, Any]:
+    """
+    Load a version 6+ store. Returns a dict with the same keys as the legacy torch.save() dict.
+    With mmap=True the embedding tensors are backed by copy-on-write mappings of the sidecar
+    files, so loading costs no copy and pages are shared through the OS page cache.
+    """
+    header = read_native_store_header(path)
+    folder = os.path.dirname(os.path.abspath(path))
+    files = header['files']
+    count = header['count']
+    text_count = header['text_count']
+    dim = header['embedding_dim']
+
+    def sidecar(kind):
+        return os.path.join(folder, files[kind])
+
+    return {
+        'version': header['version'],
+        'identifier': header['identifier'],
+        'image_embeddings': _read_matrix(sidecar('image_embeddings'), count, dim, header['embedding_dtype'], mmap=mmap),
+        'image_paths': _read_strings(sidecar('image_paths'), count),
+        'image_ids': _read_strings(sidecar('image_ids'), count),
+        'image_hashes': _read_strings(sidecar('image_hashes'), count),
+        'text_embeddings': _read_matrix(sidecar('text_embeddings'), text_count, dim, header['text_embedding_dtype'], mmap=False),
+        'texts': _read_strings(sidecar('texts'), text_count),
+        'log_segment': header.get('log_segment', 0),
+        'generation': header['generation'],
+    }
+
+
+def read_native_store_image_embeddings(path: str) -> torch.Tensor:
+    """Only the (memory-mapped) image embeddings of a version 6+ store."""
+    header = read_native_store_header(path)
+    folder = os.path.dirname(os.path.abspath(path))
+    return _read_matrix(os.path.join(folder, header['files']['image_embeddings']), header['count'],
+                        header['embedding_dim'], header['embedding_dtype'], mmap=True)
+
+
+def read_native_store_header(path: str) -> dict[str, Any]:
+    with open(path, 'rb') as f:
+        if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+            raise RuntimeError(f"{path} is not a native store file")
+        header = json.loads(f.read().decode('utf-8'))
+    if header['version'] < NATIVE_STORE_VERSION:
+        raise RuntimeError(f"unrecognized native store version in {path}: {header['version']}")
+    return header
+
+
+def write_native_store(path: str,
+                       identifier: str,
+                       image_embeddings: torch.Tensor,
+                       image_ids: list[str],
+                       image_paths: list[str],
+                       image_hashes: list[str],
+                       text_embeddings: torch.Tensor,
+                       texts: list[str],
+                       log_segment: int = 0) -> str:
+    """Write a new snapshot and switch the header at `path` over to it. Returns the snapshot's generation tag."""
+    count = len(image_paths)
+    if image_embeddings.shape[0] != count or len(image_ids) != count or len(image_hashes) != count:
+        raise ValueError(f"column length mismatch: {image_embeddings.shape[0]} embeddings, {count} paths, "
+                         f"{len(image_ids)} ids, {len(image_hashes)} hashes")
+    if text_embeddings.shape[0] != len(texts):
+        raise ValueError(f"column length mismatch: {text_embeddings.shape[0]} text embeddings, {len(texts)} texts")
+
+    folder = os.path.dirname(os.path.abspath(path))
+    base = os.path.basename(path)
+    generation = uuid.uuid4().hex[:12]
+    files = {kind: f'{base}.{generation}.{kind}' for kind in _SIDECAR_KINDS}
+
+    def sidecar(kind):
+        return os.path.join(folder, files[kind])
+
+    previous_files = _get_sidecar_paths(path) if os.path.exists(path) else []
+
+    embedding_dtype = _write_matrix(sidecar('image_embeddings'), image_embeddings)
+    text_embedding_dtype = _write_matrix(sidecar('text_embeddings'), text_embeddings)
+    _write_strings(sidecar('image_paths'), image_paths)
+    _write_strings(sidecar('image_ids'), image_ids)
+    _write_strings(sidecar('image_hashes'), [str(h) for h in image_hashes])
+    _write_strings(sidecar('texts'), texts)
+
+    header = {
+        'version': NATIVE_STORE_VERSION,
+        'identifier': identifier,
+        'generation': generation,
+        'count': count,
+        'text_count': len(texts),
+        'embedding_dim': image_embeddings.shape[1],
+        'embedding_dtype': embedding_dtype,
+        'text_embedding_dtype': text_embedding_dtype,
+        'files': files,
+        'log_segment': log_segment,
+    }
+    tmp_path = f'{path}.{generation}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(STORE_MAGIC)
+        f.write(json.dumps(header, indent=1).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # an existing mapping of an unlinked file stays valid, so this is safe even if we are
+    # replacing the files backing the live store
+    for previous_file in previous_files:
+        if os.path.exists(previous_file):
+            os.remove(previous_file)
+    return generation
+
+
+def remove_native_store(path: str):
+    """Delete a native store's header and all of its sidecars."""
+    for sidecar in _get_sidecar_paths(path):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+    os.remove(path)
+
+
+def remove_orphaned_sidecars(path: str):
+    """Delete sidecars and temp headers left behind by a save that was interrupted before completing."""
+    folder = os.path.dirname(os.path.abspath(path))
+    base = os.path.basename(path)
+    live_files = set(_get_sidecar_paths(path)) if os.path.exists(path) else set()
+    for name in os.listdir(folder):
+        parts = name[len(base):].split('.') if name.startswith(base + '.') else []
+        # ['', <generation>, <kind>]
+        if len(parts) == 3 and re.fullmatch('[0-9a-f]{12}', parts[1]) and (parts[2] in _SIDECAR_KINDS or parts[2] == 'tmp'):
+            candidate = os.path.join(folder, name)
+            if candidate not in live_files:
+                print(f'removing orphaned store file {candidate}')
+                os.remove(candidate)
+
+
+def _get_sidecar_paths(path: str) -> list[str]:
+    if not is_native_store_file(path):
+        return []
+    folder = os.path.dirname(os.path.abspath(path))
+    return [os.path.join(folder, f) for f in read_native_store_header(path)['files'].values()]
+
+
+def _write_matrix(path: str, matrix: torch.Tensor) -> str:
+    matrix = matrix.detach().cpu()
+    dtype_name = next((name for name, (torch_dtype, _) in _SUPPORTED_DTYPES.items() if torch_dtype == matrix.dtype), None)
+    if dtype_name is None:
+        matrix = matrix.to(torch.float32)
+        dtype_name = 'float32'
+    with open(path, 'wb') as f:
+        matrix.contiguous().numpy().tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    return dtype_name
+
+
+def _read_matrix(path: str, rows: int, dim: int, dtype_name: str, mmap: bool) -> torch.Tensor:
+    torch_dtype, np_dtype = _SUPPORTED_DTYPES[dtype_name]
+    if rows == 0:
+        return torch.empty([0, dim], dtype=torch_dtype)
+    if mmap:
+        # copy-on-write: writes to the tensor (there shouldn't be any) never reach the file
+        array = np.memmap(path, dtype=np_dtype, mode='c', shape=(rows, dim))
+    else:
+        array = np.fromfile(path, dtype=np_dtype).reshape(rows, dim)
+    return torch.from_numpy(array)
+
+
+def _write_strings(path: str, strings: list[str]):
+    joined = '\0'.join(strings)
+    if strings and joined.count('\0') != len(strings) - 1:
+        raise ValueError("strings must not contain NUL characters")
+    with open(path, 'wb') as f:
+        f.write(joined.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_strings(path: str, count: int) -> list[str]:
+    if count == 0:
+        return []
+    with open(path, 'rb') as f:
+        strings = f.read().decode('utf-8').split('\0')
+    if len(strings) != count:
+        raise RuntimeError(f"expected {count} entries in {path}, found {len(strings)}")
+    return strings
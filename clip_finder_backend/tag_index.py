@@ -0,0 +1,305 @@
+"""
+An inverted index from tags to the images that have them, so that tag queries don't read the
+metadata of every image in the library.
+
+Each indexed path gets a row, and each tag a bitmap (a numpy bool array) over the rows; queries are
+ORs, ANDs and ANDNOTs of bitmaps. Alongside its tags, the index remembers each file's change marker
+(see MetadataBackend.get_change_marker), so a refresh only stats the library, on a thread pool, and
+re-reads the tags of the files whose marker changed. The index is pickled to `index_file` after a
+refresh that changed something, with the bitmaps bit-packed, so that a restart starts from where the
+last run left off instead of rescanning everything.
+
+`generation` counts changes to the tags of indexed files and `layout_generation` changes to which
+row holds which path, so that stores can cache masks derived from the index (see get_tag_mask).
+
+The index doubles as a tag cache for responses: get_current_tags validates the cached tags of a batch
+of paths against their change markers and only reads the metadata of the ones that changed.
+"""
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from clip_finder_backend.metadata_backends import MetadataBackend
+
+TAG_INDEX_VERSION = 1
+
+_UNSET_MARKER = (-1, -1)
+
+
+class TagIndex:
+
+    def __init__(self, backend: MetadataBackend, index_file: str = None, workers: int = None):
+        """
+        `backend` is where tags are read from. The index is persisted in `index_file`, if given.
+        Refreshes stat and read files on `workers` threads.
+        """
+        self.backend = backend
+        self.index_file = index_file
+        self.workers = workers or min(32, 4 * os.cpu_count())
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tag-index')
+        self._lock = threading.RLock()
+        self._paths: list[str | None] = []
+        self._path_to_row: dict[str, int] = {}
+        self._markers = np.full((0, 2), -1, dtype=np.int64)
+        self._live = np.zeros(0, dtype=bool)
+        self._row_tags: list[tuple[str, ...]] = []
+        self._bitmaps: dict[str, np.ndarray] = {}
+        self._num_rows = 0
+        self.generation = 0
+        self.layout_generation = 0
+        if index_file is not None and os.path.exists(index_file):
+            self._load()
+
+    @property
+    def num_paths(self) -> int:
+        return len(self._path_to_row)
+
+    def get_tags(self, path: str) -> list[str] | None:
+        """The indexed tags of `path`, or None if it isn't indexed."""
+        with self._lock:
+            row = self._path_to_row.get(path)
+            if row is None:
+                return None
+            return list(self._row_tags[row])
+
+    def get_current_tags(self, paths: list[str]) -> list[list[str] | None]:
+        """
+        The tags of each of `paths`, None for files that are gone. Stats the files in parallel and reads
+        the metadata of those that aren't indexed or changed since, updating the index.
+        """
+        markers = list(self._executor.map(self.backend.get_change_marker, paths))
+        result = []
+        to_read = []
+        with self._lock:
+            for i, (path, marker) in enumerate(zip(paths, markers)):
+                row = self._path_to_row.get(path)
+                if marker is None:
+                    result.append(None)
+                elif row is not None and tuple(self._markers[row]) == marker:
+                    result.append(list(self._row_tags[row]))
+                else:
+                    result.append(None)
+                    to_read.append(i)
+        for i, tags in zip(to_read, self._executor.map(lambda i: self._read_tags(paths[i]), to_read)):
+            if tags is not None:
+                with self._lock:
+                    self._set_row(paths[i], tags, markers[i])
+            result[i] = tags
+        return result
+
+    def get_all_tags(self) -> dict[str, int]:
+        """Every tag in use, with the number of images that have it."""
+        with self._lock:
+            counts = {tag: int(np.count_nonzero(bitmap)) for tag, bitmap in self._bitmaps.items()}
+        return {tag: count for tag, count in counts.items() if count > 0}
+
+    def get_paths_for_tags(self, any_tags: Iterable[str] = None, all_tags: Iterable[str] = None,
+                           none_tags: Iterable[str] = None) -> list[str]:
+        """Paths with at least one of `any_tags`, all of `all_tags` and none of `none_tags`."""
+        with self._lock:
+            mask = self._get_mask(any_tags, all_tags, none_tags)
+            return [self._paths[row] for row in np.flatnonzero(mask)]
+
+    def get_rows_for_paths(self, paths: list[str]) -> tuple[np.ndarray, int]:
+        """The row of each of `paths` (-1 if it isn't indexed), and the layout_generation they belong to."""
+        with self._lock:
+            rows = np.fromiter((self._path_to_row.get(p, -1) for p in paths), dtype=np.int64, count=len(paths))
+            return rows, self.layout_generation
+
+    def get_tag_mask(self, tag: str, rows: np.ndarray, layout_generation: int) -> np.ndarray | None:
+        """
+        Which of `rows` (from get_rows_for_paths) have `tag`, as a boolean mask. None if the rows have moved
+        since, in which case they need to be looked up again.
+        """
+        with self._lock:
+            if layout_generation != self.layout_generation:
+                return None
+            mask = np.zeros(len(rows), dtype=bool)
+            bitmap = self._bitmaps.get(tag)
+            if bitmap is not None:
+                indexed = rows >= 0
+                mask[indexed] = bitmap[rows[indexed]]
+            return mask
+
+    def set_tags(self, path: str, tags: list[str], marker: tuple[int, int] = None):
+        """Record that `path` now has `tags`, after writing them through the backend."""
+        marker = marker or self.backend.get_change_marker(path) or _UNSET_MARKER
+        with self._lock:
+            self._set_row(path, tags, marker)
+
+    def remove_paths(self, paths: Iterable[str]):
+        with self._lock:
+            for path in paths:
+                self._remove_row(path)
+
+    def refresh(self, paths: list[str], progress_callback: Callable[[float], None] = None,
+                show_pbar: bool = True) -> int:
+        """
+        Bring the index up to date with `paths`, the whole library: paths that are gone or not in
+        `paths` are dropped, and the tags of new and changed files are (re)read. Returns the number of
+        files whose tags were read. Saves the index if anything changed.
+        """
+        if progress_callback:
+            progress_callback(0)
+        # a pool of its own, so that a refresh of the whole library doesn't hold up get_current_tags
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tag-index-refresh') as executor:
+            markers = list(tqdm(executor.map(self.backend.get_change_marker, paths), total=len(paths),
+                                desc='Checking tags', disable=not show_pbar))
+            with self._lock:
+                wanted = set(paths)
+                removed = [p for p in self._path_to_row if p not in wanted]
+                for path in removed:
+                    self._remove_row(path)
+                to_read = []
+                for path, marker in zip(paths, markers):
+                    row = self._path_to_row.get(path)
+                    if marker is None:
+                        if row is not None:
+                            self._remove_row(path)
+                            removed.append(path)
+                    elif row is None or tuple(self._markers[row]) != marker:
+                        to_read.append((path, marker))
+            if progress_callback:
+                progress_callback(0.1)
+
+            progress_interval = max(1, len(to_read) // 100)
+            num_read = 0
+            read_tags = executor.map(lambda path_marker: self._read_tags(path_marker[0]), to_read)
+            for i, ((path, marker), tags) in enumerate(tqdm(zip(to_read, read_tags), total=len(to_read),
+                                                              desc='Reading tags', disable=not show_pbar)):
+                # failed reads are retried on the next refresh
+                if tags is not None:
+                    with self._lock:
+                        self._set_row(path, tags, marker)
+                    num_read += 1
+                if progress_callback and i % progress_interval == 0:
+                    progress_callback(0.1 + 0.9 * i / len(to_read))
+
+        print(f"tag index: read tags of {num_read} files, dropped {len(removed)}, {self.num_paths} indexed")
+        if (num_read or removed) and self.index_file is not None:
+            self.save()
+        if progress_callback:
+            progress_callback(1)
+        return num_read
+
+    def save(self):
+        """Compact away the rows of dropped paths and write atomically."""
+        with self._lock:
+            self._compact()
+            d = {'version': TAG_INDEX_VERSION,
+                 'backend': self.backend.name,
+                 'paths': list(self._paths),
+                 'markers': self._markers[:self._num_rows].copy(),
+                 'bitmaps': {tag: np.packbits(bitmap[:self._num_rows]) for tag, bitmap in self._bitmaps.items()
+                             if bitmap[:self._num_rows].any()}}
+        tmp_path = f'{self.index_file}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(d, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_file)
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'rb') as f:
+                d = pickle.load(f)
+        except Exception as e:
+            print(f"ignoring unreadable tag index {self.index_file}: {repr(e)}")
+            return
+        if d.get('version') != TAG_INDEX_VERSION or d.get('backend') != self.backend.name:
+            print(f"ignoring tag index {self.index_file}: made by another version or for another metadata backend")
+            return
+        num_rows = len(d['paths'])
+        self._paths = d['paths']
+        self._path_to_row = {p: row for row, p in enumerate(self._paths)}
+        self._markers = d['markers']
+        self._live = np.ones(num_rows, dtype=bool)
+        self._bitmaps = {tag: np.unpackbits(packed, count=num_rows).astype(bool) for tag, packed in d['bitmaps'].items()}
+        row_tags = [[] for _ in range(num_rows)]
+        for tag, bitmap in self._bitmaps.items():
+            for row in np.flatnonzero(bitmap):
+                row_tags[row].append(tag)
+        self._row_tags = [tuple(tags) for tags in row_tags]
+        self._num_rows = num_rows
+        print(f"loaded tag index of {num_rows} files and {len(self._bitmaps)} tags from {self.index_file}")
+
+    def _read_tags(self, path: str) -> list[str] | None:
+        try:
+            return self.backend.get_tags(path) or []
+        except Exception as e:
+            print(f"Error reading tags for {path}: {e}")
+            return None
+
+    def _get_mask(self, any_tags: Iterable[str] = None, all_tags: Iterable[str] = None,
+                  none_tags: Iterable[str] = None) -> np.ndarray:
+        mask = np.zeros(self._num_rows, dtype=bool) if any_tags is not None else self._live[:self._num_rows].copy()
+        empty = np.zeros(self._num_rows, dtype=bool)
+        for tag in any_tags or []:
+            mask |= self._bitmaps.get(tag, empty)[:self._num_rows]
+        for tag in all_tags or []:
+            mask &= self._bitmaps.get(tag, empty)[:self._num_rows]
+        for tag in none_tags or []:
+            mask &= ~self._bitmaps.get(tag, empty)[:self._num_rows]
+        return mask
+
+    def _set_row(self, path: str, tags: list[str], marker: tuple[int, int]):
+        row = self._path_to_row.get(path)
+        if row is None:
+            row = self._append_row(path)
+        self._markers[row] = marker
+        if set(self._row_tags[row]) != set(tags):
+            self.generation += 1
+        self._row_tags[row] = tuple(tags)
+        tags = set(tags)
+        for tag, bitmap in self._bitmaps.items():
+            bitmap[row] = tag in tags
+        for tag in tags - self._bitmaps.keys():
+            bitmap = np.zeros(len(self._markers), dtype=bool)
+            bitmap[row] = True
+            self._bitmaps[tag] = bitmap
+
+    def _append_row(self, path: str) -> int:
+        row = self._num_rows
+        if row == len(self._markers):
+            # grow geometrically so that adding many rows is amortized O(1)
+            capacity = max(1024, 2 * row)
+            self._markers = np.concatenate([self._markers, np.full((capacity - row, 2), -1, dtype=np.int64)])
+            self._live = np.concatenate([self._live, np.zeros(capacity - row, dtype=bool)])
+            for tag, bitmap in self._bitmaps.items():
+                self._bitmaps[tag] = np.concatenate([bitmap, np.zeros(capacity - len(bitmap), dtype=bool)])
+        self._paths.append(path)
+        self._row_tags.append(())
+        self._path_to_row[path] = row
+        self.layout_generation += 1
+        self._live[row] = True
+        self._num_rows += 1
+        return row
+
+    def _remove_row(self, path: str):
+        row = self._path_to_row.pop(path, None)
+        if row is None:
+            return
+        self._paths[row] = None
+        self._live[row] = False
+        if self._row_tags[row]:
+            self.generation += 1
+        self._row_tags[row] = ()
+        self._markers[row] = _UNSET_MARKER
+        for bitmap in self._bitmaps.values():
+            bitmap[row] = False
+
+    def _compact(self):
+        if len(self._path_to_row) == self._num_rows:
+            return
+        keep = np.flatnonzero(self._live[:self._num_rows])
+        self._paths = [self._paths[row] for row in keep]
+        self._row_tags = [self._row_tags[row] for row in keep]
+        self._path_to_row = {p: row for row, p in enumerate(self._paths)}
+        self._markers = self._markers[keep]
+        self._live = self._live[keep]
+        self._bitmaps = {tag: bitmap[keep] for tag, bitmap in self._bitmaps.items()}
+        self._num_rows = len(keep)
+        self.layout_generation += 1
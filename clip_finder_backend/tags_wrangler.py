@@ -1,76 +1,163 @@
 import json
 import os
-import asyncio
-import concurrent.futures
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Callable, Optional
 
-from tqdm.auto import tqdm
+from pydantic import BaseModel
+
+from clip_finder_backend.metadata_backends import MetadataBackend, make_metadata_backend
+from clip_finder_backend.tag_index import TagIndex
+
+
+class TagUpdateResult(BaseModel):
+    num_changed: int = 0
+    num_unchanged: int = 0
+    """Error message for each image whose tags couldn't be read or written"""
+    failures: dict[str, str] = {}
 
-from osxmetadata import OSXMetaData, Tag, FINDER_COLOR_NONE
 
 class TagsWrangler:
 
-    def __init__(self, all_paths: list[str]):
+    def __init__(self, all_paths: list[str] | Callable[[], list[str]], backend: MetadataBackend = None,
+                 index_file: str = None, write_workers: int = 8):
+        """
+        `all_paths` is the library, or a function returning it. Tags are read and written through `backend`
+        (by default the platform's, see make_metadata_backend) and queried through a TagIndex persisted in
+        `index_file`. Bulk updates write on a pool of `write_workers` threads.
+        """
         self.known_tags = _load_known_tags()
-        self.all_paths = all_paths
-        self.tag_to_image_cache: Optional[dict[str, list[str]]] = None
+        self._get_all_paths = all_paths if callable(all_paths) else lambda: all_paths
+        self.backend = backend or make_metadata_backend()
+        self.tag_index = TagIndex(self.backend, index_file=index_file)
+        self._refresh_lock = threading.Lock()
+        self._index_refreshed = False
+        # paths added to the library since the refresh, indexed by the next ensure_index_refreshed
+        self._pending_paths: list[str] = []
+        self._pending_lock = threading.Lock()
+        self._write_executor = ThreadPoolExecutor(max_workers=write_workers, thread_name_prefix='tag-writer')
+        # read-modify-writes of the same file must not interleave; striped so that it takes no memory per file
+        self._path_locks = [threading.Lock() for _ in range(64)]
 
     def get_all_known_tags(self):
         return self.known_tags
 
-    def get_tags_for_images(self, image_paths: list[str]) -> dict[str, list[str]]:
-        return {p: self.get_tags(p) for p in image_paths}
+    def get_tags_for_images(self, image_paths: list[str]) -> dict[str, list[str]|None]:
+        """The tags of each image, in one batch through the tag index (see TagIndex.get_current_tags)."""
+        return dict(zip(image_paths, self.tag_index.get_current_tags(image_paths)))
 
-    def get_images_for_tags(self, tags: list[str], progress_callback: Optional[Callable[[float, str], None]] = None) -> list[str]:
-        if self.tag_to_image_cache is None:
-            self._populate_tag_to_image_cache(progress_callback=lambda p: progress_callback(p, "Loading tags...") if progress_callback else None)
-        paths = [p for p, file_tags in self.tag_to_image_cache.items()
-                 if any(t in file_tags for t in tags)]
+    def get_images_for_tags(self, tags: list[str], progress_callback: Optional[Callable[[float, str], None]] = None,
+                            match_all: bool = False) -> list[str]:
+        """Paths of the images with any of `tags`, or with all of them if `match_all`."""
+        self.ensure_index_refreshed(progress_callback=lambda p: progress_callback(p, "Loading tags...") if progress_callback else None)
+        if match_all:
+            paths = self.tag_index.get_paths_for_tags(all_tags=tags)
+        else:
+            paths = self.tag_index.get_paths_for_tags(any_tags=tags)
         if progress_callback is not None:
             progress_callback(1)
         return paths
 
     def get_tags(self, image_path: str) -> list[str]|None:
-        try:
-            md = OSXMetaData(image_path)
-            return [t.name for t in md.tags]
-        except FileNotFoundError:
-            return None
+        return self.tag_index.get_current_tags([image_path])[0]
 
     def add_tag(self, image_path, tag_name):
-        md = OSXMetaData(image_path)
-        if any(tag.name == tag_name for tag in md.tags):
-            return False
-        md.tags = md.tags + [Tag(name=tag_name, color=FINDER_COLOR_NONE)]
-        if self.tag_to_image_cache is not None:
-            self.tag_to_image_cache[image_path] = [t.name for t in md.tags]
-        return True
-
+        return self._update_image_tags(image_path, lambda tags: tags + [tag_name] if tag_name not in tags else tags)
 
     def remove_tag(self, image_path, tag_name):
-        md = OSXMetaData(image_path)
-        md.tags = [t for t in md.tags if t.name != tag_name]
-        if self.tag_to_image_cache is not None:
-            self.tag_to_image_cache[image_path] = [t.name for t in md.tags]
+        self._update_image_tags(image_path, lambda tags: [t for t in tags if t != tag_name])
+
+    def update_tags(self, image_paths: list[str], add: list[str] = (), remove: list[str] = (),
+                    progress_callback: Optional[Callable[[float], None]] = None) -> TagUpdateResult:
+        """Add the `add` tags to, and remove the `remove` tags from, each of `image_paths`."""
+        remove = set(remove) - set(add)
+
+        def transform(tags: list[str]) -> list[str]:
+            tags = [t for t in tags if t not in remove]
+            return tags + [t for t in dict.fromkeys(add) if t not in tags]
+        return self._update_tags(image_paths, transform, progress_callback)
 
+    def merge_tags(self, source_tags: list[str], target_tag: str,
+                   progress_callback: Optional[Callable[[float], None]] = None) -> TagUpdateResult:
+        """
+        Replace `source_tags` with `target_tag` on every image in the library. Renaming a tag is merging
+        it into its new name.
+        """
+        sources = set(source_tags) - {target_tag}
+        self.ensure_index_refreshed()
+        image_paths = self.tag_index.get_paths_for_tags(any_tags=sources)
 
-    def _populate_tag_to_image_cache(self, progress_callback: Optional[Callable[[float], None]] = None):
-        self.tag_to_image_cache = {}
+        def transform(tags: list[str]) -> list[str]:
+            # the target takes the place of the first source tag
+            merged = []
+            for tag in tags:
+                tag = target_tag if tag in sources else tag
+                if tag not in merged:
+                    merged.append(tag)
+            return merged
+        result = self._update_tags(image_paths, transform, progress_callback)
+        if any(t in sources for t in self.known_tags):
+            self.known_tags = list(dict.fromkeys(target_tag if t in sources else t for t in self.known_tags))
+        return result
+
+    def _update_tags(self, image_paths: list[str], transform: Callable[[list[str]], list[str]],
+                     progress_callback: Optional[Callable[[float], None]] = None) -> TagUpdateResult:
+        """Apply `transform` to the tags of each image, on the write pool. Failures don't stop the others."""
+        image_paths = list(dict.fromkeys(image_paths))
+        result = TagUpdateResult()
         if progress_callback:
             progress_callback(0)
-        progress_interval = max(1, len(self.all_paths) // 100)
-        for i, path in enumerate(tqdm(self.all_paths)):
+        futures = {self._write_executor.submit(self._update_image_tags, path, transform): path for path in image_paths}
+        progress_interval = max(1, len(futures) // 100)
+        for i, future in enumerate(as_completed(futures)):
             try:
-                if os.path.exists(path):
-                    tags = self.get_tags(path)
-                    self.tag_to_image_cache[path] = tags
-                    if i % progress_interval == 0 and progress_callback:
-                        progress_callback(i / len(self.all_paths))
-                        # Add a small delay to allow WebSocket messages to be sent
-                        time.sleep(0.01)  # 10ms delay every 100 files
+                if future.result():
+                    result.num_changed += 1
+                else:
+                    result.num_unchanged += 1
             except Exception as e:
-                print(f"Error reading tags for {path}: {e}")
+                result.failures[futures[future]] = repr(e)
+            if progress_callback and i % progress_interval == 0:
+                progress_callback(i / len(futures))
+        if progress_callback:
+            progress_callback(1)
+        return result
+
+    def _update_image_tags(self, image_path: str, transform: Callable[[list[str]], list[str]]) -> bool:
+        """Read-modify-write the tags of one image, keeping the tag index in step. Returns whether they changed."""
+        with self._path_locks[hash(image_path) % len(self._path_locks)]:
+            tags = self.backend.get_tags(image_path)
+            if tags is None:
+                raise FileNotFoundError(image_path)
+            new_tags = transform(tags)
+            if new_tags != tags:
+                self.backend.set_tags(image_path, new_tags)
+            self.tag_index.set_tags(image_path, new_tags)
+            return new_tags != tags
+
+    def on_rows_added(self, paths: list[str], ids: list[str]):
+        """
+        Rows listener for the embedding store (see add_rows_listener): images added to or moved within the
+        library after the refresh are indexed by the next ensure_index_refreshed.
+        """
+        with self._pending_lock:
+            self._pending_paths.extend(paths)
+
+    def ensure_index_refreshed(self, progress_callback: Optional[Callable[[float], None]] = None):
+        """
+        Refresh the tag index against the library once per process, and after that index the images added
+        since the last call. Concurrent callers wait for the first.
+        """
+        with self._refresh_lock:
+            with self._pending_lock:
+                pending_paths, self._pending_paths = self._pending_paths, []
+            if not self._index_refreshed:
+                # the library read below includes the pending paths
+                self.tag_index.refresh(self._get_all_paths(), progress_callback=progress_callback)
+                self._index_refreshed = True
+            elif pending_paths:
+                # reads the tags of the ones that aren't indexed yet or changed since
+                self.tag_index.get_current_tags(list(dict.fromkeys(pending_paths)))
         if progress_callback:
             progress_callback(1)
 
@@ -1,5 +1,6 @@
 import logging
 import traceback
+from typing import Callable
 
 from clip_finder_backend.embedding_store import EmbeddingStore, Query
 from clip_finder_backend.progress_manager import ProgressManager
@@ -7,7 +8,8 @@ from clip_finder_backend.tags_wrangler import TagsWrangler
 from clip_finder_backend.types import ImageResponse
 
 
-async def perform_search_task(task_id: str, query: Query, progress_manager: ProgressManager, embedding_store: EmbeddingStore):
+async def perform_search_task(task_id: str, query: Query, progress_manager: ProgressManager, embedding_store: EmbeddingStore,
+                              tags_wrangler: TagsWrangler = None):
     """Background task that performs the actual search and sends progress updates"""
     try:
         progress_manager.start_task(task_id, "Searching images...")
@@ -15,6 +17,9 @@ async def perform_search_task(task_id: str, query: Query, progress_manager: Prog
         # Perform the actual search
         def on_search_progress(progress: float, message: str=None):
             progress_manager.update_task_progress(task_id, progress*100, message=message),
+        # the key the result order is cached under, so further pages can skip resolving the query
+        cursor = embedding_store.get_search_cursor(query)
+        query = query.model_copy(update=dict(cursor=cursor))
         results, total = embedding_store.search_images(query=query, progress_callback=on_search_progress, return_total_available=True)
 
         # Validate results as before
@@ -22,14 +27,16 @@ async def perform_search_task(task_id: str, query: Query, progress_manager: Prog
             if r.path != embedding_store.get_image_path_for_id(r.id):
                 logging.warning(f"found image {r.path} doesn't match id {r.id} path {embedding_store.get_image_path_for_id(r.id)}")
 
-        # Convert to response format
-        search_results = [ImageResponse(id=r.id, path=r.path, distance=1-r.similarity)
+        # Convert to response format, with the tags of the whole page read in one batch
+        tags = tags_wrangler.get_tags_for_images([r.path for r in results]) if tags_wrangler is not None else {}
+        search_results = [ImageResponse(id=r.id, path=r.path, distance=1-r.similarity, tags=tags.get(r.path))
                          for r in results]
 
         progress_manager.complete_task(task_id, "Search completed", data={
             'images': search_results,
             'offset': query.offset,
-            'total_available': total
+            'total_available': total,
+            'cursor': cursor,
         })
 
     except Exception as e:
@@ -42,7 +49,8 @@ async def perform_search_task(task_id: str, query: Query, progress_manager: Prog
 async def perform_get_images_by_tags_task(task_id: str, tags: list[str],
                                           progress_manager: ProgressManager,
                                           embedding_store: EmbeddingStore,
-                                          tags_wrangler: TagsWrangler):
+                                          tags_wrangler: TagsWrangler,
+                                          match_all: bool = False):
     """Background task that performs the actual images fetch and sends progress updates"""
     try:
         print("starting get images by tags task")
@@ -51,7 +59,8 @@ async def perform_get_images_by_tags_task(task_id: str, tags: list[str],
         # Perform the actual search
         def on_get_images_progress(progress: float, message: str=None):
             progress_manager.update_task_progress(task_id, progress*100, message=message)
-        image_paths = tags_wrangler.get_images_for_tags(tags, progress_callback=on_get_images_progress)
+        image_paths = tags_wrangler.get_images_for_tags(tags, progress_callback=on_get_images_progress,
+                                                         match_all=match_all)
         image_ids = embedding_store.get_image_ids_for_paths(image_paths)
 
         progress_manager.complete_task(task_id, "Get images by tags complete", data=image_ids)
@@ -62,3 +71,43 @@ async def perform_get_images_by_tags_task(task_id: str, tags: list[str],
         logging.error(f"error during images by tags fetch: {repr(e)}")
         progress_manager.fail_task(task_id, f"Get images by tags failed", error_details=repr(e))
 
+
+
+async def perform_resume_ingestion_task(task_id: str, progress_manager: ProgressManager, embedding_store: EmbeddingStore):
+    """Background task that finishes ingestions interrupted by a restart and sends progress updates"""
+    try:
+        progress_manager.start_task(task_id, "Resuming interrupted image import...")
+
+        def on_ingestion_progress(progress: float, message: str=None):
+            progress_manager.update_task_progress(task_id, progress*100, message=message)
+        num_added = embedding_store.resume_ingestion(progress_callback=on_ingestion_progress)
+
+        progress_manager.complete_task(task_id, f"Image import completed, added {num_added} images")
+
+    except Exception as e:
+        traceback.print_exc()
+        logging.error(f"error resuming ingestion: {repr(e)}")
+        progress_manager.fail_task(task_id, f"Image import failed", error_details=repr(e))
+
+
+async def perform_tag_update_task(task_id: str, description: str, progress_manager: ProgressManager,
+                                  update: Callable[[Callable[[float], None]], dict]):
+    """
+    Background task that runs a bulk tag update and sends progress updates. `update(progress_callback)`
+    does the work and returns the data sent with the completion message.
+    """
+    try:
+        progress_manager.start_task(task_id, f"{description}...")
+
+        def on_update_progress(progress: float):
+            progress_manager.update_task_progress(task_id, progress*100, message=description)
+        data = update(on_update_progress)
+
+        num_failed = len(data.get('failures', {}))
+        progress_manager.complete_task(task_id, f"{description}: done" + (f" ({num_failed} errors)" if num_failed else ""),
+                                       data=data)
+
+    except Exception as e:
+        traceback.print_exc()
+        logging.error(f"error during tag update: {repr(e)}")
+        progress_manager.fail_task(task_id, f"{description} failed", error_details=repr(e))
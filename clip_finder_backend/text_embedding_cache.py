@@ -0,0 +1,136 @@
+"""
+Bounded, persistent cache of CLIP text embeddings, shared by all embedding store types.
+
+Entries are kept in LRU order in memory. New entries are appended to a mutation log next to
+`cache_file` and periodically compacted into a snapshot, so adding a query string never rewrites
+the whole cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from clip_finder_backend.coalescing_worker import CoalescingWorker
+from clip_finder_backend.mutation_log import MutationLog
+
+TEXT_EMBEDDING_CACHE_VERSION = 1
+
+
+class TextEmbeddingCache:
+
+    def __init__(self, clip_model, cache_file: str | None = None, identifier: str | None = None,
+                 capacity: int = 20_000, compact_after_log_bytes: int = 8 * 1024 * 1024):
+        """
+        `identifier` should match the clip model's distinct_identifier; a cache file written for a
+        different model is discarded. Without a `cache_file` the cache lives in memory only.
+        """
+        self.clip_model = clip_model
+        self.cache_file = cache_file
+        self.identifier = identifier
+        self.capacity = capacity
+        self.compact_after_log_bytes = compact_after_log_bytes
+        self._entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._log: MutationLog | None = None
+        self._compactor: CoalescingWorker | None = None
+        self.hits = 0
+        self.misses = 0
+        if cache_file is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._entries
+
+    def get_text_embedding(self, text: str) -> torch.Tensor:
+        return self.get_text_embeddings([text])[0]
+
+    def get_text_embeddings(self, texts: list[str]) -> torch.Tensor:
+        """Embeddings for `texts` as a [len(texts), embedding_dim] cpu tensor. Misses are encoded in one batch."""
+        if not texts:
+            return torch.empty([0, self.clip_model.embedding_dim])
+        with self._lock:
+            found = {}
+            for text in texts:
+                embedding = self._entries.get(text)
+                if embedding is not None:
+                    self._entries.move_to_end(text)
+                    found[text] = embedding
+            missing = list(dict.fromkeys(t for t in texts if t not in found))
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            if self.clip_model is None:
+                raise RuntimeError("cannot compute text embeddings without a clip model")
+            missing_embeddings = self.clip_model.get_text_features(missing).detach().to('cpu', dtype=torch.float32)
+            self.add(missing, missing_embeddings)
+            found.update(zip(missing, missing_embeddings))
+
+        return torch.stack([found[t] for t in texts])
+
+    def add(self, texts: list[str], embeddings: torch.Tensor):
+        embeddings = embeddings.detach().to('cpu', dtype=torch.float32)
+        with self._lock:
+            self._insert(texts, embeddings)
+            if self._compactor is not None:
+                self._log.append('add_texts', {'texts': list(texts), 'embeddings': embeddings.numpy()})
+                if self._log.bytes_written > self.compact_after_log_bytes:
+                    self._compactor.request()
+
+    def save(self):
+        if self._compactor is not None:
+            self._compact()
+
+    def _insert(self, texts: list[str], embeddings: torch.Tensor):
+        for text, embedding in zip(texts, embeddings):
+            self._entries[text] = embedding.clone()
+            self._entries.move_to_end(text)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def _load(self):
+        self._log = MutationLog(self.cache_file)
+        first_log_segment = 0
+        discard = False
+        if os.path.exists(self.cache_file):
+            d = torch.load(self.cache_file)
+            if d['version'] != TEXT_EMBEDDING_CACHE_VERSION:
+                print(f"ignoring text embedding cache {self.cache_file} with unrecognized version {d['version']}")
+                discard = True
+            elif self.identifier is not None and d['identifier'] != self.identifier:
+                print(f"ignoring text embedding cache {self.cache_file}: it was written for {d['identifier']}, not {self.identifier}")
+                discard = True
+            else:
+                self._insert(d['texts'], d['embeddings'])
+                first_log_segment = d['log_segment']
+        if discard:
+            self._log.remove_segments_before(max(self._log.existing_segments(), default=-1) + 1)
+        else:
+            for kind, payload in self._log.replay(first_log_segment):
+                if kind == 'add_texts':
+                    self._insert(payload['texts'], torch.from_numpy(payload['embeddings']))
+        print(f'loaded {len(self._entries)} cached text embeddings from {self.cache_file}')
+        self._log.start_new_segment()
+        self._compactor = CoalescingWorker(self._compact, name='text embedding cache compactor')
+
+    def _compact(self):
+        with self._compaction_lock:
+            with self._lock:
+                texts = list(self._entries.keys())
+                embeddings = torch.stack(list(self._entries.values())) if texts else torch.empty([0, 0])
+                first_log_segment = self._log.start_new_segment()
+            tmp_path = f'{self.cache_file}.tmp'
+            torch.save({
+                'version': TEXT_EMBEDDING_CACHE_VERSION,
+                'identifier': self.identifier,
+                'texts': texts,
+                'embeddings': embeddings,
+                'log_segment': first_log_segment,
+            }, tmp_path)
+            os.replace(tmp_path, self.cache_file)
+            self._log.remove_segments_before(first_log_segment)
@@ -1,41 +1,231 @@
 import hashlib
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 import platformdirs
 from PIL import ImageOps
 
+from clip_finder_backend.coalescing_worker import CoalescingWorker
+from clip_finder_backend.single_flight import SingleFlight
+
+SIZE_TIERS = (128, 256, 512)
+
+
 class ThumbnailProvider:
-    def __init__(self, thumbnail_size=(512, 512)):
-        self.thumbnail_size = thumbnail_size
-        self.cache_dir = Path(platformdirs.user_cache_dir("clipfinder3")) / "thumbnails"
+    def __init__(self, size_tiers=SIZE_TIERS, max_workers: int = None, max_cache_bytes: int = 2 * 1024 ** 3,
+                 cache_dir: str = None):
+        """
+        Thumbnails are made in `size_tiers` (longest side in pixels) on a pool of `max_workers` threads.
+        Concurrent requests for the same thumbnail share a single decode.
+        The cache is kept under `max_cache_bytes` by a background sweeper that deletes the least recently
+        used thumbnails first.
+        """
+        self.size_tiers = tuple(sorted(size_tiers))
+        self.cache_dir = Path(cache_dir or Path(platformdirs.user_cache_dir("clipfinder3")) / "thumbnails")
         self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_cache_bytes = max_cache_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or min(8, os.cpu_count()),
+                                            thread_name_prefix='thumbnailer')
+        self._single_flight = SingleFlight()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'errors': 0, 'prewarmed': 0, 'evictions': 0, 'evicted_bytes': 0}
+        # unknown until the first sweep has walked the cache
+        self._cache_bytes: int | None = None
+        self._bytes_written_since_sweep = 0
+        self._sweeper = CoalescingWorker(self._sweep, name='thumbnail-sweeper')
+        self._sweeper.request()
+
+    def get_size_tier(self, size: int) -> int:
+        """The smallest tier at least `size` pixels, or the largest tier."""
+        return next((tier for tier in self.size_tiers if tier >= size), self.size_tiers[-1])
+
+    def get_thumbnail_path(self, original_path: str, size: int = None) -> Path:
+        """
+        Where the thumbnail of the current version of `original_path` is cached. The key includes the file's
+        mtime and size, so an edited file gets a new thumbnail. Files are spread over two levels of
+        subdirectories to keep each directory small.
+        """
+        tier = self.get_size_tier(size or self.size_tiers[-1])
+        stat = os.stat(original_path)
+        key_hash = hashlib.sha256(f'{original_path}\0{stat.st_mtime_ns}\0{stat.st_size}'.encode()).hexdigest()
+        return self.cache_dir / key_hash[:2] / key_hash[2:4] / f"{key_hash}_{tier}.jpg"
+
+    def get_or_create_thumbnail(self, image_path: str, size: int = None) -> Path:
+        """Get existing thumbnail or create a new one if it doesn't exist. Blocks until it is ready."""
+        return self.get_or_create_thumbnail_async(image_path, size).result()
+
+    def get_or_create_thumbnail_async(self, image_path: str, size: int = None) -> Future:
+        """
+        Future for the thumbnail's path. Existing thumbnails are returned without going through the pool,
+        otherwise the thumbnail is made on the pool, once however many callers are waiting for it.
+        """
+        tier = self.get_size_tier(size or self.size_tiers[-1])
+        thumbnail_path = self.get_thumbnail_path(image_path, tier)
+        if self._touch(thumbnail_path):
+            self._count('hits')
+            future = Future()
+            future.set_result(thumbnail_path)
+            return future
+        return self._single_flight.submit(thumbnail_path, lambda: self._create_thumbnail(image_path, thumbnail_path, tier),
+                                          self._executor)
+
+    def get_thumbnails_bytes(self, image_paths: list[str | None], size: int = None) -> list[bytes | None]:
+        """
+        The JPEG bytes of each image's thumbnail, with the missing ones made in parallel on the pool. None for
+        images that are gone or can't be decoded. Blocks until all are ready.
+        """
+        futures = []
+        for image_path in image_paths:
+            try:
+                futures.append(None if image_path is None else self.get_or_create_thumbnail_async(image_path, size))
+            except OSError:
+                futures.append(None)
+        thumbnails = []
+        for future in futures:
+            try:
+                thumbnails.append(None if future is None else future.result().read_bytes())
+            except (RuntimeError, OSError):
+                thumbnails.append(None)
+        return thumbnails
+
+    def write_thumbnails_from_image(self, image_path: str, img: Image.Image):
+        """
+        Cache every tier of `image_path`'s thumbnail from `img`, its already decoded, upright pixels (see
+        ClipModel.get_image_features_batched), so that browsing newly added images doesn't decode them again.
+        """
+        for tier in sorted(self.size_tiers, reverse=True):
+            thumbnail_path = self.get_thumbnail_path(image_path, tier)
+            if thumbnail_path.exists():
+                continue
+            # each tier is resized from the next larger one, which is much cheaper than from the original
+            scale = min(1.0, tier / max(img.size))
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                             Image.Resampling.LANCZOS, reducing_gap=3.0)
+            self._write_thumbnail(img, thumbnail_path)
+            self._count('prewarmed')
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return {**self._stats, 'cache_bytes': self._cache_bytes, 'max_cache_bytes': self.max_cache_bytes}
 
-    def get_thumbnail_path(self, original_path: str) -> Path:
-        """Generate a unique thumbnail path based on the original image path."""
-        # Create a hash of the original path to use as the thumbnail filename
-        path_hash = hashlib.sha256(original_path.encode()).hexdigest()
-        return self.cache_dir / f"{path_hash}.jpg"
-
-    def get_or_create_thumbnail(self, image_path: str) -> Path:
-        """Get existing thumbnail or create a new one if it doesn't exist."""
-        thumbnail_path = self.get_thumbnail_path(image_path)
-        
-        # Return existing thumbnail if it exists
+    def _count(self, counter: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[counter] += amount
+
+    def _touch(self, thumbnail_path: Path, min_interval: float = 3600) -> bool:
+        """Mark a cached thumbnail as used (its mtime is the LRU clock). Returns False if it isn't cached."""
+        try:
+            mtime = thumbnail_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        if now - mtime > min_interval:
+            try:
+                os.utime(thumbnail_path, (now, now))
+            except FileNotFoundError:
+                # evicted just now
+                return False
+        return True
+
+    def _create_thumbnail(self, image_path: str, thumbnail_path: Path, tier: int) -> Path:
+        # another request may have finished it between the check and the submit
         if thumbnail_path.exists():
+            self._count('hits')
             return thumbnail_path
-
-        # Create new thumbnail
+        self._count('misses')
         try:
             with Image.open(image_path) as img:
+                # let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, instead of decoding every pixel
+                img.draft('RGB', (tier, tier))
                 # Convert to RGB if necessary (handles PNG with transparency)
-                if img.mode in ('RGBA', 'P'):
+                if img.mode not in ('RGB', 'L'):
                     img = img.convert('RGB')
                 img = ImageOps.exif_transpose(img)
 
-                # Create thumbnail
-                img.thumbnail(self.thumbnail_size, Image.Resampling.LANCZOS)
-                img.save(thumbnail_path, "JPEG", quality=85)
-                
+                # Create thumbnail: reduce() by an integer factor first, then a LANCZOS pass over what is left
+                img.thumbnail((tier, tier), Image.Resampling.LANCZOS, reducing_gap=3.0)
+                self._write_thumbnail(img, thumbnail_path)
+
             return thumbnail_path
         except Exception as e:
-            raise RuntimeError(f"Failed to create thumbnail: {str(e)}") 
\ No newline at end of file
+            self._count('errors')
+            raise RuntimeError(f"Failed to create thumbnail: {str(e)}")
+
+    def _write_thumbnail(self, img: Image.Image, thumbnail_path: Path):
+        thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = thumbnail_path.parent / f'{thumbnail_path.name}.{threading.get_ident()}.tmp'
+        img.save(tmp_path, "JPEG", quality=85)
+        os.replace(tmp_path, thumbnail_path)
+        num_bytes = thumbnail_path.stat().st_size
+        with self._stats_lock:
+            if self._cache_bytes is not None:
+                self._cache_bytes += num_bytes
+            self._bytes_written_since_sweep += num_bytes
+            needs_sweep = self._cache_bytes is not None and self._cache_bytes > self.max_cache_bytes \
+                and self._bytes_written_since_sweep > self.max_cache_bytes // 20
+        if needs_sweep:
+            self._sweeper.request()
+
+    def _sweep(self, low_water: float = 0.9, stale_tmp_seconds: float = 3600):
+        """
+        Walk the cache and, if it is over budget, delete the least recently used thumbnails until it is
+        down to `low_water` of the budget. Also deletes temp files left behind by a crash.
+        """
+        with self._stats_lock:
+            self._bytes_written_since_sweep = 0
+        entries = []
+        total_bytes = 0
+        now = time.time()
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > stale_tmp_seconds:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        num_evicted = 0
+        evicted_bytes = 0
+        if total_bytes > self.max_cache_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total_bytes - evicted_bytes <= self.max_cache_bytes * low_water:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                num_evicted += 1
+                evicted_bytes += size
+            print(f'evicted {num_evicted} thumbnails ({evicted_bytes / 1024 ** 2:.0f} MiB) from {self.cache_dir}')
+        with self._stats_lock:
+            # thumbnails written during the walk may or may not have been counted; the next sweep corrects that
+            self._cache_bytes = total_bytes - evicted_bytes
+            self._stats['evictions'] += num_evicted
+            self._stats['evicted_bytes'] += evicted_bytes
+
+
+def pack_thumbnails(ids: list[str], thumbnails: list[bytes | None]) -> bytes:
+    """
+    One length-prefixed record per id, in order: <u32 id length><id utf-8><u32 jpeg length><jpeg bytes>,
+    with big-endian lengths. A thumbnail that couldn't be made has length 0.
+    """
+    parts = []
+    for image_id, thumbnail in zip(ids, thumbnails):
+        encoded_id = image_id.encode('utf-8')
+        thumbnail = thumbnail or b''
+        parts += [struct.pack('>I', len(encoded_id)), encoded_id, struct.pack('>I', len(thumbnail)), thumbnail]
+    return b''.join(parts)
@@ -1,6 +1,5 @@
 from dataclasses import dataclass
 from enum import Enum
-from clip_finder_backend.util import get_tags
 
 from pydantic import BaseModel
 from pydantic.alias_generators import to_camel
@@ -33,6 +32,7 @@ class ResultFilters(BaseModel):
 class ZeroShotClassifyRequest(BaseModel):
     classes: list[EmbeddingRequest]
     filters: ResultFilters
+    include_tags: bool = True
 
     @property
     def is_empty(self) -> bool:
@@ -45,15 +45,14 @@ class ImageResponse:
     id: str
     path: str
     distance: float
-    tags: list[str]
+    """None if the request didn't ask for tags or the file is gone."""
+    tags: list[str] | None
 
     def __init__(self, id, path, distance=None, tags=None):
         self.id = id
         self.path = path
         self.distance = distance or 0
-        self.tags = tags or get_tags(path)
-        #if self.tags:
-        #    print('tags:', self.tags, 'path:', path)
+        self.tags = tags
 
 
 @dataclass
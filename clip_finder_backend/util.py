@@ -1,15 +1,6 @@
-from osxmetadata import OSXMetaData
 import torch
 from typing import List
 
-def get_tags(path):
-    try:
-        md = OSXMetaData(path)
-        return [t[0] for t in md.tags]
-    except FileNotFoundError:
-        return []
-
-
 def minimum_cost_path_coverage(distance_matrix: torch.Tensor) -> List[int]:
     """
     Find K non-intersecting paths that together cover all nodes with minimum total cost.
@@ -0,0 +1,133 @@
+"""
+Reading Weaviate dump chunks (`part_0000.pt`, `part_0001.pt`, ...) into shards.
+
+Chunks are read in parallel, a bounded number ahead of the consumer, and copied into preallocated
+per-shard buffers. The first load converts the dump into native store files (see store_format.py),
+one per shard, plus a manifest describing the chunks they came from; later loads memory-map those
+files instead of unpickling the dump again, as long as the chunks are unchanged.
+"""
+import json
+import os
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator
+
+import torch
+from tqdm.auto import tqdm
+
+from clip_finder_backend.store_format import write_native_store, remove_native_store
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def find_chunk_files(chunks_folder: str) -> list[str]:
+    chunk_files = []
+    while os.path.exists(path := os.path.join(chunks_folder, f'part_{len(chunk_files):04d}.pt')):
+        chunk_files.append(path)
+    return chunk_files
+
+
+def read_chunks(chunk_files: list[str], workers: int = None) -> Generator[tuple[list[str], torch.Tensor], None, None]:
+    """Yield (paths, vectors) for each chunk, in order. Up to `workers` chunks are loaded ahead in parallel."""
+    def read_chunk(path):
+        chunk = torch.load(path, weights_only=False)
+        return [p['path'] for p in chunk['objects']], chunk['vectors']
+
+    workers = workers or min(8, os.cpu_count())
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chunk-reader') as executor:
+        pending = deque(executor.submit(read_chunk, path) for path in chunk_files[:workers])
+        next_chunk = len(pending)
+        while pending:
+            result = pending.popleft().result()
+            if next_chunk < len(chunk_files):
+                pending.append(executor.submit(read_chunk, chunk_files[next_chunk]))
+                next_chunk += 1
+            yield result
+
+
+def iter_shards(chunk_files: list[str], shard_size: int, workers: int = None) -> Generator[tuple[list[str], torch.Tensor], None, None]:
+    """Regroup the chunks into (paths, embeddings) shards of `shard_size` rows (the last one may be smaller)."""
+    buffer = None
+    buffer_paths = []
+    for chunk_paths, vectors in tqdm(read_chunks(chunk_files, workers), total=len(chunk_files), desc='Loading chunks'):
+        start = 0
+        while start < len(chunk_paths):
+            if buffer is None:
+                buffer = torch.empty([shard_size, vectors.shape[1]], dtype=vectors.dtype)
+                buffer_paths = []
+            count = min(shard_size - len(buffer_paths), len(chunk_paths) - start)
+            buffer[len(buffer_paths):len(buffer_paths) + count] = vectors[start:start + count]
+            buffer_paths.extend(chunk_paths[start:start + count])
+            start += count
+            if len(buffer_paths) == shard_size:
+                yield buffer_paths, buffer
+                buffer = None
+    if buffer is not None:
+        # copy, so the unused tail of the buffer can be freed
+        yield buffer_paths, buffer[:len(buffer_paths)].clone()
+
+
+def get_native_shard_files(chunks_folder: str, native_folder: str, shard_size: int | None) -> list[str] | None:
+    """
+    The shard files converted from the chunks in `chunks_folder`, or None if they are missing, out of date,
+    or (unless `shard_size` is None) split into shards of a different size.
+    """
+    manifest_path = os.path.join(native_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if (manifest['version'] != MANIFEST_VERSION or (shard_size is not None and manifest['shard_size'] != shard_size)
+            or manifest['chunks'] != _describe_chunks(find_chunk_files(chunks_folder))):
+        print(f'native shards in {native_folder} are out of date')
+        return None
+    shard_files = [os.path.join(native_folder, name) for name in manifest['shards']]
+    if not all(os.path.exists(path) for path in shard_files):
+        return None
+    return shard_files
+
+
+def convert_to_native_shards(chunks_folder: str, native_folder: str, shard_size: int, workers: int = None) -> list[str]:
+    """Write the chunks in `chunks_folder` as native store files of `shard_size` rows each. Returns their paths."""
+    os.makedirs(native_folder, exist_ok=True)
+    manifest_path = os.path.join(native_folder, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        # the shards are about to be rewritten, so they must not be trusted if this is interrupted
+        os.remove(manifest_path)
+    chunk_files = find_chunk_files(chunks_folder)
+    shard_files = []
+    for paths, embeddings in iter_shards(chunk_files, shard_size, workers):
+        shard_file = os.path.join(native_folder, f'shard_{len(shard_files):04d}.store')
+        write_native_store(shard_file,
+                           identifier='shard__',
+                           image_embeddings=embeddings,
+                           image_ids=[str(uuid.uuid4()) for _ in range(len(paths))],
+                           image_paths=paths,
+                           image_hashes=[''] * len(paths),
+                           text_embeddings=torch.empty([0, embeddings.shape[1]]),
+                           texts=[])
+        shard_files.append(shard_file)
+
+    for name in os.listdir(native_folder):
+        path = os.path.join(native_folder, name)
+        if name.startswith('shard_') and name.endswith('.store') and path not in shard_files:
+            remove_native_store(path)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'shard_size': shard_size,
+        'chunks': _describe_chunks(chunk_files),
+        'shards': [os.path.basename(path) for path in shard_files],
+    }
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+    print(f'converted {len(chunk_files)} chunks in {chunks_folder} to {len(shard_files)} native shards in {native_folder}')
+    return shard_files
+
+
+def _describe_chunks(chunk_files: list[str]) -> list[list]:
+    return [[os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns] for path in chunk_files]
@@ -1,24 +1,27 @@
 import torch
-from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from clip_finder_backend.embedding_store import EmbeddingStore
+from clip_finder_backend.tags_wrangler import TagsWrangler
 from clip_finder_backend.types import ZeroShotClassifyRequest, ZeroShotClassification, ImageResponse
 #from MulticoreTSNE import MulticoreTSNE as TSNE
 import logging
-from clip_finder_backend.filtering import get_included_path_indices
 
-def do_zero_shot_classify(embedding_provider: SimpleClipEmbeddingStore,
-                          request: ZeroShotClassifyRequest):
+def do_zero_shot_classify(embedding_provider: EmbeddingStore,
+                          request: ZeroShotClassifyRequest,
+                          tags_wrangler: TagsWrangler = None):
 
     cls_results = []
 
-    indices = get_included_path_indices(filters=request.filters, image_paths=embedding_provider.image_paths)
-    image_ids = [embedding_provider.image_ids[i] for i in indices]
-    image_paths = [embedding_provider.image_paths[i] for i in indices]
-    image_embeddings = embedding_provider.image_embeddings[indices]
+    image_ids, image_paths, image_embeddings = embedding_provider.get_filtered_images(request.filters)
 
+    if any(cls.images for cls in request.classes):
+        raise NotImplementedError
+    # one batch for every class's texts, so only cache misses reach the model
+    all_texts = [t for cls in request.classes for t in cls.texts]
+    all_text_embeddings = embedding_provider.get_text_embeddings(all_texts).to(image_embeddings.device, dtype=image_embeddings.dtype)
+    first_text_index = 0
     for cls in request.classes:
-        cls_text_embeddings = torch.stack([embedding_provider.get_text_embedding(t) for t in cls.texts])
-        if cls.images:
-            raise NotImplementedError
+        cls_text_embeddings = all_text_embeddings[first_text_index:first_text_index + len(cls.texts)]
+        first_text_index += len(cls.texts)
         similarities = image_embeddings @ cls_text_embeddings.T
         cls_results.append(similarities.mean(dim=1))
 
@@ -30,9 +33,11 @@ def do_zero_shot_classify(embedding_provider: SimpleClipEmbeddingStore,
     order_key = _order_tsne_2d(probs, normalize=True)
     logging.info("ran tsne")
 
+    tags = tags_wrangler.get_tags_for_images(image_paths) if tags_wrangler is not None and request.include_tags else {}
     return [
         ZeroShotClassification(image=ImageResponse(id=image_ids[i],
-                                                   path=image_paths[i]),
+                                                   path=image_paths[i],
+                                                   tags=tags.get(image_paths[i])),
                                best_cls=request.classes[cls_selections[i].item()].id,
                                entropy=entropy[i].item(),
                                order_key=order_key[i].cpu().tolist())
@@ -0,0 +1,53 @@
+"""Shared fixtures. FakeClipModel stands in for the CLIP model, so stores can be built without loading one."""
+import hashlib
+
+import pytest
+import torch
+
+EMBEDDING_DIM = 8
+
+
+def _unit_vector(seed_bytes: bytes) -> torch.Tensor:
+    seed = int.from_bytes(hashlib.md5(seed_bytes).digest()[:4], 'little')
+    embedding = torch.randn(EMBEDDING_DIM, generator=torch.Generator().manual_seed(seed))
+    return embedding / embedding.norm()
+
+
+class FakeClipModel:
+    """Embeds an image file as a deterministic function of its bytes, and a text as a function of the text."""
+    embedding_dim = EMBEDDING_DIM
+    distinct_identifier = 'fake-clip'
+
+    def get_image_features(self, path: str) -> torch.Tensor:
+        with open(path, 'rb') as f:
+            return _unit_vector(f.read())
+
+    def get_image_features_batched(self, paths, batch_size=10, show_pbar=True, **kwargs):
+        for path in paths:
+            yield path, self.get_image_features(path)
+
+    def get_text_features(self, text: str | list[str]) -> torch.Tensor:
+        texts = [text] if isinstance(text, str) else text
+        return torch.stack([_unit_vector(t.encode('utf-8')) for t in texts])
+
+
+@pytest.fixture
+def clip_model() -> FakeClipModel:
+    return FakeClipModel()
+
+
+@pytest.fixture
+def make_images(tmp_path):
+    """Writes small files with distinct contents (or the given `contents`) and returns their paths."""
+    folder = tmp_path / 'images'
+    folder.mkdir()
+
+    def make(names: list[str], contents: list[bytes] | None = None) -> list[str]:
+        paths = []
+        for i, name in enumerate(names):
+            path = folder / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(contents[i] if contents is not None else f'image {name}'.encode('utf-8'))
+            paths.append(str(path))
+        return paths
+    return make
@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from clip_finder_backend.ann_index import IVFPQIndex, build_ann_index_file
+from clip_finder_backend.embedding_store import Query, SimpleClipEmbeddingStore
+from conftest import FakeClipModel
+
+
+def clustered_embeddings(num_rows: int, dim: int = 32, num_clusters: int = 16, seed: int = 0) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_clusters, dim, generator=generator)
+    rows = centers[torch.randint(num_clusters, (num_rows,), generator=generator)] + 0.3 * torch.randn(num_rows, dim, generator=generator)
+    return rows / rows.norm(dim=1, keepdim=True)
+
+
+def test_recall_after_exact_reranking():
+    embeddings = clustered_embeddings(2000)
+    index = IVFPQIndex.train(embeddings, nlist=32, m=4)
+    queries = clustered_embeddings(20, seed=1)
+    recalls = []
+    for query in queries:
+        exact_top = set(torch.topk(embeddings @ query, 10).indices.tolist())
+        candidates, _ = index.search(query, nprobe=8, k=200)
+        reranked = candidates[torch.topk(embeddings[candidates] @ query, 10).indices]
+        recalls.append(len(exact_top & set(reranked.tolist())) / 10)
+    assert np.mean(recalls) >= 0.9
+
+
+def test_probing_every_list_finds_every_row():
+    embeddings = clustered_embeddings(300)
+    index = IVFPQIndex.train(embeddings, nlist=8, m=4)
+    rows, scores = index.search(embeddings[0], nprobe=8, k=300)
+    assert sorted(rows.tolist()) == list(range(300))
+    assert torch.all(scores[:-1] >= scores[1:])
+
+    row_mask = np.zeros(300, dtype=bool)
+    row_mask[::3] = True
+    rows, _ = index.search(embeddings[0], nprobe=8, k=300, row_mask=row_mask)
+    assert sorted(rows.tolist()) == list(range(0, 300, 3))
+
+
+def test_index_follows_store_row_changes():
+    embeddings = clustered_embeddings(400)
+    index = IVFPQIndex.train(embeddings[:300], nlist=8, m=4)
+    index.add(embeddings[300:])
+    keep = np.flatnonzero(np.arange(400) % 5 != 0)
+    index.keep_rows(keep)
+    replaced_rows = np.array([0, 7, 100])
+    replacements = clustered_embeddings(3, seed=2)
+    index.replace_rows(replaced_rows, replacements)
+
+    expected_embeddings = embeddings[torch.from_numpy(keep)].clone()
+    expected_embeddings[torch.from_numpy(replaced_rows)] = replacements
+    expected = IVFPQIndex(centroids=index.centroids, codebooks=index.codebooks)
+    expected.add(expected_embeddings)
+    assert torch.equal(index.assignments, expected.assignments)
+    assert torch.equal(index.codes, expected.codes)
+    # the inverted lists were rebuilt for the new rows
+    assert sorted(index.search(replacements[1], nprobe=8, k=400)[0].tolist()) == list(range(len(keep)))
+
+
+def test_saved_index_must_match_the_store_snapshot(tmp_path):
+    index = IVFPQIndex.train(clustered_embeddings(100), nlist=4, m=4)
+    path = str(tmp_path / 'store.ivfpq')
+    index.save(path, store_generation='abc')
+    loaded = IVFPQIndex.load(path, store_generation='abc', num_rows=100)
+    assert torch.equal(loaded.codes, index.codes) and torch.equal(loaded.centroids, index.centroids)
+    assert IVFPQIndex.load(path, store_generation='def', num_rows=100) is None
+    assert IVFPQIndex.load(path, store_generation='abc', num_rows=99) is None
+
+
+@pytest.fixture
+def store(tmp_path, make_images) -> SimpleClipEmbeddingStore:
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+    store.add_images(make_images([f'{i}.jpg' for i in range(200)]), show_pbar=False)
+    store.build_ann_index(nlist=8)
+    return store
+
+
+@pytest.mark.parametrize('sort_order', ['similarity', 'similarity_max', 'similarity_avg'])
+def test_search_with_every_list_probed_matches_exact_search(store, sort_order):
+    query = Query.text_query_with_weights(['a cat', 'a dog'], [1.0, 0.5])
+    query.sort_order = sort_order
+    query.limit = 200
+    exact = store.search_images(query)
+    query.ann_nprobe = store.ann_index.nlist
+    query.ann_candidates = 200
+    approximate = store.search_images(query)
+    assert [r.id for r in approximate] == [r.id for r in exact]
+
+
+def test_index_is_saved_with_the_snapshot_and_follows_the_log(tmp_path, store, make_images):
+    store.save()
+    store.add_images(make_images([f'new/{i}.jpg' for i in range(5)]), show_pbar=False)
+    store.remove_image(store.image_ids[3])
+    store._compactor.wait_until_idle()
+    store._log.close()
+
+    reloaded = SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+    assert reloaded.ann_index is not None
+    assert reloaded.ann_index.num_rows == len(reloaded.image_paths) == 204
+    expected = IVFPQIndex(centroids=reloaded.ann_index.centroids, codebooks=reloaded.ann_index.codebooks)
+    expected.add(reloaded.image_embeddings)
+    assert torch.equal(reloaded.ann_index.codes, expected.codes)
+
+
+def test_offline_build_only_writes_the_index_file(tmp_path, make_images):
+    store_file = str(tmp_path / 'store')
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    store.add_images(make_images([f'{i}.jpg' for i in range(100)]), show_pbar=False)
+    store.save()
+    # logged, but not in the snapshot yet
+    store.add_images(make_images([f'new/{i}.jpg' for i in range(3)]), show_pbar=False)
+    store._compactor.wait_until_idle()
+    store._log.close()
+    files_before = {name: os.path.getmtime(tmp_path / name) for name in os.listdir(tmp_path) if name != 'images'}
+
+    build_ann_index_file(store_file, nlist=4)
+    files_after = {name: os.path.getmtime(tmp_path / name) for name in os.listdir(tmp_path) if name != 'images'}
+    assert files_after.keys() - files_before.keys() == {'store.ivfpq'}
+    assert all(files_after[name] == mtime for name, mtime in files_before.items())
+
+    reloaded = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    assert reloaded.ann_index is not None
+    assert reloaded.ann_index.num_rows == len(reloaded.image_paths) == 103
+
@@ -0,0 +1,101 @@
+import hashlib
+import os
+
+import pytest
+import torch
+
+from clip_finder_backend.content_hash import compute_content_hash, compute_content_hashes
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from conftest import FakeClipModel
+
+
+def test_hashes_match_md5_of_the_whole_file(tmp_path):
+    contents = [b'', b'small', os.urandom(3 * 1024 * 1024 + 17)]
+    paths = []
+    for i, content in enumerate(contents):
+        (tmp_path / str(i)).write_bytes(content)
+        paths.append(str(tmp_path / str(i)))
+    expected = [hashlib.md5(content).hexdigest() for content in contents]
+    assert [compute_content_hash(p, chunk_size=1000) for p in paths] == expected
+    assert compute_content_hashes(paths + [str(tmp_path / 'missing')], workers=3) == expected + ['']
+
+
+def test_xxh3_digests_are_prefixed(tmp_path):
+    pytest.importorskip('xxhash')
+    (tmp_path / 'a').write_bytes(b'content')
+    digest = compute_content_hash(str(tmp_path / 'a'), 'xxh3')
+    assert digest.startswith('xxh3:') and digest != compute_content_hash(str(tmp_path / 'a'))
+
+
+def test_unknown_algorithm_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        compute_content_hash(str(tmp_path), 'sha0')
+
+
+@pytest.fixture
+def store(tmp_path) -> SimpleClipEmbeddingStore:
+    return SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+
+
+def fail_on_model_use(store, monkeypatch):
+    def get_image_features_batched(paths, **kwargs):
+        if paths:
+            pytest.fail(f'the model was run on {paths}')
+        return iter(())
+    monkeypatch.setattr(store.clip_model, 'get_image_features_batched', get_image_features_batched)
+
+
+def test_moved_image_keeps_its_row_and_id(store, tmp_path, make_images, monkeypatch):
+    paths = make_images(['a.jpg', 'b.jpg'])
+    store.add_images(paths, show_pbar=False)
+    ids, embeddings = list(store.image_ids), store.image_embeddings.clone()
+    moved_path = str(tmp_path / 'images' / 'renamed.jpg')
+    os.rename(paths[0], moved_path)
+
+    fail_on_model_use(store, monkeypatch)
+    store.add_images([moved_path], show_pbar=False)
+    assert store.image_paths == [moved_path, paths[1]]
+    assert store.image_ids == ids
+    assert torch.equal(store.image_embeddings, embeddings)
+    assert not store.has_image(paths[0])
+    assert store.get_image_ids_for_paths([moved_path]) == ids[:1]
+
+
+def test_copied_image_reuses_the_embedding(store, make_images, monkeypatch):
+    original, = make_images(['a.jpg'])
+    store.add_images([original], show_pbar=False)
+    copy, = make_images(['copy of a.jpg'], [b'image a.jpg'])
+
+    fail_on_model_use(store, monkeypatch)
+    store.add_images([copy], show_pbar=False)
+    assert store.image_paths == [original, copy]
+    assert len(set(store.image_ids)) == 2
+    assert torch.equal(store.image_embeddings[1], store.image_embeddings[0])
+    assert store.image_hashes[0] == store.image_hashes[1] == compute_content_hash(original)
+
+
+def test_only_new_content_is_embedded(store, tmp_path, make_images):
+    paths = make_images(['a.jpg', 'b.jpg'])
+    store.add_images(paths, show_pbar=False)
+    os.rename(paths[0], str(tmp_path / 'images' / 'moved.jpg'))
+    new_paths = [str(tmp_path / 'images' / 'moved.jpg')] + make_images(['c.jpg', 'copy of b.jpg'], [b'image c.jpg', b'image b.jpg'])
+
+    embedded = []
+    original = store.clip_model.get_image_features_batched
+
+    def get_image_features_batched(paths, **kwargs):
+        embedded.extend(paths)
+        return original(paths, **kwargs)
+    store.clip_model.get_image_features_batched = get_image_features_batched
+    store.add_images(new_paths, show_pbar=False)
+    assert embedded == [new_paths[1]]
+    assert sorted(store.image_paths) == sorted(new_paths + [paths[1]])
+    # removing one of two rows with the same content leaves the other findable by its hash
+    store.remove_image(store.get_image_ids_for_paths([paths[1]])[0])
+    os.remove(new_paths[2])
+    moved_copy = str(tmp_path / 'images' / 'b again.jpg')
+    with open(moved_copy, 'wb') as f:
+        f.write(b'image b.jpg')
+    store.add_images([moved_copy], show_pbar=False)
+    assert embedded == [new_paths[1]]
+    assert moved_copy in store.image_paths and new_paths[2] not in store.image_paths
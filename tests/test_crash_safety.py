@@ -0,0 +1,178 @@
+"""
+A store must come back from a crash with every mutation that was logged before it: the mutation log is
+replayed on top of the last snapshot, a record torn by the crash is dropped, and a snapshot that wasn't
+completely written is never loaded.
+"""
+import os
+import re
+
+import numpy as np
+import pytest
+import torch
+
+from clip_finder_backend import store_format
+from clip_finder_backend.coalescing_worker import CoalescingWorker
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from conftest import EMBEDDING_DIM, FakeClipModel
+
+
+def open_store(store_file) -> SimpleClipEmbeddingStore:
+    return SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(store_file))
+
+
+def crash(store: SimpleClipEmbeddingStore):
+    """Abandon `store` the way a killed process would, after whatever it has written so far."""
+    if store._compactor is not None:
+        store._compactor.wait_until_idle()
+    store._log.close()
+
+
+def columns(store: SimpleClipEmbeddingStore) -> tuple:
+    return list(store.image_paths), list(store.image_ids), list(store.image_hashes), store.image_embeddings.clone()
+
+
+def assert_same_columns(store: SimpleClipEmbeddingStore, expected: tuple):
+    paths, ids, hashes, embeddings = columns(store)
+    assert (paths, ids, hashes) == expected[:3]
+    assert torch.equal(embeddings, expected[3])
+
+
+def test_logged_mutations_are_replayed(tmp_path, make_images):
+    store_file = tmp_path / 'store'
+    store = open_store(store_file)
+    store.add_images(make_images(['a.jpg', 'b.jpg', 'c.jpg']), show_pbar=False)
+    store.save()
+    store.add_images(make_images(['d.jpg', 'e.jpg']), show_pbar=False)
+    store.remove_image(store.image_ids[1])
+    expected = columns(store)
+    crash(store)
+
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+
+
+def test_torn_record_is_dropped(tmp_path, make_images):
+    store_file = tmp_path / 'store'
+    store = open_store(store_file)
+    store.add_images(make_images(['a.jpg']), show_pbar=False)
+    expected = columns(store)
+    store.add_images(make_images(['b.jpg']), show_pbar=False)
+    segment_path = store._log.segment_path(store._log.current_segment)
+    crash(store)
+    with open(segment_path, 'r+b') as f:
+        f.truncate(os.path.getsize(segment_path) - 3)
+
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+    # later mutations go to a new segment, so they survive the next restart despite the torn record before them
+    store.add_images(make_images(['c.jpg']), show_pbar=False)
+    expected = columns(store)
+    crash(store)
+    assert_same_columns(open_store(store_file), expected)
+
+
+def test_interrupted_snapshot_is_not_loaded(tmp_path, monkeypatch, make_images):
+    store_file = tmp_path / 'store'
+    store = open_store(store_file)
+    store.add_images(make_images(['a.jpg', 'b.jpg']), show_pbar=False)
+    store.save()
+    store.add_images(make_images(['c.jpg']), show_pbar=False)
+    expected = columns(store)
+
+    def fail_header_replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, 'replace', fail_header_replace)
+    with pytest.raises(OSError):
+        store.save()
+    monkeypatch.undo()
+    crash(store)
+
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+    store._compactor.wait_until_idle()
+    # the files of the interrupted snapshot are cleaned up
+    live_files = {os.path.basename(p) for p in store_format._get_sidecar_paths(str(store_file))}
+    snapshot_files = {name for name in os.listdir(tmp_path) if re.fullmatch(r'store\.[0-9a-f]{12}\.\w+', name)}
+    assert snapshot_files == live_files
+
+
+def test_failed_snapshot_is_not_taken_for_current(tmp_path, monkeypatch, make_images):
+    store_file = tmp_path / 'store'
+    store = open_store(store_file)
+    store.add_images(make_images([f'{i}.jpg' for i in range(8)]), show_pbar=False)
+    store.build_ann_index(nlist=2, m=2)
+    store.save()
+    store.add_images(make_images(['new.jpg']), show_pbar=False)
+
+    def fail_header_replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, 'replace', fail_header_replace)
+    with pytest.raises(OSError):
+        store.save()
+    monkeypatch.undo()
+
+    # so saving the ANN index writes the snapshot that's missing, rather than an index that doesn't match it
+    store.save_ann_index()
+    assert store_format.read_native_store(str(store_file))['image_paths'] == store.image_paths
+    expected = columns(store)
+    crash(store)
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+    assert store.ann_index is not None and store.ann_index.num_rows == 9
+
+
+def test_compaction_folds_the_log_into_a_snapshot(tmp_path, make_images):
+    store_file = tmp_path / 'store'
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(store_file), compact_after_log_bytes=1)
+    store.add_images(make_images(['a.jpg', 'b.jpg']), show_pbar=False)
+    store._compactor.wait_until_idle()
+    expected = columns(store)
+    crash(store)
+
+    # the snapshot alone holds everything, and the log segments it replaces are gone
+    snapshot = store_format.read_native_store(str(store_file))
+    assert snapshot['image_paths'] == expected[0]
+    assert min(store._log.existing_segments()) == snapshot['log_segment'] > 0
+    assert_same_columns(open_store(store_file), expected)
+
+
+def test_moved_images_are_replayed(tmp_path, make_images):
+    store_file = tmp_path / 'store'
+    store = open_store(store_file)
+    paths = make_images(['0.jpg', '1.jpg', '2.jpg'])
+    store.add_images(paths, show_pbar=False)
+    store.save()
+    ids = list(store.image_ids)
+    moved_path = str(tmp_path / 'images' / 'moved.jpg')
+    os.rename(paths[1], moved_path)
+    # the content is already in the store, so the image is moved rather than added
+    store.add_images([moved_path], show_pbar=False)
+    assert store.image_ids == ids and store.image_paths[1] == moved_path
+    expected = columns(store)
+    crash(store)
+
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+    assert not store.has_image(paths[1])
+    assert store.get_image_path_for_id(ids[1]) == moved_path
+
+
+def test_regenerated_image_ids_are_replayed(tmp_path, monkeypatch):
+    store_file = tmp_path / 'store'
+    paths = [f'/images/{i}.jpg' for i in range(4)]
+    # a legacy store without image ids, which get generated when it is loaded
+    torch.save(dict(version=4, identifier=FakeClipModel.distinct_identifier, image_paths=paths, image_ids=None,
+                    image_embeddings=torch.randn(4, EMBEDDING_DIM), image_hashes=[f'hash-{i}' for i in range(4)],
+                    texts=[], text_embeddings=None), store_file)
+    # crash before the background conversion to the native format writes the new ids into a snapshot
+    monkeypatch.setattr(CoalescingWorker, 'request', lambda self: None)
+    store = open_store(store_file)
+    ids = list(store.image_ids)
+    store.remove_image(ids[0])
+    expected = columns(store)
+    crash(store)
+
+    store = open_store(store_file)
+    assert_same_columns(store, expected)
+    assert store.image_ids == ids[1:]
+    assert np.array_equal(store.get_rows_for_ids(ids), [-1, 0, 1, 2])
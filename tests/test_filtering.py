@@ -0,0 +1,200 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from clip_finder_backend.embedding_store import Query, SimpleClipEmbeddingStore
+from clip_finder_backend.filtering import RowFilter, get_included_rows
+from clip_finder_backend.metadata_backends import SidecarMetadataBackend
+from clip_finder_backend.tag_index import TagIndex
+from clip_finder_backend.types import ResultFilters
+from conftest import FakeClipModel
+
+NAMES = ['holiday/beach.jpg', 'holiday/forest.jpg', 'work/beach.jpg', 'work/desk.jpg', 'home/cat.jpg', 'home/beach cat.jpg']
+TAGS = {'holiday/beach.jpg': ['sea', 'sun'], 'holiday/forest.jpg': ['trees'], 'work/beach.jpg': ['sea'],
+        'home/cat.jpg': ['cat'], 'home/beach cat.jpg': ['cat', 'sea', 'sun']}
+
+
+@pytest.fixture
+def store(make_images) -> SimpleClipEmbeddingStore:
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    store.add_images(make_images(NAMES), show_pbar=False)
+    return store
+
+
+@pytest.fixture
+def tagged_store(store) -> SimpleClipEmbeddingStore:
+    backend = SidecarMetadataBackend()
+    for path in store.image_paths:
+        backend.set_tags(path, tags_of(path))
+    tag_index = TagIndex(backend)
+    tag_index.refresh(store.image_paths, show_pbar=False)
+    store.attach_tag_index(tag_index)
+    return store
+
+
+def tags_of(path: str) -> list[str]:
+    return next((tags for name, tags in TAGS.items() if path.endswith(name)), [])
+
+
+def reference_mask(store, row_filter: RowFilter) -> np.ndarray:
+    def passes(path, image_id):
+        tags = set(tags_of(path))
+        return ((not row_filter.path_contains_any or any(f in path for f in row_filter.path_contains_any))
+                and not any(f in path for f in row_filter.path_contains_none)
+                and (row_filter.required_image_ids is None or image_id in row_filter.required_image_ids)
+                and image_id not in row_filter.excluded_image_ids
+                and (not row_filter.tags_any or bool(tags & set(row_filter.tags_any)))
+                and set(row_filter.tags_all) <= tags
+                and not tags & set(row_filter.tags_none))
+    return np.array([passes(p, i) for p, i in zip(store.image_paths, store.image_ids)])
+
+
+def test_compile_mask_matches_a_row_by_row_check(store):
+    ids = store.image_ids
+    filters = [
+        RowFilter(path_contains_any=('beach',)),
+        RowFilter(path_contains_any=('beach', 'cat')),
+        RowFilter(path_contains_none=('work', 'forest')),
+        RowFilter(path_contains_any=('beach',), path_contains_none=('holiday',)),
+        RowFilter(required_image_ids=(ids[0], ids[3], 'unknown-id')),
+        RowFilter(required_image_ids=()),
+        RowFilter(excluded_image_ids=(ids[1], 'unknown-id')),
+        RowFilter(path_contains_any=('beach',), required_image_ids=(ids[0], ids[2], ids[5]), excluded_image_ids=(ids[2],)),
+    ]
+    for row_filter in filters:
+        assert np.array_equal(row_filter.compile_mask(store), reference_mask(store, row_filter)), row_filter
+
+
+def test_empty_filter_compiles_to_none(store):
+    assert RowFilter().compile_mask(store) is None
+    assert Query.text_query('cat').to_row_filter().compile_mask(store) is None
+    assert np.array_equal(get_included_rows(ResultFilters(), store), np.arange(len(NAMES)))
+
+
+def test_get_included_rows(store):
+    filters = ResultFilters(pathContains=['beach', ''], pathNotContains=['home'])
+    assert list(get_included_rows(filters, store)) == [0, 2]
+
+
+def test_path_masks_follow_mutations(store, make_images):
+    assert RowFilter(path_contains_any=('beach',)).compile_mask(store).sum() == 3
+    store.add_images(make_images(['more/beach.jpg']), show_pbar=False)
+    store.remove_image(store.image_ids[0])
+    mask = RowFilter(path_contains_any=('beach',)).compile_mask(store)
+    assert len(mask) == len(NAMES) and mask.sum() == 3
+    assert store.image_paths[-1].endswith('more/beach.jpg') and mask[-1]
+
+
+@pytest.mark.parametrize('sort_order', ['similarity', 'similarity_asc'])
+def test_search_returns_only_rows_passing_the_filter(store, sort_order):
+    query_embedding = torch.randn(FakeClipModel.embedding_dim)
+    query = Query.vector_query(query_embedding.tolist())
+    query.required_path_contains = 'beach'
+    query.excluded_image_ids = [store.image_ids[2]]
+    query.sort_order = sort_order
+    results, total_available = store.search_images(query, return_total_available=True)
+
+    allowed = [i for i, p in enumerate(store.image_paths) if 'beach' in p and i != 2]
+    similarities = (store.image_embeddings[allowed] @ (query_embedding / query_embedding.norm())).tolist()
+    expected = [store.image_ids[i] for _, i in sorted(zip(similarities, allowed), reverse=sort_order == 'similarity')]
+    assert total_available == len(allowed)
+    assert [r.id for r in results] == expected
+
+    query.offset, query.limit = 1, 10
+    assert [r.id for r in store.search_images(query)] == expected[1:]
+
+
+def test_rows_removed_while_scoring_dont_disturb_the_search(store, monkeypatch):
+    query = Query.vector_query(torch.randn(FakeClipModel.embedding_dim).tolist())
+    query.required_path_contains = 'beach'
+    beaches = [i for i, p in enumerate(store.image_paths) if 'beach' in p]
+    compute_similarities = store._compute_similarities
+
+    def remove_during_scoring(*args):
+        # from another thread, which would wait forever if scoring held the store's lock
+        remover = threading.Thread(target=store.remove_image, args=(store.image_ids[0],))
+        remover.start()
+        remover.join(timeout=5)
+        assert not remover.is_alive()
+        return compute_similarities(*args)
+    monkeypatch.setattr(store, '_compute_similarities', remove_during_scoring)
+    ordering = store._compute_search_ordering(query)
+    # the order is of the rows as they were when the search started
+    assert ordering.total_available == len(beaches) and sorted(ordering.rows.tolist()) == beaches
+    assert len(store.image_paths) == len(NAMES) - 1
+
+
+def test_tag_predicates_match_a_row_by_row_check(tagged_store):
+    filters = [
+        RowFilter(tags_any=('sea',)),
+        RowFilter(tags_any=('trees', 'cat', 'unknown')),
+        RowFilter(tags_all=('sea', 'sun')),
+        RowFilter(tags_all=('unknown',)),
+        RowFilter(tags_none=('sea',)),
+        RowFilter(tags_any=('sea', 'cat'), tags_all=('sun',), tags_none=('cat',)),
+        RowFilter(path_contains_any=('beach',), tags_none=('sun',)),
+    ]
+    for row_filter in filters:
+        assert np.array_equal(row_filter.compile_mask(tagged_store), reference_mask(tagged_store, row_filter)), row_filter
+
+
+def test_get_included_rows_honours_tags(tagged_store):
+    filters = ResultFilters(requiredTagsOr=['sea', 'trees'], excludedTags=['sun'], pathNotContains=['forest'])
+    assert list(get_included_rows(filters, tagged_store)) == [2]
+
+
+def test_tag_filtered_search_follows_tag_edits(tagged_store, monkeypatch):
+    query_embedding = torch.randn(FakeClipModel.embedding_dim).tolist()
+    query = Query.vector_query(query_embedding)
+    query.required_tags_or = ['cat']
+    untagged_query = Query.vector_query(query_embedding)
+    assert sorted(r.path for r in tagged_store.search_images(query)) == sorted(p for p in tagged_store.image_paths if 'cat' in tags_of(p))
+    tagged_store.search_images(untagged_query)
+
+    work_beach = next(p for p in tagged_store.image_paths if p.endswith('work/beach.jpg'))
+    tagged_store.tag_index.set_tags(work_beach, ['sea', 'cat'])
+    computed = []
+    compute = tagged_store._compute_search_ordering
+    monkeypatch.setattr(tagged_store, '_compute_search_ordering', lambda q, *args: computed.append(q) or compute(q, *args))
+    assert work_beach in [r.path for r in tagged_store.search_images(query)]
+    # orders of queries without tag predicates don't depend on tags, and stay cached
+    tagged_store.search_images(untagged_query)
+    assert computed == [query]
+
+
+def test_cursors_of_tag_filtered_searches_expire_with_tag_edits(tagged_store):
+    query = Query.vector_query(torch.randn(FakeClipModel.embedding_dim).tolist())
+    query.required_tags_or = ['cat']
+    query.cursor = tagged_store.get_search_cursor(query)
+    tagged_store.search_images(query)
+    assert tagged_store.get_search_cursor(query) == query.cursor
+
+    work_beach = next(p for p in tagged_store.image_paths if p.endswith('work/beach.jpg'))
+    tagged_store.tag_index.set_tags(work_beach, ['sea', 'cat'])
+    assert tagged_store.get_cached_search_ordering(query.cursor) is None
+    assert tagged_store.get_search_cursor(query) != query.cursor
+    assert work_beach in [r.path for r in tagged_store.search_images(query)]
+
+
+def test_tag_predicates_need_a_tag_index(store):
+    query = Query.text_query('cat')
+    query.excluded_tags = ['sea']
+    with pytest.raises(RuntimeError):
+        store.search_images(query)
+
+
+def test_tag_predicates_wait_for_the_tag_index(store):
+    backend = SidecarMetadataBackend()
+    for path in store.image_paths:
+        backend.set_tags(path, tags_of(path))
+    tag_index = TagIndex(backend)
+    # like TagsWrangler.ensure_index_refreshed, which waits for the refresh started at startup
+    store.attach_tag_index(tag_index, ensure_current=lambda: tag_index.refresh(store.image_paths, show_pbar=False))
+    query = Query.vector_query(torch.randn(FakeClipModel.embedding_dim).tolist())
+    query.required_tags_or = ['cat']
+    assert sorted(r.path for r in store.search_images(query)) == sorted(p for p in store.image_paths if 'cat' in tags_of(p))
+    assert np.array_equal(RowFilter(tags_all=('sea', 'sun')).compile_mask(store),
+                          reference_mask(store, RowFilter(tags_all=('sea', 'sun'))))
+
@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+import torch
+from PIL import Image
+
+from clip_finder_backend.clip_modelling import ClipModel
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from clip_finder_backend.thumbnail_provider import ThumbnailProvider
+
+
+class TinyImageEncoder:
+    """Embeds a preprocessed image as its mean colour, so the embedding identifies the image it came from."""
+    def __init__(self):
+        self.batch_sizes = []
+
+    def encode_image(self, images: torch.Tensor, normalize=True) -> torch.Tensor:
+        self.batch_sizes.append(images.shape[0])
+        return images.mean(dim=(2, 3)) + 1
+
+
+def preprocess(img: Image.Image) -> torch.Tensor:
+    return torch.tensor(list(img.resize((4, 4)).getdata()), dtype=torch.float32).T.reshape(3, 4, 4) / 255
+
+
+@pytest.fixture
+def model() -> ClipModel:
+    model = ClipModel(device='cpu', decode_workers=3, prefetch_images=5)
+    model.model = TinyImageEncoder()
+    model.preprocess = preprocess
+    return model
+
+
+@pytest.fixture
+def images(tmp_path) -> list[str]:
+    paths = []
+    for i in range(23):
+        path = str(tmp_path / f'{i}.png')
+        Image.new('RGB', (8, 8), (i * 10, 0, 255 - i * 10)).save(path)
+        paths.append(path)
+    return paths
+
+
+def expected_embedding(path: str) -> torch.Tensor:
+    features = preprocess(Image.open(path).convert('RGB')).mean(dim=(1, 2)) + 1
+    return features / features.norm()
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 10, 50])
+def test_embeddings_are_yielded_in_input_order(model, images, batch_size):
+    results = list(model.get_image_features_batched(images, batch_size=batch_size, show_pbar=False))
+    assert [image for image, _ in results] == images
+    for image, embedding in results:
+        assert torch.allclose(embedding, expected_embedding(image))
+    assert max(model.model.batch_sizes) <= batch_size
+    assert sum(model.model.batch_sizes) == len(images)
+
+
+def test_images_that_fail_to_decode_are_skipped(model, images, tmp_path):
+    broken = str(tmp_path / 'broken.png')
+    with open(broken, 'wb') as f:
+        f.write(b'not an image')
+    missing = str(tmp_path / 'missing.png')
+    mixed = images[:3] + [broken] + images[3:7] + [missing]
+
+    results = list(model.get_image_features_batched(mixed, batch_size=4, show_pbar=False))
+    assert [image for image, _ in results] == images[:7]
+    assert model.model.batch_sizes == [4, 3]
+    with pytest.raises(RuntimeError):
+        model.get_image_features(broken)
+
+
+def test_decoding_stays_a_bounded_distance_ahead(model, images, monkeypatch):
+    decoded = []
+    lock = threading.Lock()
+    original = model._preprocess_image
+
+    def counting_preprocess(image, *args):
+        with lock:
+            decoded.append(image)
+        return original(image, *args)
+    monkeypatch.setattr(model, '_preprocess_image', counting_preprocess)
+
+    results = model.get_image_features_batched(images, batch_size=2, show_pbar=False, prefetch_images=6)
+    next(results)
+    # the first batch of two consumed one more image each, on top of the prefetched ones
+    assert len(decoded) <= 6 + 2
+    assert len(list(results)) == len(images) - 1
+    assert sorted(decoded) == sorted(images)
+
+
+
+def test_decoded_images_are_passed_to_the_hook(model, images, tmp_path):
+    rotated = str(tmp_path / 'rotated.jpg')
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new('RGB', (8, 4), (10, 20, 30)).save(rotated, exif=exif)
+    decoded = {}
+    lock = threading.Lock()
+
+    def on_image_decoded(path, img):
+        with lock:
+            decoded[path] = (img.mode, img.size)
+    results = list(model.get_image_features_batched(images[:3] + [rotated], show_pbar=False, on_image_decoded=on_image_decoded))
+    assert len(results) == 4
+    assert decoded == {**{path: ('RGB', (8, 8)) for path in images[:3]}, rotated: ('RGB', (4, 8))}
+
+
+def test_failing_hook_does_not_drop_the_image(model, images):
+    def on_image_decoded(path, img):
+        raise OSError('disk full')
+    results = list(model.get_image_features_batched(images, show_pbar=False, on_image_decoded=on_image_decoded))
+    assert [image for image, _ in results] == images
+
+
+def test_added_images_get_thumbnails(model, images, tmp_path):
+    model.clip_name, model.embedding_dim = 'tiny', 3
+    store = SimpleClipEmbeddingStore(model, store_file=str(tmp_path / 'store'))
+    provider = ThumbnailProvider(cache_dir=str(tmp_path / 'thumbnails'))
+    added, _ = store.add_images(images[:4], show_pbar=False, thumbnail_provider=provider)
+    assert added == images[:4]
+    assert all(provider.get_thumbnail_path(path, tier).exists() for path in added for tier in provider.size_tiers)
+    assert provider.get_stats()['prewarmed'] == 4 * len(provider.size_tiers)
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from clip_finder_backend.indexing_jobs import IndexingJobManager
+from clip_finder_backend.progress_manager import ProgressStatus
+from conftest import FakeClipModel
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+NAMES = [f'{i}.png' for i in range(6)]
+
+
+class RecordingProgressManager:
+    """Records the progress updates that would be sent over the WebSocket."""
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name not in ('start_task', 'update_task_progress', 'complete_task', 'fail_task'):
+            raise AttributeError(name)
+        return lambda task_id, *args, **kwargs: self.calls.append((name, task_id, args, kwargs))
+
+    def calls_for(self, task_id, name):
+        return [(args, kwargs) for n, t, args, kwargs in self.calls if n == name and t == task_id]
+
+
+@pytest.fixture
+def root(tmp_path, make_images) -> str:
+    make_images(NAMES, [PNG_SIGNATURE + name.encode('utf-8') for name in NAMES])
+    return str(tmp_path / 'images')
+
+
+@pytest.fixture
+def store(tmp_path) -> SimpleClipEmbeddingStore:
+    return SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+
+
+@pytest.fixture
+def progress_manager() -> RecordingProgressManager:
+    return RecordingProgressManager()
+
+
+def wait_until_finished(manager: IndexingJobManager, job_id: str, timeout=10):
+    deadline = time.time() + timeout
+    while (info := manager.get_job(job_id)).finished_at is None:
+        assert time.time() < deadline, f'job {job_id} did not finish: {info}'
+        time.sleep(0.01)
+    return info
+
+
+def test_job_indexes_the_directory_and_reports_progress(store, root, progress_manager):
+    manager = IndexingJobManager(store, progress_manager, batch_size=2)
+    job_id = manager.start_job(root).job_id
+    info = wait_until_finished(manager, job_id)
+
+    assert info.status == 'completed' and info.num_added == len(NAMES) == len(store.image_paths)
+    assert info.num_processed == info.num_found == len(NAMES) and info.scan_complete
+    assert info.images_per_second > 0 and info.eta_seconds is None
+    updates = progress_manager.calls_for(job_id, 'update_task_progress')
+    assert [args[0] for args, _ in updates][-1] == 100
+    assert [job.job_id for job in manager.list_jobs()] == [job_id]
+    (_, kwargs), = progress_manager.calls_for(job_id, 'complete_task')
+    assert kwargs['data']['num_added'] == len(NAMES)
+
+
+def test_cancelled_job_keeps_what_it_added(store, root, progress_manager):
+    manager = IndexingJobManager(store, progress_manager, batch_size=1)
+    started = threading.Event()
+    proceed = threading.Event()
+    add_images = store.add_images
+
+    def blocking_add_images(paths, **kwargs):
+        result = add_images(paths, **kwargs)
+        started.set()
+        proceed.wait(10)
+        return result
+    store.add_images = blocking_add_images
+
+    job_id = manager.start_job(root).job_id
+    assert started.wait(10)
+    assert manager.cancel_job(job_id).status == 'running'
+    proceed.set()
+    info = wait_until_finished(manager, job_id)
+
+    assert info.status == 'cancelled'
+    assert info.num_added == len(store.image_paths) == 1
+    (_, kwargs), = progress_manager.calls_for(job_id, 'complete_task')
+    assert kwargs['status'] == ProgressStatus.CANCELLED
+
+
+def test_queued_jobs_run_in_order_and_can_be_cancelled_before_starting(store, root, tmp_path, progress_manager, make_images):
+    proceed = threading.Event()
+    add_images = store.add_images
+    store.add_images = lambda paths, **kwargs: proceed.wait(10) and add_images(paths, **kwargs)
+    manager = IndexingJobManager(store, progress_manager)
+
+    first = manager.start_job(root, job_id='first')
+    second = manager.start_job(root, job_id='second')
+    assert second.status == 'queued'
+    assert manager.cancel_job('second').status == 'cancelled'
+    assert manager.cancel_job('unknown') is None
+    with pytest.raises(ValueError):
+        manager.start_job(root, job_id='first')
+    proceed.set()
+
+    assert wait_until_finished(manager, first.job_id).status == 'completed'
+    assert manager.get_job('second').started_at is None
+
+
+def test_failing_job_reports_the_error(store, root, progress_manager):
+    def failing_add_images(paths, **kwargs):
+        raise OSError('disk full')
+    store.add_images = failing_add_images
+    manager = IndexingJobManager(store, progress_manager)
+    job_id = manager.start_job(root).job_id
+    info = wait_until_finished(manager, job_id)
+    assert info.status == 'error' and 'disk full' in info.error
+    assert len(progress_manager.calls_for(job_id, 'fail_task')) == 1
+
+
+def test_jobs_are_throttled(store, root, progress_manager):
+    manager = IndexingJobManager(store, progress_manager, batch_size=2)
+    info = wait_until_finished(manager, manager.start_job(root, max_images_per_second=40).job_id)
+    # the last batch may finish at once; everything before it is held back to the rate
+    assert info.finished_at - info.started_at >= (len(NAMES) - 2) / 40
+    assert info.images_per_second <= 40 * 1.1
+
+
+def test_throttled_job_is_cancelled_without_waiting_out_the_throttle(store, root, progress_manager):
+    manager = IndexingJobManager(store, progress_manager, batch_size=1)
+    job_id = manager.start_job(root, max_images_per_second=0.1).job_id
+    deadline = time.time() + 10
+    while not store.image_paths:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    # the job is now waiting 10s for the rate to drop to the limit
+    cancelled_at = time.time()
+    manager.cancel_job(job_id)
+    info = wait_until_finished(manager, job_id)
+    assert info.status == 'cancelled' and info.finished_at - cancelled_at < 2
+    assert len(store.image_paths) == 1
+
+
+def test_only_directories_can_be_indexed(store, root, progress_manager):
+    manager = IndexingJobManager(store, progress_manager)
+    with pytest.raises(ValueError):
+        manager.start_job(f'{root}/0.png')
+    assert manager.list_jobs() == []
@@ -0,0 +1,92 @@
+import pytest
+import torch
+
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from clip_finder_backend.ingestion_checkpoint import IngestionCheckpoint
+from conftest import FakeClipModel
+
+NAMES = [f'{i}.jpg' for i in range(9)]
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingClipModel(FakeClipModel):
+    """Crashes on the `crash_at`th image, and records which images were embedded."""
+    def __init__(self, crash_at: int = None):
+        self.crash_at = crash_at
+        self.embedded = []
+
+    def get_image_features_batched(self, paths, batch_size=10, show_pbar=True, **kwargs):
+        for path in paths:
+            if len(self.embedded) == self.crash_at:
+                raise Crash()
+            self.embedded.append(path)
+            yield path, self.get_image_features(path)
+
+
+def open_store(tmp_path, clip_model) -> SimpleClipEmbeddingStore:
+    return SimpleClipEmbeddingStore(clip_model, store_file=str(tmp_path / 'store'))
+
+
+def test_increments_are_committed_and_reported(tmp_path, make_images):
+    paths = make_images(NAMES)
+    store = open_store(tmp_path, FakeClipModel())
+    progress = []
+    added, embeddings = store.add_images(paths, show_pbar=False, commit_every=4,
+                                         progress_callback=lambda p, message: progress.append(p))
+    assert added == paths == store.image_paths
+    assert torch.equal(embeddings, store.image_embeddings)
+    assert progress == [4 / 9, 8 / 9, 1.0]
+    assert IngestionCheckpoint.find(store.store_file) == []
+    assert store.add_images(paths, return_embeddings=False) == ([], None)
+
+
+def test_interrupted_ingestion_resumes_from_its_checkpoint(tmp_path, make_images):
+    paths = make_images(NAMES)
+    clip_model = CrashingClipModel(crash_at=7)
+    store = open_store(tmp_path, clip_model)
+    with pytest.raises(Crash):
+        store.add_images(paths, show_pbar=False, commit_every=2, checkpoint_every=4)
+    assert store.image_paths == paths[:6]
+    checkpoint, = IngestionCheckpoint.find(store.store_file)
+    assert checkpoint.load() == paths[4:]
+    store._compactor.wait_until_idle()
+    store._log.close()
+
+    clip_model = CrashingClipModel()
+    store = open_store(tmp_path, clip_model)
+    assert store.image_paths == paths[:6]
+    assert store.has_pending_ingestion()
+    assert store.resume_ingestion(show_pbar=False, commit_every=2) == 3
+    # images that were committed before the crash are not embedded again
+    assert clip_model.embedded == paths[6:]
+    assert store.image_paths == paths
+    assert not store.has_pending_ingestion()
+    assert store.resume_ingestion(show_pbar=False) == 0
+
+
+def test_small_ingestions_and_stores_without_a_file_keep_no_checkpoint(tmp_path, make_images):
+    paths = make_images(NAMES)
+    store = open_store(tmp_path, CrashingClipModel(crash_at=2))
+    with pytest.raises(Crash):
+        store.add_images(paths[:3], show_pbar=False, commit_every=3)
+    assert not store.has_pending_ingestion()
+
+    in_memory = SimpleClipEmbeddingStore(CrashingClipModel(crash_at=5))
+    with pytest.raises(Crash):
+        in_memory.add_images(paths, show_pbar=False, commit_every=2)
+    assert in_memory.image_paths == paths[:4]
+    assert not in_memory.has_pending_ingestion() and in_memory.resume_ingestion() == 0
+
+
+def test_checkpoint_round_trip(tmp_path):
+    store_file = str(tmp_path / 'store')
+    first = IngestionCheckpoint.create(store_file, ['/a.jpg', '/b.jpg'])
+    second = IngestionCheckpoint.create(store_file, ['/c.jpg'])
+    assert {c.path for c in IngestionCheckpoint.find(store_file)} == {first.path, second.path}
+    first.save(['/b.jpg'])
+    assert first.load() == ['/b.jpg']
+    first.remove()
+    assert [c.path for c in IngestionCheckpoint.find(store_file)] == [second.path]
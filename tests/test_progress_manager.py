@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from clip_finder_backend.progress_manager import ProgressManager
+
+
+class FakeWebSocket:
+    """Records what is sent to it. Sends block while `blocked` is cleared, like a client that stopped reading."""
+    def __init__(self):
+        self.received = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+    async def send_text(self, text: str):
+        while not self.blocked.is_set():
+            await asyncio.sleep(0.01)
+        self.received.append(json.loads(text))
+
+    def statuses(self, task_id: str) -> list[tuple[str, float]]:
+        return [(m['status'], m['progress']) for m in self.received if m['task_id'] == task_id]
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_updates_are_coalesced_and_the_latest_one_is_sent(loop):
+    manager = ProgressManager(min_update_interval=0.3)
+    websocket = FakeWebSocket()
+    manager.add_connection(websocket, loop)
+    manager.start_task('task')
+    for progress in range(50):
+        manager.update_task_progress('task', progress)
+    wait_for(lambda: ('in_progress', 49) in websocket.statuses('task'))
+    assert websocket.statuses('task') == [('started', 0), ('in_progress', 49)]
+
+
+def test_final_state_is_sent_at_once_and_drops_pending_updates(loop):
+    manager = ProgressManager(min_update_interval=0.2)
+    websocket = FakeWebSocket()
+    manager.add_connection(websocket, loop)
+    manager.start_task('task')
+    manager.update_task_progress('task', 10)
+    manager.update_task_progress('task', 20)
+    manager.complete_task('task', 'done')
+    wait_for(lambda: ('completed', 100) in websocket.statuses('task'))
+    time.sleep(0.3)
+    assert websocket.statuses('task') == [('started', 0), ('completed', 100)]
+
+
+def test_slow_client_gets_only_the_latest_update_of_each_task(loop):
+    manager = ProgressManager(min_update_interval=0)
+    websocket = FakeWebSocket()
+    manager.add_connection(websocket, loop)
+    websocket.blocked.clear()
+    manager.start_task('a')
+    manager.start_task('b')
+    for progress in range(100):
+        manager.update_task_progress('a', progress)
+        manager.update_task_progress('b', progress)
+    websocket.blocked.set()
+    wait_for(lambda: ('in_progress', 99) in websocket.statuses('a') and ('in_progress', 99) in websocket.statuses('b'))
+    # whatever was already being sent when the client stalled, then only the latest of each
+    assert len(websocket.received) <= 6
+    assert manager.connections
+
+
+def test_clients_that_fall_behind_are_disconnected(loop):
+    manager = ProgressManager(max_waiting_messages=3)
+    stalled, healthy = FakeWebSocket(), FakeWebSocket()
+    manager.add_connection(stalled, loop)
+    manager.add_connection(healthy, loop)
+    stalled.blocked.clear()
+    for task in range(5):
+        manager.start_task(f'task-{task}')
+        # the healthy client keeps up
+        wait_for(lambda: len(healthy.received) == task + 1)
+    assert [c.websocket for c in manager.connections] == [healthy]
+    stalled.blocked.set()
+
+
+def test_sends_time_out(loop):
+    manager = ProgressManager(send_timeout=0.1)
+    websocket = FakeWebSocket()
+    websocket.blocked.clear()
+    manager.add_connection(websocket, loop)
+    manager.start_task('task')
+    wait_for(lambda: not manager.connections)
+
+
+def test_new_connections_get_the_active_tasks(loop):
+    manager = ProgressManager()
+    manager.start_task('running')
+    manager.update_task_progress('running', 40)
+    websocket = FakeWebSocket()
+    manager.add_connection(websocket, loop)
+    wait_for(lambda: websocket.received)
+    assert websocket.statuses('running') == [('in_progress', 40)]
+
+
+def test_finished_tasks_are_forgotten(loop):
+    manager = ProgressManager(keep_finished_seconds=0.1)
+    manager.start_task('a')
+    manager.fail_task('a', 'it broke', error_details='disk full')
+    assert manager.active_tasks['a'].message == 'it broke\nError details: disk full'
+    manager.start_task('b')
+    wait_for(lambda: 'a' not in manager.active_tasks)
+    assert 'b' in manager.active_tasks
+
+
+def test_remove_connection(loop):
+    manager = ProgressManager()
+    first, second = FakeWebSocket(), FakeWebSocket()
+    manager.add_connection(first, loop)
+    manager.add_connection(second, loop)
+    manager.remove_connection(first)
+    assert [c.websocket for c in manager.connections] == [second]
+    manager.remove_connection(first)
+    manager.remove_connection(second)
+    assert manager.connections == []
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+import torch
+
+from clip_finder_backend.embedding_store import Query, SimpleClipEmbeddingStore
+from clip_finder_backend.quantization import QuantizationSettings, QuantizedEmbeddings, measure_recall
+from conftest import FakeClipModel
+
+
+def unit_rows(num_rows: int, dim: int = 64, seed: int = 0) -> torch.Tensor:
+    rows = torch.randn(num_rows, dim, generator=torch.Generator().manual_seed(seed))
+    return rows / rows.norm(dim=1, keepdim=True)
+
+
+@pytest.mark.parametrize('kind, tolerance', [('float16', 1e-3), ('int8', 2e-2)])
+def test_scores_approximate_inner_products(kind, tolerance):
+    embeddings = unit_rows(500)
+    quantized = QuantizedEmbeddings(QuantizationSettings(kind=kind), embedding_dim=64, block_size=64)
+    quantized.add(embeddings)
+    queries = unit_rows(3, seed=1)
+    assert torch.allclose(quantized.scores(queries), queries @ embeddings.T, atol=tolerance)
+    rows = torch.tensor([5, 0, 499])
+    assert torch.allclose(quantized.scores(queries, rows), queries @ embeddings[rows].T, atol=tolerance)
+    assert quantized.nbytes <= embeddings.numel() * embeddings.element_size() / (2 if kind == "float16" else 3.5)
+
+
+def test_rescoring_recovers_exact_recall():
+    result = measure_recall(unit_rows(2000), QuantizationSettings(kind='int8', rescore_top_k=200), num_queries=20, k=20)
+    assert result['recall'] >= 0.9
+    assert result['rescored_recall'] == 1.0
+
+
+def test_sign_prefilter_keeps_rows_passing_the_mask():
+    embeddings = unit_rows(1000)
+    settings = QuantizationSettings(kind='int8', sign_prefilter=True, prefilter_candidates=100)
+    quantized = QuantizedEmbeddings.from_embeddings(embeddings, settings)
+    query = embeddings[:1]
+    candidates = quantized.prefilter(query)
+    assert len(candidates) == 100 and 0 in candidates.tolist()
+
+    row_mask = np.zeros(1000, dtype=bool)
+    row_mask[500:550] = True
+    assert quantized.prefilter(query, row_mask).tolist() == list(range(500, 550))
+    # nothing to rule out in a small corpus
+    assert QuantizedEmbeddings.from_embeddings(embeddings[:100], settings).prefilter(query) is None
+
+
+@pytest.mark.parametrize('sign_prefilter', [False, True])
+def test_copy_follows_store_row_changes(sign_prefilter):
+    settings = QuantizationSettings(kind='int8', sign_prefilter=sign_prefilter)
+    embeddings = unit_rows(300)
+    quantized = QuantizedEmbeddings.from_embeddings(embeddings[:200], settings)
+    quantized.add(embeddings[200:])
+    keep = np.flatnonzero(np.arange(300) % 4 != 0)
+    quantized.keep_rows(keep)
+    replaced_rows = np.array([1, 50])
+    quantized.replace_rows(replaced_rows, unit_rows(2, seed=3))
+
+    expected_embeddings = embeddings[torch.from_numpy(keep)].clone()
+    expected_embeddings[torch.from_numpy(replaced_rows)] = unit_rows(2, seed=3)
+    expected = QuantizedEmbeddings.from_embeddings(expected_embeddings, settings)
+    assert torch.equal(quantized.values, expected.values) and torch.equal(quantized.scales, expected.scales)
+    assert np.array_equal(quantized.sign_bits, expected.sign_bits)
+
+
+@pytest.mark.parametrize('sort_order', ['similarity', 'similarity_asc', 'similarity_max', 'similarity_avg'])
+def test_quantized_store_search_matches_exact_search(make_images, sort_order):
+    paths = make_images([f'{i}.jpg' for i in range(100)])
+    exact_store = SimpleClipEmbeddingStore(FakeClipModel())
+    quantized_store = SimpleClipEmbeddingStore(FakeClipModel(), quantization=QuantizationSettings(kind='int8', rescore_top_k=100))
+    for store in [exact_store, quantized_store]:
+        store.add_images(paths, show_pbar=False)
+        store.remove_image(store.image_ids[10])
+    assert quantized_store._quantized.num_rows == 99
+
+    query = Query.text_query_with_weights(['a cat', 'a dog'], [1.0, 0.5])
+    query.sort_order = sort_order
+    exact = exact_store.search_images(query)
+    quantized = quantized_store.search_images(query)
+    assert [r.path for r in quantized] == [r.path for r in exact]
+    assert np.allclose([r.similarity for r in quantized], [r.similarity for r in exact], atol=1e-5)
@@ -0,0 +1,149 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from clip_finder_backend.embedding_store import Query, SimpleClipEmbeddingStore
+from clip_finder_backend.result_cache import ResultOrderCache, SearchOrdering
+from clip_finder_backend.single_flight import SingleFlight
+from conftest import FakeClipModel
+
+
+def ordering(num_rows: int) -> SearchOrdering:
+    return SearchOrdering(rows=torch.arange(num_rows, dtype=torch.int32), similarities=torch.zeros(num_rows),
+                          total_available=num_rows)
+
+
+def test_cache_is_an_lru_bounded_by_bytes():
+    cache = ResultOrderCache(max_bytes=3 * ordering(10).nbytes)
+    for key in ['a', 'b', 'c']:
+        cache.get_or_compute(key, lambda: ordering(10))
+    cache.get('a')
+    cache.get_or_compute('d', lambda: ordering(10))
+    assert 'a' in cache and 'b' not in cache and 'c' in cache and 'd' in cache
+    # an ordering larger than the whole cache is returned but not kept
+    assert cache.get_or_compute('huge', lambda: ordering(100)).total_available == 100
+    assert 'huge' not in cache and 'a' in cache
+
+
+def test_invalidation_discards_orderings_computed_before_it():
+    cache = ResultOrderCache()
+    cache.get_or_compute('a', lambda: ordering(1))
+    cache.invalidate()
+    assert 'a' not in cache
+
+    def compute_while_the_store_changes():
+        cache.invalidate()
+        return ordering(2)
+    assert cache.get_or_compute('b', compute_while_the_store_changes).total_available == 2
+    assert 'b' not in cache
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    single_flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(single_flight.do, 'key', slow_call)
+        started.wait(5)
+        followers = [executor.submit(single_flight.do, 'key', slow_call) for _ in range(3)]
+        release.set()
+        assert [f.result() for f in [leader] + followers] == ['result'] * 4
+    assert len(calls) == 1
+    # once the call is done, the key is free again
+    assert single_flight.do('key', lambda: 'again') == 'again'
+
+
+def test_single_flight_passes_exceptions_to_every_caller():
+    single_flight = SingleFlight()
+    with pytest.raises(ValueError):
+        single_flight.do('key', lambda: (_ for _ in ()).throw(ValueError("boom")))
+    with ThreadPoolExecutor(1) as executor:
+        release = threading.Event()
+        first = single_flight.submit('key', lambda: release.wait(5) and 1, executor)
+        assert single_flight.submit('key', lambda: 2, executor) is first
+        release.set()
+        assert first.result() == 1
+
+
+@pytest.fixture
+def store(make_images) -> SimpleClipEmbeddingStore:
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    store.add_images(make_images([f'{i}.jpg' for i in range(20)]), show_pbar=False)
+    return store
+
+
+def count_computations(store, monkeypatch) -> list:
+    computations = []
+    compute = store._compute_search_ordering
+
+    def counting_compute(*args, **kwargs):
+        computations.append(1)
+        return compute(*args, **kwargs)
+    monkeypatch.setattr(store, '_compute_search_ordering', counting_compute)
+    return computations
+
+
+def test_pages_of_a_query_share_one_ordering(store, monkeypatch):
+    computations = count_computations(store, monkeypatch)
+    query = Query.text_query('a cat')
+    query.limit = 5
+    pages = []
+    for offset in range(0, 20, 5):
+        query.offset = offset
+        page, total_available = store.search_images(query, return_total_available=True)
+        pages.extend(r.id for r in page)
+    assert len(computations) == 1 and total_available == 20
+    assert sorted(pages) == sorted(store.image_ids)
+
+    query.offset, query.limit = 0, 20
+    assert [r.id for r in store.search_images(query)] == pages
+    assert len(computations) == 1
+
+
+def test_changed_images_invalidate_cached_orderings(store, monkeypatch, make_images):
+    computations = count_computations(store, monkeypatch)
+    query = Query.text_query('a cat')
+    store.search_images(query)
+    store.get_text_embedding('a dog')
+    store.search_images(query)
+    assert len(computations) == 1
+
+    removed_id = store.image_ids[0]
+    store.remove_image(removed_id)
+    assert removed_id not in [r.id for r in store.search_images(query)]
+    store.add_images(make_images(['new/0.jpg']), show_pbar=False)
+    assert len(store.search_images(query)) == 20
+    assert len(computations) == 3
+
+
+def test_cursor_is_the_key_the_ordering_is_cached_under(store, monkeypatch):
+    computations = count_computations(store, monkeypatch)
+    query = Query.text_query('a cat')
+    query.limit = 5
+    query.cursor = store.get_search_cursor(query)
+    first_page = store.search_images(query)
+    assert query.cursor in store._result_cache
+
+    # further pages are found by their cursor alone
+    monkeypatch.setattr(Query, 'cache_key', lambda self: pytest.fail('the query was normalized again'))
+    query.offset = 5
+    assert store.get_search_cursor(query) == query.cursor
+    assert not {r.id for r in store.search_images(query)} & {r.id for r in first_page}
+    assert len(computations) == 1
+
+
+def test_unknown_cursor_is_ignored(store):
+    query = Query.text_query('a cat')
+    expected = store.get_search_cursor(query)
+    query.cursor = 'not-a-cursor'
+    assert store.get_search_cursor(query) == expected
+    assert len(store.search_images(query)) == 20
@@ -0,0 +1,60 @@
+import numpy as np
+
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from conftest import FakeClipModel
+
+
+def assert_indexes_match_columns(store: SimpleClipEmbeddingStore):
+    rows = np.arange(len(store.image_paths))
+    assert np.array_equal(store.get_rows_for_paths(store.image_paths), rows)
+    assert np.array_equal(store.get_rows_for_ids(store.image_ids), rows)
+    assert len(store._path_to_row) == len(store._id_to_row) == len(rows)
+
+
+def test_lookups_follow_additions_and_removals(make_images):
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    paths = make_images([f'{i}.jpg' for i in range(8)])
+    store.add_images(paths[:5], show_pbar=False)
+    store.add_images(paths[5:], show_pbar=False)
+    assert_indexes_match_columns(store)
+
+    removed_ids = [store.image_ids[1], store.image_ids[6]]
+    for image_id in removed_ids:
+        store.remove_image(image_id)
+    assert_indexes_match_columns(store)
+    assert store.image_paths == [p for i, p in enumerate(paths) if i not in (1, 6)]
+    assert list(store.get_rows_for_ids(removed_ids + [store.image_ids[-1]])) == [-1, -1, 5]
+    assert list(store.get_rows_for_paths([paths[1], paths[7], '/not/there.jpg'])) == [-1, 5, -1]
+    assert store.get_image_paths_for_ids([store.image_ids[2], removed_ids[0]]) == [paths[3], None]
+    assert not store.has_image(paths[6]) and store.has_image(paths[7])
+
+
+def test_lookups_survive_a_reload(tmp_path, make_images):
+    store_file = str(tmp_path / 'store')
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    paths = make_images(['a.jpg', 'b.jpg', 'c.jpg'])
+    store.add_images(paths, show_pbar=False)
+    store.save()
+    store.remove_image(store.image_ids[0])
+    ids = list(store.image_ids)
+    store._compactor.wait_until_idle()
+
+    # loaded from the snapshot, with the removal replayed from the log
+    reloaded = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    assert_indexes_match_columns(reloaded)
+    assert reloaded.get_image_ids_for_paths(paths) == ids
+    assert reloaded.get_image_path_for_id(ids[1]) == paths[2]
+
+
+def test_duplicate_paths_are_added_once(make_images):
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    paths = make_images(['a.jpg', 'b.jpg', 'c.jpg'])
+    store.add_images(paths[:1], show_pbar=False)
+    store.add_images([paths[1], paths[0], paths[2], paths[1]], show_pbar=False)
+    assert store.image_paths == paths
+    assert_indexes_match_columns(store)
+
+    store.remove_image(store.image_ids[1])
+    assert store.image_paths == [paths[0], paths[2]]
+    assert_indexes_match_columns(store)
+
@@ -0,0 +1,190 @@
+import os
+import threading
+
+import pytest
+import torch
+
+from clip_finder_backend import scanner
+from clip_finder_backend.embedding_store import ShardedEmbeddingStore, SimpleClipEmbeddingStore
+from conftest import FakeClipModel
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png(name: str) -> bytes:
+    return PNG_SIGNATURE + name.encode('utf-8')
+
+
+@pytest.fixture
+def root(tmp_path, make_images) -> str:
+    names = ['a.png', 'b.png', 'sub/c.png', 'sub/deeper/d.png']
+    make_images(names, [png(name) for name in names])
+    make_images(['notes.txt', 'sub/e.png'], [b'just some text', b'not really a png'])
+    return str(tmp_path / 'images')
+
+
+@pytest.fixture
+def store(tmp_path) -> SimpleClipEmbeddingStore:
+    return SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+
+
+def test_images_are_recognised_by_their_signature(tmp_path):
+    signatures = {'jpeg': b'\xff\xd8\xff\xe0', 'png': PNG_SIGNATURE, 'gif': b'GIF89a', 'webp': b'RIFF\0\0\0\0WEBPVP8 ',
+                  'heic': b'\0\0\0\x18ftypheic', 'text': b'hello world', 'empty': b''}
+    for name, header in signatures.items():
+        (tmp_path / name).write_bytes(header + b'\0' * 8)
+    assert {name for name in signatures if scanner.looks_like_image(str(tmp_path / name))} == \
+           {'jpeg', 'png', 'gif', 'webp', 'heic'}
+    assert not scanner.looks_like_image(str(tmp_path / 'missing'))
+
+
+def test_only_images_are_added(store, root):
+    assert store.add_images_recursively(root) == 4
+    assert sorted(os.path.relpath(p, root) for p in store.image_paths) == \
+           ['a.png', 'b.png', os.path.join('sub', 'c.png'), os.path.join('sub', 'deeper', 'd.png')]
+
+
+def test_unchanged_files_are_not_opened_again(store, root, monkeypatch):
+    store.add_images_recursively(root)
+    manifest_file = scanner.get_manifest_file(f'{store.store_file}.scan_manifests', root)
+    assert os.path.exists(manifest_file)
+
+    monkeypatch.setattr(scanner, 'looks_like_image', lambda path: pytest.fail(f'{path} was opened again'))
+    assert store.add_images_recursively(root) == 0
+    assert len(store.image_paths) == 4
+
+
+def test_new_changed_and_removed_files(store, root, make_images):
+    store.add_images_recursively(root)
+    changed = os.path.join(root, 'b.png')
+    changed_id, = store.get_image_ids_for_paths([changed])
+    embedding_before = store.image_embeddings[store.image_paths.index(changed)].clone()
+    with open(changed, 'wb') as f:
+        f.write(png('b, edited'))
+    os.remove(os.path.join(root, 'a.png'))
+    new_path, = make_images(['sub/new.png'], [png('new')])
+
+    assert store.add_images_recursively(root) == 1
+    assert new_path in store.image_paths
+    # the changed image keeps its row and id, and gets a new embedding
+    assert store.get_image_ids_for_paths([changed]) == [changed_id]
+    embedding_after = store.image_embeddings[store.image_paths.index(changed)]
+    assert not torch.equal(embedding_after, embedding_before)
+    assert torch.equal(embedding_after, FakeClipModel().get_image_features(changed))
+
+    manifest = scanner.ScanManifest(root, scanner.get_manifest_file(f'{store.store_file}.scan_manifests', root))
+    assert os.path.join(root, 'a.png') not in manifest.files
+    assert manifest.files[new_path].is_image and not manifest.files[os.path.join(root, 'notes.txt')].is_image
+
+
+def test_touched_files_with_the_same_content_are_not_embedded_again(store, root, monkeypatch):
+    store.add_images_recursively(root)
+    touched = os.path.join(root, 'b.png')
+    os.utime(touched, ns=(1, 1))
+    monkeypatch.setattr(store.clip_model, 'get_image_features_batched',
+                        lambda paths, **kwargs: pytest.fail(f'the model was run on {paths}'))
+    assert store.add_images_recursively(root) == 0
+    manifest = scanner.ScanManifest(root, scanner.get_manifest_file(f'{store.store_file}.scan_manifests', root))
+    assert manifest.files[touched].mtime_ns == 1
+
+
+def test_changed_image_that_fails_to_decode_keeps_its_embedding(store, root, monkeypatch):
+    store.add_images_recursively(root)
+    changed = os.path.join(root, 'b.png')
+    embedding_before = store.image_embeddings[store.image_paths.index(changed)].clone()
+    with open(changed, 'wb') as f:
+        f.write(png('b, half written'))
+    monkeypatch.setattr(store.clip_model, 'get_image_features_batched', lambda paths, **kwargs: iter(()))
+    assert store.add_images_recursively(root) == 0
+    assert torch.equal(store.image_embeddings[store.image_paths.index(changed)], embedding_before)
+
+    # it isn't opened again until it changes, then it is re-embedded
+    monkeypatch.undo()
+    monkeypatch.setattr(scanner, 'looks_like_image', lambda path: pytest.fail(f'{path} was opened again'))
+    assert store.add_images_recursively(root) == 0
+    monkeypatch.undo()
+    with open(changed, 'wb') as f:
+        f.write(png('b, fully written'))
+    store.add_images_recursively(root)
+    assert torch.equal(store.image_embeddings[store.image_paths.index(changed)], FakeClipModel().get_image_features(changed))
+
+
+def test_new_image_that_fails_to_decode_is_skipped_until_it_changes(store, root, monkeypatch):
+    broken = os.path.join(root, 'a.png')
+    get_image_features_batched = store.clip_model.get_image_features_batched
+    monkeypatch.setattr(store.clip_model, 'get_image_features_batched',
+                        lambda paths, **kwargs: get_image_features_batched([p for p in paths if p != broken], **kwargs))
+    assert store.add_images_recursively(root) == 3
+    monkeypatch.undo()
+
+    opened = []
+    looks_like_image = scanner.looks_like_image
+    monkeypatch.setattr(scanner, 'looks_like_image', lambda path: opened.append(path) or looks_like_image(path))
+    assert store.add_images_recursively(root) == 0
+    assert opened == [] and not store.has_image(broken)
+
+    with open(broken, 'wb') as f:
+        f.write(png('a, fixed'))
+    assert store.add_images_recursively(root) == 1
+    assert opened == [broken] and store.has_image(broken)
+
+
+def test_sharded_store_keeps_the_manifest_next_to_its_editable_shard(tmp_path, root, monkeypatch):
+    editable_shard = SimpleClipEmbeddingStore(FakeClipModel(), store_file=str(tmp_path / 'store'))
+    sharded = ShardedEmbeddingStore(FakeClipModel(), [SimpleClipEmbeddingStore(FakeClipModel())])
+    with pytest.raises(RuntimeError):
+        sharded.add_images_recursively(root)
+    sharded.add_shard(editable_shard, editable=True)
+    assert sharded.add_images_recursively(root) == 4
+    assert os.path.exists(scanner.get_manifest_file(f'{editable_shard.store_file}.scan_manifests', root))
+
+    monkeypatch.setattr(scanner, 'looks_like_image', lambda path: pytest.fail(f'{path} was opened again'))
+    assert sharded.add_images_recursively(root) == 0
+
+
+def test_images_are_added_in_batches_while_scanning(store, root):
+    added_batches = []
+    original_add_images = store.add_images
+
+    def add_images(paths, *args, **kwargs):
+        added_batches.append(len(paths))
+        return original_add_images(paths, *args, **kwargs)
+    store.add_images = add_images
+
+    assert scanner.add_images_recursively(store, root, batch_size=3) == 4
+    assert sum(added_batches) == 4 and max(added_batches) <= 3
+
+
+def test_progress_is_reported_after_every_batch(store, root):
+    progress = []
+    assert scanner.add_images_recursively(store, root, batch_size=1,
+                                          progress_callback=lambda *args: progress.append(args)) == 4
+    num_processed = [num_processed for num_processed, _, _ in progress]
+    assert num_processed == sorted(num_processed) and set(num_processed) == {1, 2, 3, 4}
+    assert all(num_found >= num_processed for num_processed, num_found, _ in progress)
+    assert progress[-1] == (4, 4, True)
+
+
+def test_cancelling_stops_after_the_current_batch(store, root):
+    cancel_event = threading.Event()
+    num_added = scanner.add_images_recursively(store, root, batch_size=1, cancel_event=cancel_event,
+                                               progress_callback=lambda *args: cancel_event.set())
+    assert num_added == len(store.image_paths) == 1
+    # the rest is added by the next scan
+    assert store.add_images_recursively(root) == 3
+
+
+def test_manifest_of_another_root_is_ignored(tmp_path, root):
+    manifest_file = str(tmp_path / 'manifest')
+    manifest = scanner.ScanManifest(root, manifest_file)
+    manifest.files['/elsewhere/a.png'] = scanner.FileState(1, 2, 3, True)
+    manifest.save()
+    assert scanner.ScanManifest(root, manifest_file).files
+    assert not scanner.ScanManifest(str(tmp_path), manifest_file).files
+
+
+def test_stores_without_a_file_keep_no_manifest(tmp_path, root):
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    assert store.add_images_recursively(root) == 4
+    assert store.add_images_recursively(root) == 0
+    assert sorted(os.listdir(tmp_path)) == ['images']
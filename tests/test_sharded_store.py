@@ -0,0 +1,141 @@
+import pytest
+import torch
+
+from clip_finder_backend import zero_shot
+from clip_finder_backend.embedding_store import Query, ShardedEmbeddingStore, SimpleClipEmbeddingStore
+from clip_finder_backend.types import ZeroShotClassifyRequest
+from conftest import FakeClipModel
+
+
+@pytest.fixture
+def paths(make_images) -> list[str]:
+    return make_images([f'{i}.jpg' for i in range(30)])
+
+
+@pytest.fixture
+def sharded(paths) -> ShardedEmbeddingStore:
+    shards = []
+    for start, end in [(0, 12), (12, 13), (13, 30)]:
+        shard = SimpleClipEmbeddingStore(FakeClipModel())
+        shard.add_images(paths[start:end], show_pbar=False)
+        shards.append(shard)
+    shards.append(SimpleClipEmbeddingStore(FakeClipModel()))
+    return ShardedEmbeddingStore(FakeClipModel(), shards, search_workers=2)
+
+
+@pytest.fixture
+def unsharded(paths) -> SimpleClipEmbeddingStore:
+    store = SimpleClipEmbeddingStore(FakeClipModel())
+    store.add_images(paths, show_pbar=False)
+    return store
+
+
+def page(store, query: Query, offset: int, limit: int) -> list[tuple[str, float]]:
+    query = query.model_copy(update=dict(offset=offset, limit=limit))
+    return [(r.path, round(r.similarity, 5)) for r in store.search_images(query)]
+
+
+@pytest.mark.parametrize('sort_order', ['similarity', 'similarity_asc', 'similarity_max', 'direction'])
+def test_merged_pages_match_an_unsharded_store(sharded, unsharded, sort_order):
+    query = Query.text_query_with_weights(['a cat', 'a dog'], [1.0, 0.5])
+    query.sort_order = sort_order
+    expected = page(unsharded, query, 0, 30)
+    for offset, limit in [(0, 30), (0, 7), (5, 10), (25, 10), (40, 5)]:
+        assert page(sharded, query, offset, limit) == expected[offset:offset + limit]
+    assert sharded.search_images(query, return_total_available=True)[1] == 30
+
+
+def test_filters_apply_in_every_shard(sharded, unsharded):
+    query = Query.text_query('a cat')
+    query.required_path_contains = 'images/1'
+    results, total_available = sharded.search_images(query, return_total_available=True)
+    assert total_available == 11
+    assert [r.path for r in results] == [r.path for r in unsharded.search_images(query)]
+
+
+def test_image_queries_resolve_across_shards(sharded, unsharded, paths):
+    query_path = paths[20]
+    query = Query(texts=['a cat'], image_ids=[sharded.shards[2].get_image_ids_for_paths([query_path])[0]], weights=[0.5, 1.0])
+    original = query.model_dump()
+    results = sharded.search_images(query)
+    assert query.model_dump() == original
+    assert results[0].path == query_path
+
+    expected = unsharded.search_images(Query(texts=['a cat'], image_ids=unsharded.get_image_ids_for_paths([query_path]),
+                                             weights=[0.5, 1.0]))
+    assert [r.path for r in results] == [r.path for r in expected]
+
+
+def test_progress_is_averaged_across_shards(sharded):
+    reported = []
+    sharded.search_images(Query.text_query('a cat'), progress_callback=lambda progress, message: reported.append(progress))
+    assert reported[-1] == 1
+    assert all(0 <= p <= 1 for p in reported)
+
+
+def test_ids_and_paths_route_to_their_shard(sharded, paths):
+    for shard in sharded.shards:
+        for path, image_id in zip(shard.image_paths, shard.image_ids):
+            assert sharded.get_image_path_for_id(image_id) == path
+            assert sharded.get_image_ids_for_paths([path]) == [image_id]
+            assert sharded.has_image(path)
+            assert torch.equal(sharded.get_image_embedding(path), shard.image_embeddings[shard.get_rows_for_paths([path])[0]])
+    assert sharded.get_image_path_for_id('unknown-id') is None
+    assert not sharded.has_image('/not/there.jpg')
+    assert sorted(sharded.image_paths) == sorted(paths)
+
+    # in the order asked for, across shards
+    found_paths, embeddings = sharded.get_image_embeddings([paths[20], paths[3], paths[12]])
+    assert found_paths == [paths[20], paths[3], paths[12]]
+    assert torch.equal(embeddings[0], sharded.shards[2].get_image_embedding(paths[20]))
+
+
+def test_routes_follow_changes_made_through_the_shards(sharded, paths, make_images):
+    shard = sharded.shards[0]
+    image_id = shard.get_image_ids_for_paths([paths[5]])[0]
+    # removed behind the sharded store's back
+    shard.remove_image(image_id)
+    assert not sharded.has_image(paths[5])
+    assert sharded.get_image_path_for_id(image_id) is None
+
+    [new_path] = make_images(['new.jpg'])
+    sharded.shards[3].add_images([new_path], show_pbar=False)
+    assert sharded.get_image_ids_for_paths([new_path]) == sharded.shards[3].image_ids
+
+    moved_id = sharded.get_image_ids_for_paths([paths[13]])[0]
+    sharded.remove_image(moved_id)
+    assert not sharded.shards[2].has_image(paths[13])
+    with pytest.raises(ValueError):
+        sharded.remove_image(moved_id)
+
+
+def test_unknown_paths_are_added_to_the_editable_shard(sharded, make_images):
+    editable = SimpleClipEmbeddingStore(FakeClipModel())
+    sharded.add_shard(editable, editable=True)
+    [new_path] = make_images(['new.jpg'])
+    found_paths, _ = sharded.get_image_embeddings([new_path])
+    assert found_paths == [new_path]
+    assert editable.image_paths == [new_path]
+    assert sharded.get_image_path_for_id(editable.image_ids[0]) == new_path
+
+
+def test_cursor_skips_resolving_the_query(sharded, unsharded, monkeypatch):
+    query = Query.text_query('a cat')
+    query.cursor = sharded.get_search_cursor(query)
+    first_page = page(sharded, query, 0, 10)
+    monkeypatch.setattr(sharded, '_resolve_query', lambda q: pytest.fail('the query was resolved again'))
+    assert sharded.get_search_cursor(query) == query.cursor
+    assert first_page + page(sharded, query, 10, 20) == page(unsharded, Query.text_query('a cat'), 0, 30)
+
+
+def test_zero_shot_classification_matches_an_unsharded_store(sharded, unsharded, monkeypatch):
+    monkeypatch.setattr(zero_shot, '_order_tsne_2d', lambda probs, normalize=False: probs)
+    request = ZeroShotClassifyRequest.model_validate(dict(
+        classes=[dict(id='cats', texts=['a cat', 'a kitten']), dict(id='dogs', texts=['a dog'])],
+        filters=dict(pathNotContains=['images/1']), include_tags=False))
+
+    def classify(store):
+        return sorted((c.image.path, c.best_cls, round(c.entropy, 5)) for c in zero_shot.do_zero_shot_classify(store, request))
+    expected = classify(unsharded)
+    assert len(expected) == 19
+    assert classify(sharded) == expected
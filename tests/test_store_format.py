@@ -0,0 +1,97 @@
+import os
+
+import pytest
+import torch
+
+from clip_finder_backend import store_format
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from conftest import EMBEDDING_DIM, FakeClipModel
+
+
+def write(path, count=3, dtype=torch.float32, **overrides):
+    columns = dict(identifier='fake-clip',
+                   image_embeddings=torch.randn(count, EMBEDDING_DIM).to(dtype),
+                   image_ids=[f'id-{i}' for i in range(count)],
+                   image_paths=[f'/images/ünïcode {i}.jpg' for i in range(count)],
+                   image_hashes=[f'hash-{i}' for i in range(count)],
+                   text_embeddings=torch.randn(2, EMBEDDING_DIM),
+                   texts=['a cat', 'a dog'])
+    columns.update(overrides)
+    store_format.write_native_store(str(path), **columns)
+    return columns
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip(tmp_path, dtype, mmap):
+    columns = write(tmp_path / 'store', dtype=dtype)
+    assert store_format.is_native_store_file(str(tmp_path / 'store'))
+    loaded = store_format.read_native_store(str(tmp_path / 'store'), mmap=mmap)
+    assert loaded['identifier'] == 'fake-clip'
+    assert loaded['image_embeddings'].dtype == dtype
+    for key, value in columns.items():
+        if isinstance(value, torch.Tensor):
+            assert torch.equal(loaded[key], value)
+        else:
+            assert loaded[key] == value
+
+
+def test_empty_store_round_trip(tmp_path):
+    write(tmp_path / 'store', count=0, texts=[], text_embeddings=torch.empty(0, EMBEDDING_DIM))
+    loaded = store_format.read_native_store(str(tmp_path / 'store'))
+    assert loaded['image_paths'] == [] and loaded['texts'] == []
+    assert loaded['image_embeddings'].shape == (0, EMBEDDING_DIM)
+
+
+def test_save_replaces_the_previous_sidecars(tmp_path):
+    path = str(tmp_path / 'store')
+    write(path)
+    first_sidecars = store_format._get_sidecar_paths(path)
+    mapped = store_format.read_native_store(path, mmap=True)['image_embeddings']
+    columns = write(path, count=5)
+
+    assert not any(os.path.exists(p) for p in first_sidecars)
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(p) for p in store_format._get_sidecar_paths(path)] + ['store'])
+    assert torch.equal(store_format.read_native_store(path)['image_embeddings'], columns['image_embeddings'])
+    # an existing mapping of the replaced files stays readable
+    assert mapped.shape == (3, EMBEDDING_DIM) and torch.isfinite(mapped).all()
+
+
+def test_column_length_mismatch_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        write(tmp_path / 'store', image_ids=['only-one'])
+    with pytest.raises(ValueError):
+        write(tmp_path / 'store', image_paths=['a\0b', 'c', 'd'])
+    assert not os.path.exists(tmp_path / 'store')
+
+
+def test_legacy_store_is_rewritten_in_the_native_format(tmp_path):
+    store_file = str(tmp_path / 'store')
+    embeddings = torch.randn(2, EMBEDDING_DIM)
+    torch.save(dict(version=5, identifier=FakeClipModel.distinct_identifier, image_paths=['/a.jpg', '/b.jpg'],
+                    image_ids=['id-a', 'id-b'], image_embeddings=embeddings, image_hashes=['hash-a', 'hash-b'],
+                    texts=[], text_embeddings=torch.empty(0, EMBEDDING_DIM)), store_file)
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    assert store.image_paths == ['/a.jpg', '/b.jpg']
+    store.save()
+    # the conversion was also scheduled in the background when the legacy store was loaded
+    store._compactor.wait_until_idle()
+    assert store_format.is_native_store_file(store_file)
+
+    reloaded = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    assert reloaded.image_ids == ['id-a', 'id-b'] and reloaded.image_hashes == ['hash-a', 'hash-b']
+    assert torch.equal(reloaded.image_embeddings, embeddings)
+
+
+def test_store_saves_and_loads_added_images(tmp_path, make_images):
+    store_file = str(tmp_path / 'store')
+    store = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    paths = make_images(['a.jpg', 'b.jpg', 'c.jpg'])
+    store.add_images(paths, show_pbar=False)
+    store.save()
+
+    reloaded = SimpleClipEmbeddingStore(FakeClipModel(), store_file=store_file)
+    assert reloaded.image_paths == store.image_paths
+    assert reloaded.image_ids == store.image_ids
+    assert reloaded.image_hashes == store.image_hashes
+    assert torch.equal(reloaded.image_embeddings, store.image_embeddings)
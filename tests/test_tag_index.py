@@ -0,0 +1,223 @@
+"""TagIndex against real metadata backends in a temporary directory."""
+import errno
+import json
+import os
+
+import pytest
+
+from clip_finder_backend.metadata_backends import SidecarMetadataBackend, XattrMetadataBackend
+from clip_finder_backend.tag_index import TagIndex
+from clip_finder_backend.tags_wrangler import TagsWrangler
+
+
+def _xattrs_supported(directory) -> bool:
+    path = os.path.join(directory, 'probe')
+    open(path, 'w').close()
+    try:
+        os.setxattr(path, XattrMetadataBackend.attribute, b'probe')
+        return True
+    except (OSError, AttributeError):
+        return False
+    finally:
+        os.remove(path)
+
+
+@pytest.fixture(params=['sidecar', 'xattr'])
+def backend(request, tmp_path):
+    if request.param == 'sidecar':
+        return SidecarMetadataBackend()
+    if not _xattrs_supported(tmp_path):
+        pytest.skip("the temporary directory doesn't support user xattrs")
+    return XattrMetadataBackend()
+
+
+@pytest.fixture
+def images(tmp_path, backend) -> dict[str, str]:
+    tags = {'beach': ['sea', 'sun'], 'forest': ['trees'], 'harbour': ['sea', 'boats'], 'blank': []}
+    paths = {}
+    for name, image_tags in tags.items():
+        paths[name] = str(tmp_path / f'{name}.jpg')
+        open(paths[name], 'wb').close()
+        set_tags(backend, paths[name], image_tags)
+    return paths
+
+
+def set_tags(backend, path: str, tags: list[str]):
+    """Write `tags` and make sure the change marker moves, even on filesystems with coarse timestamps."""
+    backend.set_tags(path, tags)
+    marked_path = backend.sidecar_path(path) if isinstance(backend, SidecarMetadataBackend) else path
+    if os.path.exists(marked_path):
+        stat = os.stat(marked_path)
+        os.utime(marked_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_refresh_reads_only_new_and_changed_files(backend, images):
+    index = TagIndex(backend)
+    assert index.refresh(list(images.values()), show_pbar=False) == len(images)
+    assert sorted(index.get_tags(images['beach'])) == ['sea', 'sun']
+    assert index.refresh(list(images.values()), show_pbar=False) == 0
+
+    set_tags(backend, images['forest'], ['trees', 'fog'])
+    assert index.refresh(list(images.values()), show_pbar=False) == 1
+    assert sorted(index.get_tags(images['forest'])) == ['fog', 'trees']
+
+
+def test_refresh_drops_paths_that_are_gone(backend, images):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+    os.remove(images['harbour'])
+    index.refresh(list(images.values()), show_pbar=False)
+    assert index.get_tags(images['harbour']) is None
+    # and paths that are no longer in the library
+    index.refresh([images['beach']], show_pbar=False)
+    assert index.num_paths == 1
+
+
+def test_get_current_tags_rereads_changed_files(backend, images):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+    set_tags(backend, images['blank'], ['new'])
+    missing_path = images['blank'] + '.missing'
+    blank_tags, beach_tags, missing_tags = index.get_current_tags([images['blank'], images['beach'], missing_path])
+    assert (blank_tags, sorted(beach_tags), missing_tags) == (['new'], ['sea', 'sun'], None)
+    assert index.get_paths_for_tags(any_tags=['new']) == [images['blank']]
+
+
+def test_current_tags_of_unchanged_files_come_from_the_index(backend, images, monkeypatch):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+    monkeypatch.setattr(backend, 'get_tags', lambda path: pytest.fail(f'the tags of {path} were read again'))
+    harbour_tags, blank_tags = index.get_current_tags([images['harbour'], images['blank']])
+    assert (sorted(harbour_tags), blank_tags) == (['boats', 'sea'], [])
+
+def test_get_paths_for_tags(backend, images):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+
+    def query(**kwargs):
+        return sorted(os.path.basename(p)[:-4] for p in index.get_paths_for_tags(**kwargs))
+    assert query(any_tags=['sun', 'trees']) == ['beach', 'forest']
+    assert query(all_tags=['sea', 'boats']) == ['harbour']
+    assert query(none_tags=['sea']) == ['blank', 'forest']
+    assert query(any_tags=['sea'], none_tags=['sun']) == ['harbour']
+    assert query(any_tags=['unknown']) == []
+    assert query(all_tags=[]) == ['beach', 'blank', 'forest', 'harbour']
+
+
+def test_saved_index_is_loaded(backend, images, tmp_path):
+    index_file = str(tmp_path / 'tag_index.pkl')
+    index = TagIndex(backend, index_file=index_file)
+    index.refresh(list(images.values()), show_pbar=False)
+    assert os.path.exists(index_file)
+
+    loaded = TagIndex(backend, index_file=index_file)
+    assert loaded.num_paths == len(images)
+    for path in images.values():
+        assert sorted(loaded.get_tags(path)) == sorted(index.get_tags(path))
+    assert loaded.get_all_tags() == index.get_all_tags()
+    # the markers were saved too, so nothing needs reading again
+    assert loaded.refresh(list(images.values()), show_pbar=False) == 0
+
+
+def test_index_for_another_backend_is_ignored(images, tmp_path):
+    index_file = str(tmp_path / 'tag_index.pkl')
+    TagIndex(SidecarMetadataBackend(), index_file=index_file).refresh(list(images.values()), show_pbar=False)
+
+    class OtherBackend(SidecarMetadataBackend):
+        name = 'other'
+    assert TagIndex(OtherBackend(), index_file=index_file).num_paths == 0
+
+
+def test_compaction_renumbers_rows(backend, images):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+    rows, layout_generation = index.get_rows_for_paths([images['harbour']])
+    index.remove_paths([images['beach'], images['forest']])
+    assert index.get_paths_for_tags(any_tags=['sea']) == [images['harbour']]
+
+    index._compact()
+    assert index.layout_generation > layout_generation
+    # masks for rows looked up before the compaction are refused, so that they get looked up again
+    assert index.get_tag_mask('sea', rows, layout_generation) is None
+    rows, layout_generation = index.get_rows_for_paths([images['harbour'], images['blank'], images['beach']])
+    assert list(rows) == [0, 1, -1]
+    assert list(index.get_tag_mask('sea', rows, layout_generation)) == [True, False, False]
+    assert sorted(index.get_all_tags()) == ['boats', 'sea']
+
+
+def test_generation_counts_tag_changes(backend, images):
+    index = TagIndex(backend)
+    index.refresh(list(images.values()), show_pbar=False)
+    generation = index.generation
+    index.set_tags(images['beach'], ['sun', 'sea'])
+    assert index.generation == generation
+    index.set_tags(images['beach'], ['sun'])
+    index.remove_paths([images['blank']])
+    assert index.generation == generation + 1
+    index.remove_paths([images['forest']])
+    assert index.generation == generation + 2
+
+def test_backend_round_trip(backend, images):
+    assert sorted(backend.get_tags(images['harbour'])) == ['boats', 'sea']
+    assert backend.get_tags(images['blank']) == []
+    set_tags(backend, images['beach'], [])
+    assert backend.get_tags(images['beach']) == []
+    assert backend.get_tags(images['beach'] + '.missing') is None
+    assert backend.get_change_marker(images['beach'] + '.missing') is None
+
+
+@pytest.mark.parametrize('error', [errno.ENOTSUP, errno.EACCES])
+def test_unreadable_xattrs_are_not_taken_for_no_tags(tmp_path, monkeypatch, error):
+    path = str(tmp_path / 'image.jpg')
+    open(path, 'wb').close()
+
+    def getxattr(p, attribute, error=error):
+        raise OSError(error, os.strerror(error), p)
+    monkeypatch.setattr(os, 'getxattr', getxattr, raising=False)
+    backend = XattrMetadataBackend()
+    with pytest.raises(OSError):
+        backend.get_tags(path)
+    index = TagIndex(backend)
+    index.refresh([path], show_pbar=False)
+    assert index.get_tags(path) is None
+
+    monkeypatch.setattr(os, 'getxattr', lambda p, attribute: getxattr(p, attribute, errno.ENODATA))
+    assert backend.get_tags(path) == []
+
+
+@pytest.fixture
+def known_tags(tmp_path, monkeypatch):
+    known_tags_file = tmp_path / 'known_tags.json'
+    known_tags_file.write_text(json.dumps(['sea', 'sky']))
+    monkeypatch.setenv('CLIPFINDER_KNOWN_TAGS_JSON', str(known_tags_file))
+
+
+def test_wrangler_queries_and_edits_go_through_the_index(backend, images, known_tags, tmp_path):
+    wrangler = TagsWrangler(lambda: list(images.values()), backend=backend, index_file=str(tmp_path / 'tag_index.pkl'))
+    assert wrangler.get_all_known_tags() == ['sea', 'sky']
+    assert sorted(wrangler.get_images_for_tags(['sun', 'boats'])) == sorted([images['beach'], images['harbour']])
+    assert wrangler.get_images_for_tags(['sea', 'sun'], match_all=True) == [images['beach']]
+
+    assert wrangler.add_tag(images['forest'], 'sea')
+    assert not wrangler.add_tag(images['forest'], 'sea')
+    wrangler.remove_tag(images['beach'], 'sea')
+    assert sorted(wrangler.get_images_for_tags(['sea'])) == sorted([images['forest'], images['harbour']])
+    assert sorted(backend.get_tags(images['forest'])) == ['sea', 'trees']
+    with pytest.raises(FileNotFoundError):
+        wrangler.add_tag(images['forest'] + '.missing', 'sea')
+    tags = wrangler.get_tags_for_images([images['forest'], images['beach'], images['beach'] + '.missing'])
+    assert {path: sorted(t) if t is not None else None for path, t in tags.items()} == {
+        images['forest']: ['sea', 'trees'], images['beach']: ['sun'], images['beach'] + '.missing': None}
+
+
+def test_images_added_after_the_refresh_are_indexed(backend, images, known_tags):
+    library = [images['beach'], images['forest']]
+    wrangler = TagsWrangler(lambda: library, backend=backend)
+    wrangler.ensure_index_refreshed()
+    assert wrangler.tag_index.get_paths_for_tags(any_tags=['sea']) == [images['beach']]
+
+    # what the embedding store's rows listener reports
+    library.append(images['harbour'])
+    wrangler.on_rows_added([images['harbour']], ['harbour-id'])
+    wrangler.ensure_index_refreshed()
+    assert sorted(wrangler.tag_index.get_paths_for_tags(any_tags=['sea'])) == sorted([images['beach'], images['harbour']])
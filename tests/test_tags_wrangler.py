@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+
+import pytest
+
+from clip_finder_backend.metadata_backends import SidecarMetadataBackend
+from clip_finder_backend.tags_wrangler import TagsWrangler
+
+
+@pytest.fixture
+def backend() -> SidecarMetadataBackend:
+    return SidecarMetadataBackend()
+
+
+@pytest.fixture
+def images(tmp_path, backend) -> dict[str, str]:
+    tags = {'beach': ['sea', 'sun'], 'forest': ['trees', 'green'], 'harbour': ['ocean', 'boats'], 'blank': []}
+    paths = {}
+    for name, image_tags in tags.items():
+        paths[name] = str(tmp_path / f'{name}.jpg')
+        open(paths[name], 'wb').close()
+        backend.set_tags(paths[name], image_tags)
+    return paths
+
+
+@pytest.fixture
+def wrangler(images, backend, tmp_path, monkeypatch) -> TagsWrangler:
+    known_tags_file = tmp_path / 'known_tags.json'
+    known_tags_file.write_text(json.dumps(['sea', 'ocean', 'sun']))
+    monkeypatch.setenv('CLIPFINDER_KNOWN_TAGS_JSON', str(known_tags_file))
+    return TagsWrangler(list(images.values()), backend=backend, write_workers=4)
+
+
+def test_update_tags(wrangler, backend, images):
+    progress = []
+    missing = images['blank'] + '.missing'
+    result = wrangler.update_tags([images['beach'], images['blank'], images['beach'], missing],
+                                  add=['favourite', 'sun'], remove=['sea', 'favourite'], progress_callback=progress.append)
+    assert result.num_changed == 2 and result.num_unchanged == 0
+    assert list(result.failures) == [missing]
+    assert backend.get_tags(images['beach']) == ['sun', 'favourite']
+    assert backend.get_tags(images['blank']) == ['favourite', 'sun']
+    assert progress[0] == 0 and progress[-1] == 1
+
+    assert wrangler.update_tags([images['beach']], add=['sun']).num_unchanged == 1
+    # the index was updated as the writes landed
+    assert sorted(wrangler.get_images_for_tags(['favourite'])) == sorted([images['beach'], images['blank']])
+
+
+def test_merge_tags(wrangler, backend, images):
+    result = wrangler.merge_tags(['sea', 'ocean', 'water'], 'water')
+    assert result.num_changed == 2 and not result.failures
+    assert backend.get_tags(images['beach']) == ['water', 'sun']
+    assert backend.get_tags(images['harbour']) == ['water', 'boats']
+    assert sorted(wrangler.get_images_for_tags(['water'])) == sorted([images['beach'], images['harbour']])
+    assert wrangler.get_images_for_tags(['sea', 'ocean']) == []
+    assert wrangler.get_all_known_tags() == ['water', 'sun']
+
+
+def test_merging_into_a_tag_an_image_already_has(wrangler, backend, images):
+    backend.set_tags(images['harbour'], ['boats', 'sea', 'ocean'])
+    wrangler.merge_tags(['ocean'], 'sea')
+    assert backend.get_tags(images['harbour']) == ['boats', 'sea']
+
+
+def test_rename_is_a_merge_of_one_tag(wrangler, backend, images):
+    assert wrangler.merge_tags(['green'], 'leafy').num_changed == 1
+    assert backend.get_tags(images['forest']) == ['trees', 'leafy']
+    assert wrangler.merge_tags(['green'], 'leafy').num_changed == 0
+
+
+def test_concurrent_updates_of_the_same_images_are_not_lost(wrangler, backend, tmp_path):
+    paths = []
+    for i in range(30):
+        paths.append(str(tmp_path / f'{i}.jpg'))
+        open(paths[-1], 'wb').close()
+    threads = [threading.Thread(target=wrangler.update_tags, args=(paths,), kwargs={'add': [f'tag-{t}']}) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(sorted(backend.get_tags(p)) == [f'tag-{t}' for t in range(4)] for p in paths)
+
+
+def test_single_tag_edits(wrangler, backend, images):
+    assert wrangler.add_tag(images['blank'], 'new')
+    assert not wrangler.add_tag(images['blank'], 'new')
+    wrangler.remove_tag(images['beach'], 'sea')
+    assert wrangler.get_tags_for_images([images['blank'], images['beach']]) == {images['blank']: ['new'], images['beach']: ['sun']}
+    with pytest.raises(FileNotFoundError):
+        wrangler.remove_tag(os.path.join(os.path.dirname(images['blank']), 'missing.jpg'), 'new')
@@ -0,0 +1,75 @@
+import torch
+
+from clip_finder_backend.embedding_store import SimpleClipEmbeddingStore
+from clip_finder_backend.text_embedding_cache import TextEmbeddingCache
+from conftest import EMBEDDING_DIM, FakeClipModel
+
+
+class CountingClipModel(FakeClipModel):
+    def __init__(self):
+        self.text_batches = []
+
+    def get_text_features(self, text):
+        self.text_batches.append(list(text))
+        return super().get_text_features(text)
+
+
+def close(cache: TextEmbeddingCache):
+    """Let the compactor finish and release the log, as a process exiting would."""
+    cache._compactor.wait_until_idle()
+    cache._log.close()
+
+
+def test_misses_are_encoded_in_one_batch():
+    model = CountingClipModel()
+    cache = TextEmbeddingCache(model)
+    embeddings = cache.get_text_embeddings(['cat', 'dog', 'cat'])
+    assert model.text_batches == [['cat', 'dog']]
+    assert torch.equal(embeddings[0], embeddings[2])
+    assert torch.allclose(embeddings[1], FakeClipModel().get_text_features('dog')[0])
+
+    cache.get_text_embeddings(['dog', 'bird', 'cat'])
+    assert model.text_batches == [['cat', 'dog'], ['bird']]
+    assert (cache.hits, cache.misses) == (3, 3)
+    assert cache.get_text_embeddings([]).shape == (0, EMBEDDING_DIM)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TextEmbeddingCache(FakeClipModel(), capacity=2)
+    cache.get_text_embeddings(['a', 'b'])
+    cache.get_text_embedding('a')
+    cache.get_text_embedding('c')
+    assert 'a' in cache and 'b' not in cache and 'c' in cache and len(cache) == 2
+
+
+def test_entries_survive_a_restart(tmp_path):
+    cache_file = str(tmp_path / 'text_embeddings.pt')
+    cache = TextEmbeddingCache(FakeClipModel(), cache_file=cache_file, identifier='fake-clip')
+    cache.get_text_embeddings(['a', 'b'])
+    cache.save()
+    # only in the log, not in the snapshot
+    cache.get_text_embedding('c')
+    close(cache)
+
+    model = CountingClipModel()
+    reloaded = TextEmbeddingCache(model, cache_file=cache_file, identifier='fake-clip')
+    assert len(reloaded) == 3
+    assert torch.equal(reloaded.get_text_embedding('c'), FakeClipModel().get_text_features('c')[0])
+    assert model.text_batches == []
+    close(reloaded)
+
+    # a cache written for another model is discarded
+    assert len(TextEmbeddingCache(FakeClipModel(), cache_file=cache_file, identifier='other-clip')) == 0
+
+
+def test_texts_in_legacy_store_files_move_to_the_cache(tmp_path):
+    store_file = str(tmp_path / 'store')
+    text_embeddings = torch.randn(2, EMBEDDING_DIM)
+    torch.save(dict(version=5, identifier=FakeClipModel.distinct_identifier, image_paths=[], image_ids=[],
+                    image_embeddings=torch.empty(0, EMBEDDING_DIM), image_hashes=[],
+                    texts=['a cat', 'a dog'], text_embeddings=text_embeddings), store_file)
+    model = CountingClipModel()
+    cache = TextEmbeddingCache(model)
+    store = SimpleClipEmbeddingStore(model, store_file=store_file, text_embedding_cache=cache)
+    assert torch.equal(store.get_text_embeddings(['a dog', 'a cat']), text_embeddings.flip(0))
+    assert model.text_batches == []
@@ -0,0 +1,255 @@
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+import platformdirs
+import pytest
+from PIL import Image
+
+from clip_finder_backend.thumbnail_provider import ThumbnailProvider, pack_thumbnails
+
+EXIF_ORIENTATION = 0x0112
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch) -> ThumbnailProvider:
+    monkeypatch.setattr(platformdirs, 'user_cache_dir', lambda appname: str(tmp_path / 'cache'))
+    return ThumbnailProvider(max_workers=4)
+
+
+def make_jpeg(path, size=(1000, 600), orientation: int = None) -> str:
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[EXIF_ORIENTATION] = orientation
+    Image.new('RGB', size, (200, 30, 30)).save(path, 'JPEG', exif=exif)
+    return str(path)
+
+
+def test_sizes_are_rounded_up_to_a_tier(provider):
+    assert [provider.get_size_tier(s) for s in (1, 128, 129, 256, 300, 512, 4000)] == [128, 128, 256, 256, 512, 512, 512]
+
+
+@pytest.mark.parametrize('size', [None, 100, 256])
+def test_thumbnail_fits_its_tier(provider, tmp_path, size):
+    image_path = make_jpeg(tmp_path / 'wide.jpg')
+    thumbnail_path = provider.get_or_create_thumbnail(image_path, size)
+    tier = provider.get_size_tier(size or 512)
+    with Image.open(thumbnail_path) as thumbnail:
+        assert thumbnail.format == 'JPEG'
+        assert thumbnail.size == (tier, round(tier * 0.6))
+    assert thumbnail_path == provider.get_thumbnail_path(image_path, size)
+    assert not list(tmp_path.glob('cache/**/*.tmp'))
+
+
+def test_exif_orientation_is_applied(provider, tmp_path):
+    image_path = make_jpeg(tmp_path / 'rotated.jpg', orientation=6)
+    with Image.open(provider.get_or_create_thumbnail(image_path, 128)) as thumbnail:
+        assert thumbnail.size == (77, 128)
+
+
+def test_concurrent_requests_share_one_decode(provider, tmp_path, monkeypatch):
+    image_path = make_jpeg(tmp_path / 'a.jpg')
+    opened = []
+    original_open = Image.open
+
+    def slow_open(path, *args, **kwargs):
+        opened.append(path)
+        time.sleep(0.1)
+        return original_open(path, *args, **kwargs)
+    monkeypatch.setattr(Image, 'open', slow_open)
+
+    futures = [provider.get_or_create_thumbnail_async(image_path, 256) for _ in range(8)]
+    assert len({future.result() for future in futures}) == 1
+    assert opened == [image_path]
+    # a cached thumbnail is returned without going through the pool
+    assert provider.get_or_create_thumbnail_async(image_path, 256).done()
+    assert opened == [image_path]
+
+
+def test_different_tiers_are_made_in_parallel(provider, tmp_path, monkeypatch):
+    image_path = make_jpeg(tmp_path / 'a.jpg')
+    both_started = threading.Barrier(2, timeout=5)
+    original_open = Image.open
+
+    def waiting_open(path, *args, **kwargs):
+        both_started.wait()
+        return original_open(path, *args, **kwargs)
+    monkeypatch.setattr(Image, 'open', waiting_open)
+
+    small, large = provider.get_or_create_thumbnail_async(image_path, 128), provider.get_or_create_thumbnail_async(image_path, 512)
+    assert small.result() != large.result()
+
+
+def test_undecodable_image_fails(provider, tmp_path):
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'not a jpeg')
+    with pytest.raises(RuntimeError):
+        provider.get_or_create_thumbnail(str(broken))
+    assert not provider.get_thumbnail_path(str(broken)).exists()
+
+
+def make_thumbnails(provider, tmp_path, count: int) -> list[Path]:
+    """Thumbnails of `count` images, least recently used first."""
+    thumbnails = []
+    for i in range(count):
+        thumbnail = provider.get_or_create_thumbnail(make_jpeg(tmp_path / f'{i}.jpg', size=(300 + i, 200)), 128)
+        os.utime(thumbnail, (1000 + i, 1000 + i))
+        thumbnails.append(thumbnail)
+    return thumbnails
+
+
+def test_edited_image_gets_a_new_thumbnail(provider, tmp_path):
+    image_path = make_jpeg(tmp_path / 'a.jpg')
+    before = provider.get_or_create_thumbnail(image_path)
+    make_jpeg(tmp_path / 'a.jpg', size=(600, 1000))
+    after = provider.get_or_create_thumbnail(image_path)
+    assert after != before
+    with Image.open(after) as thumbnail:
+        assert thumbnail.size == (307, 512)
+
+
+def test_cache_is_sharded_two_levels_deep(provider, tmp_path):
+    thumbnail = provider.get_or_create_thumbnail(make_jpeg(tmp_path / 'a.jpg'), 256)
+    first, second, name = thumbnail.relative_to(provider.cache_dir).parts
+    assert (first, second) == (name[:2], name[2:4]) and name.endswith('_256.jpg')
+
+
+def test_sweep_evicts_the_least_recently_used(provider, tmp_path):
+    provider._sweeper.wait_until_idle()
+    thumbnails = make_thumbnails(provider, tmp_path, 6)
+    total = sum(t.stat().st_size for t in thumbnails)
+    provider.max_cache_bytes = total - 1
+    provider._sweep()
+
+    remaining = [t.exists() for t in thumbnails]
+    assert remaining == sorted(remaining) and remaining.count(False) >= 1
+    kept_bytes = sum(t.stat().st_size for t in thumbnails if t.exists())
+    assert kept_bytes <= 0.9 * provider.max_cache_bytes
+    stats = provider.get_stats()
+    assert stats['evictions'] == remaining.count(False) and stats['cache_bytes'] == kept_bytes
+
+
+def test_serving_a_thumbnail_marks_it_as_used(provider, tmp_path):
+    provider._sweeper.wait_until_idle()
+    thumbnails = make_thumbnails(provider, tmp_path, 3)
+    assert provider.get_or_create_thumbnail(str(tmp_path / '0.jpg'), 128) == thumbnails[0]
+    assert thumbnails[0].stat().st_mtime > time.time() - 60
+    provider.max_cache_bytes = sum(t.stat().st_size for t in thumbnails) - 1
+    provider._sweep()
+    assert [t.exists() for t in thumbnails] == [True, False, True]
+
+
+def test_writes_over_budget_trigger_a_sweep(tmp_path):
+    provider = ThumbnailProvider(cache_dir=str(tmp_path / 'cache'), max_cache_bytes=5000)
+    provider._sweeper.wait_until_idle()
+    for i in range(10):
+        provider.get_or_create_thumbnail(make_jpeg(tmp_path / f'{i}.jpg', size=(300 + i, 200)), 128)
+    provider._sweeper.wait_until_idle()
+    assert provider.get_stats()['evictions'] > 0
+    on_disk = sum(p.stat().st_size for p in Path(provider.cache_dir).rglob('*.jpg'))
+    assert provider.get_stats()['cache_bytes'] == on_disk
+
+
+def test_stale_temp_files_are_removed(provider, tmp_path):
+    provider._sweeper.wait_until_idle()
+    stale = provider.cache_dir / 'ab' / 'cd' / 'abcd_128.jpg.1234.tmp'
+    stale.parent.mkdir(parents=True)
+    stale.write_bytes(b'partial')
+    os.utime(stale, (1000, 1000))
+    recent = provider.cache_dir / 'ab' / 'cd' / 'abcd_256.jpg.1234.tmp'
+    recent.write_bytes(b'being written')
+    provider._sweep()
+    assert not stale.exists() and recent.exists()
+
+
+def test_sweep_tolerates_temp_files_vanishing(provider, monkeypatch):
+    provider._sweeper.wait_until_idle()
+    stale = provider.cache_dir / 'ab' / 'abcd_128.jpg.1234.tmp'
+    stale.parent.mkdir(parents=True)
+    stale.write_bytes(b'partial')
+    os.utime(stale, (1000, 1000))
+    remove = os.remove
+
+    def remove_after_someone_else(path):
+        # the writer's own cleanup (or another sweep) got there first
+        remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, 'remove', remove_after_someone_else)
+    provider._sweep()
+    assert not stale.exists()
+
+
+def test_stats_count_hits_misses_and_errors(provider, tmp_path):
+    image_path = make_jpeg(tmp_path / 'a.jpg')
+    provider.get_or_create_thumbnail(image_path)
+    provider.get_or_create_thumbnail(image_path)
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'not a jpeg')
+    with pytest.raises(RuntimeError):
+        provider.get_or_create_thumbnail(str(broken))
+    stats = provider.get_stats()
+    assert (stats['hits'], stats['misses'], stats['errors']) == (1, 2, 1)
+
+
+def unpack_thumbnails(body: bytes) -> list[tuple[str, bytes]]:
+    records = []
+    offset = 0
+    while offset < len(body):
+        id_length, = struct.unpack_from('>I', body, offset)
+        image_id = body[offset + 4:offset + 4 + id_length].decode('utf-8')
+        offset += 4 + id_length
+        jpeg_length, = struct.unpack_from('>I', body, offset)
+        records.append((image_id, body[offset + 4:offset + 4 + jpeg_length]))
+        offset += 4 + jpeg_length
+    return records
+
+
+def test_page_of_thumbnails(provider, tmp_path):
+    image_paths = [make_jpeg(tmp_path / f'{i}.jpg', size=(300 + i, 200)) for i in range(5)]
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'not a jpeg')
+    requested = image_paths[:2] + [str(broken), str(tmp_path / 'missing.jpg'), None] + image_paths[2:]
+
+    thumbnails = provider.get_thumbnails_bytes(requested, 128)
+    assert [t is None for t in thumbnails] == [False, False, True, True, True, False, False, False]
+    for image_path, thumbnail in zip(requested, thumbnails):
+        if thumbnail is not None:
+            assert thumbnail == provider.get_thumbnail_path(image_path, 128).read_bytes()
+
+
+def test_thumbnails_are_packed_as_length_prefixed_records():
+    ids = ['a', 'ünïcode', 'missing']
+    thumbnails = [b'\xff\xd8jpeg a', b'\xff\xd8jpeg b', None]
+    body = pack_thumbnails(ids, thumbnails)
+    assert body[:9] == b'\x00\x00\x00\x01a\x00\x00\x00\x08'
+    assert unpack_thumbnails(body) == [('a', thumbnails[0]), ('ünïcode', thumbnails[1]), ('missing', b'')]
+    assert pack_thumbnails([], []) == b''
+
+
+def test_every_tier_is_written_from_a_decoded_image(provider, tmp_path, monkeypatch):
+    image_path = make_jpeg(tmp_path / 'a.jpg', size=(1000, 600))
+    with Image.open(image_path) as img:
+        decoded = img.convert('RGB')
+    provider.write_thumbnails_from_image(image_path, decoded)
+    assert decoded.size == (1000, 600)
+    assert provider.get_stats()['prewarmed'] == 3
+
+    monkeypatch.setattr(Image, 'open', lambda *args, **kwargs: pytest.fail('the image was decoded again'))
+    thumbnail_paths = [provider.get_or_create_thumbnail(image_path, tier) for tier in provider.size_tiers]
+    monkeypatch.undo()
+    sizes = []
+    for thumbnail_path in thumbnail_paths:
+        with Image.open(thumbnail_path) as thumbnail:
+            sizes.append(thumbnail.size)
+    assert sizes == [(128, 77), (256, 154), (512, 307)]
+    assert provider.get_stats()['hits'] == 3
+
+
+def test_small_images_are_not_enlarged(provider, tmp_path):
+    image_path = make_jpeg(tmp_path / 'small.jpg', size=(200, 100))
+    with Image.open(image_path) as img:
+        provider.write_thumbnails_from_image(image_path, img.convert('RGB'))
+    with Image.open(provider.get_thumbnail_path(image_path, 512)) as thumbnail:
+        assert thumbnail.size == (200, 100)
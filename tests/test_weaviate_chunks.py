@@ -0,0 +1,84 @@
+import os
+
+import pytest
+import torch
+
+from clip_finder_backend.embedding_store import ShardedEmbeddingStore, load_chunk_paths
+from clip_finder_backend.weaviate_chunks import MANIFEST_NAME, find_chunk_files, iter_shards, read_chunks
+from conftest import EMBEDDING_DIM, FakeClipModel
+
+CHUNK_SIZES = [5, 3, 8, 1, 6]
+
+
+def write_chunk(folder, index: int, first_row: int, size: int) -> list[str]:
+    paths = [f'/images/{first_row + i}.jpg' for i in range(size)]
+    vectors = torch.arange(first_row, first_row + size, dtype=torch.float32).unsqueeze(1).repeat(1, EMBEDDING_DIM)
+    torch.save({'objects': [{'path': p} for p in paths], 'vectors': vectors}, os.path.join(folder, f'part_{index:04d}.pt'))
+    return paths
+
+
+@pytest.fixture
+def chunks_folder(tmp_path) -> str:
+    folder = tmp_path / 'chunks'
+    folder.mkdir()
+    first_row = 0
+    for index, size in enumerate(CHUNK_SIZES):
+        write_chunk(folder, index, first_row, size)
+        first_row += size
+    return str(folder)
+
+
+def test_chunks_are_read_in_order(chunks_folder):
+    chunk_files = find_chunk_files(chunks_folder)
+    assert len(chunk_files) == len(CHUNK_SIZES)
+    chunks = list(read_chunks(chunk_files, workers=2))
+    assert [len(paths) for paths, _ in chunks] == CHUNK_SIZES
+    assert [p for paths, _ in chunks for p in paths] == [f'/images/{i}.jpg' for i in range(sum(CHUNK_SIZES))]
+
+
+@pytest.mark.parametrize('shard_size', [1, 4, 7, 23, 100])
+def test_chunks_are_regrouped_into_shards(chunks_folder, shard_size):
+    shards = list(iter_shards(find_chunk_files(chunks_folder), shard_size, workers=3))
+    total = sum(CHUNK_SIZES)
+    assert [len(paths) for paths, _ in shards] == [min(shard_size, total - start) for start in range(0, total, shard_size)]
+    rows = torch.cat([embeddings for _, embeddings in shards])
+    assert torch.equal(rows[:, 0], torch.arange(total, dtype=torch.float32))
+    assert [p for paths, _ in shards for p in paths] == [f'/images/{i}.jpg' for i in range(total)]
+
+
+def load(chunks_folder, shard_size=10, **kwargs) -> ShardedEmbeddingStore:
+    return ShardedEmbeddingStore.from_weaviate_dump_chunks(chunks_folder, clip_model=FakeClipModel(), shard_size=shard_size, **kwargs)
+
+
+def test_first_load_converts_to_native_shards(chunks_folder, monkeypatch):
+    store = load(chunks_folder)
+    assert [len(shard.image_paths) for shard in store.shards] == [10, 10, 3]
+    native_folder = os.path.join(chunks_folder, 'native_shards')
+    assert os.path.exists(os.path.join(native_folder, MANIFEST_NAME))
+
+    # later loads don't read the chunks at all, and keep the image ids
+    monkeypatch.setattr(torch, 'load', lambda *args, **kwargs: pytest.fail("chunks were read again"))
+    reloaded = load(chunks_folder)
+    assert [shard.image_ids for shard in reloaded.shards] == [shard.image_ids for shard in store.shards]
+    assert torch.equal(reloaded.shards[1].image_embeddings, store.shards[1].image_embeddings)
+    assert load_chunk_paths(chunks_folder) == [f'/images/{i}.jpg' for i in range(sum(CHUNK_SIZES))]
+
+
+def test_changed_chunks_or_shard_size_trigger_a_new_conversion(chunks_folder):
+    store = load(chunks_folder)
+    assert [len(shard.image_paths) for shard in load(chunks_folder, shard_size=20).shards] == [20, 3]
+
+    write_chunk(chunks_folder, len(CHUNK_SIZES), sum(CHUNK_SIZES), 4)
+    reloaded = load(chunks_folder, shard_size=20)
+    assert [len(shard.image_paths) for shard in reloaded.shards] == [20, 7]
+    assert reloaded.shards[1].image_paths[-1] == '/images/26.jpg'
+    assert reloaded.shards[0].image_ids != store.shards[0].image_ids + store.shards[1].image_ids
+    native_shards = sorted(name for name in os.listdir(os.path.join(chunks_folder, 'native_shards')) if name.endswith('.store'))
+    assert native_shards == ['shard_0000.store', 'shard_0001.store']
+
+
+def test_chunks_can_be_loaded_without_converting(chunks_folder):
+    store = load(chunks_folder, convert_to_native=False)
+    assert [len(shard.image_paths) for shard in store.shards] == [10, 10, 3]
+    assert not os.path.exists(os.path.join(chunks_folder, 'native_shards'))
+    assert load_chunk_paths(chunks_folder)[-1] == '/images/22.jpg'